@@ -0,0 +1,385 @@
+# Ahead-of-time translation of asm programs into Python modules
+
+"""
+Instead of decoding a program every time it runs, it can be translated once into a Python module,
+which is imported like any other (so CPython caches its bytecode in __pycache__).
+
+The code is split into one function per global label, and each function into basic blocks.
+A function runs its blocks inside a single `while True` loop, with a check of the program counter
+in front of each block: falling through or branching forwards simply runs on into the next check,
+and branching backwards restarts the loop. The guest registers are local ints within a function,
+and are written back to the VM's register file whenever control leaves it.
+
+Control leaves a function for a jump into another function, for jalr (calls and returns),
+and for traps: instructions which the module leaves to the VM (the debug insn, unknown instructions,
+negative shift immediates), and memory accesses which are misaligned or out of bounds,
+so that the VM raises exactly the same error. After a trap, the VM runs instructions
+one by one until the program counter reaches the start of a translated block again.
+
+The module also embeds the program itself, so the VM can load it (lazily, so nothing is decoded)
+and run the instructions which trap.
+"""
+
+import importlib.util
+import os
+import py_compile
+import re
+import parser
+from parser import Parser
+from interpreter import VM, MemoryLayout, OPCODES, DEFAULT_DATA_BASE, MASK_32, code_label_locator, parse_address
+
+AOT_VERSION = 1
+HALT_PC = 0xFFFFFFFF
+TRAP = 1 << 32  # flag on the program counter returned by a function when the VM has to run that instruction
+NUMERIC_LABEL_PATTERN = re.compile(r'^\d+[fb]?$')
+SPILL_MARKER = "<write back registers>"
+
+# expressions for each ALU instruction, over the (masked, unsigned) operand values x and y
+ALU_EXPRESSIONS = {
+    "add": "({x} + {y}) & M",
+    "sub": "({x} - {y}) & M",
+    "and": "{x} & {y}",
+    "or": "{x} | {y}",
+    "xor": "{x} ^ {y}",
+    "sll": "({x} << {y}) & M if {y} < 32 else 0",
+    "srl": "{x} >> {y}",
+    "sra": "((({x} ^ 0x80000000) - 0x80000000) >> {y}) & M",
+    "slt": "1 if ({x} ^ 0x80000000) < ({y} ^ 0x80000000) else 0",
+    "sltu": "1 if {x} < {y} else 0",
+    "mul": "({x} * {y}) & M",
+    "mulh": "((to_signed_32({x}) * to_signed_32({y})) >> 32) & M",
+    "mulhu": "({x} * {y}) >> 32",
+    "div": "trunc_divmod(to_signed_32({x}), to_signed_32({y}))[0] & M if {y} else M",
+    "divu": "{x} // {y} if {y} else M",
+    "rem": "trunc_divmod(to_signed_32({x}), to_signed_32({y}))[1] & M if {y} else M",
+    "remu": "{x} % {y} if {y} else M",
+}
+SHIFT_IMMEDIATES = ("slli", "srli", "srai")
+BRANCH_CONDITIONS = {
+    "beq": "{x} == {y}",
+    "bne": "{x} != {y}",
+    "blt": "({x} ^ 0x80000000) < ({y} ^ 0x80000000)",
+    "bge": "({x} ^ 0x80000000) >= ({y} ^ 0x80000000)",
+    "bltu": "{x} < {y}",
+    "bgeu": "{x} >= {y}",
+}
+LOAD_EXPRESSIONS = {
+    "lw": "mem[addr] | mem[addr + 1] << 8 | mem[addr + 2] << 16 | mem[addr + 3] << 24",
+    "lh": "(((mem[addr] | mem[addr + 1] << 8) ^ 0x8000) - 0x8000) & M",
+    "lhu": "mem[addr] | mem[addr + 1] << 8",
+    "lb": "((mem[addr] ^ 0x80) - 0x80) & M",
+    "lbu": "mem[addr]",
+}
+ACCESS_SIZES = { "lw": 4, "sw": 4, "lh": 2, "lhu": 2, "sh": 2, "lb": 1, "lbu": 1, "sb": 1 }
+
+class TrapInstruction(Exception):
+    # raised while translating an instruction which the VM has to run itself
+    pass
+
+def local_name(reg):
+    return "0" if reg == "zero" else f"r_{reg}"
+
+def function_name(label, taken_names):
+    name = "fn_" + re.sub(r'\W', '_', label)
+    while name in taken_names:
+        name += "_"
+    taken_names.add(name)
+    return name
+
+class Translator:
+    def __init__(self, program: Parser, data_base=DEFAULT_DATA_BASE):
+        self.program = program
+        self.data_base = data_base
+        # a VM resolves the labels exactly as it would when running the program
+        self.vm = VM(layout=MemoryLayout.for_program(program, data_base=data_base))
+        self.vm.load_program(program, lazy=True)
+        self.length = len(program.code)
+
+    def branch_target(self, idx, label):
+        return code_label_locator(self.vm, idx)(label)
+
+    def find_functions(self) -> list:
+        # (name, start, end) for each global label, plus any code before the first one
+        starts = []
+        for idx in range(self.length):
+            if any(not NUMERIC_LABEL_PATTERN.match(label) for label in self.program.code_labels[idx]):
+                starts.append(idx)
+        if not starts or starts[0] != 0:
+            starts.insert(0, 0)
+        taken_names = set()
+        functions = []
+        for n, start in enumerate(starts):
+            end = starts[n + 1] if n + 1 < len(starts) else self.length
+            global_labels = [label for label in self.program.code_labels[start] if not NUMERIC_LABEL_PATTERN.match(label)]
+            functions.append((function_name(global_labels[0] if global_labels else "start", taken_names), start, end))
+        return functions
+
+    def find_leaders(self) -> set:
+        # the first instruction of every basic block
+        leaders = { 0 }
+        for idx, (instr, args) in enumerate(self.program.code):
+            if self.program.code_labels[idx]:
+                leaders.add(idx)
+            spec = OPCODES.get(instr)
+            if spec is None or not spec.is_branch:
+                continue
+            leaders.add(idx + 1)
+            try:
+                if spec.fmt == "branch":
+                    leaders.add(self.branch_target(idx, args[2]))
+                elif spec.fmt == "jal":
+                    leaders.add(self.branch_target(idx, args[1]))
+            except (ValueError, IndexError):
+                pass  # the instruction traps instead
+        return { leader for leader in leaders if leader < self.length }
+
+    def translate(self, source_name="<asm>") -> str:
+        functions = self.find_functions()
+        leaders = self.find_leaders() | { start for _, start, _ in functions }
+        lines = [
+            f"# Translated from {source_name} by aot.py, do not edit",
+            "from interpreter import to_signed_32, trunc_divmod",
+            "",
+            f"AOT_VERSION = {AOT_VERSION}",
+            f"DATA_BASE = {self.data_base}",
+            "M = 0xFFFFFFFF",
+            f"TRAP = {TRAP}",
+            "",
+            f"CODE = {[(instr, list(args)) for instr, args in self.program.code]!r}",
+            f"CODE_LABELS = {[list(labels) for labels in self.program.code_labels]!r}",
+            f"DATA = {bytes(self.program.data)!r}",
+            f"DATA_LABELS = {[list(labels) for labels in self.program.data_labels]!r}",
+        ]
+        entry_points = []
+        for name, start, end in functions:
+            blocks = sorted(leader for leader in leaders if start <= leader < end)
+            lines.append("")
+            lines.extend(FunctionTranslator(self, name, start, end, blocks).translate())
+            entry_points.extend((block, name) for block in blocks)
+
+        lines.append("")
+        lines.append("# the start of every translated block -> the function holding it")
+        lines.append("ENTRY_POINTS = {")
+        for block, name in entry_points:
+            lines.append(f"    {block}: {name},")
+        lines.append("}")
+        return "\n".join(lines) + "\n"
+
+class FunctionTranslator:
+    def __init__(self, translator: Translator, name, start, end, blocks):
+        self.translator = translator
+        self.program_code = translator.program.code
+        self.name = name
+        self.start = start
+        self.end = end
+        self.blocks = blocks
+        self.block_ends = { block: (blocks[n + 1] if n + 1 < len(blocks) else end) for n, block in enumerate(blocks) }
+        self.written = set()  # registers this function assigns, which have to be written back
+        self.read = set()
+
+    def reg(self, name):
+        if not re.match(r'^\w+$', name):
+            raise TrapInstruction(f"Invalid register: {name}")
+        if name != "zero":
+            self.read.add(name)
+        return local_name(name)
+
+    def dest(self, name):
+        self.reg(name)
+        if name != "zero":
+            self.written.add(name)
+        return local_name(name)
+
+    def leave(self, pc_expr) -> list:
+        # write the registers back, and hand control to the driver.
+        # which registers the function writes is only known at the end, so they are filled in then
+        return [SPILL_MARKER, f"return {pc_expr}"]
+
+    def jump(self, block, target) -> list:
+        if self.start <= target < self.end and target in self.block_ends:
+            if target <= block:
+                return [f"pc = {target}", "continue"]  # backwards, so start the checks over
+            return [f"pc = {target}"]  # forwards, the checks run on into the target
+        return self.leave(target)
+
+    def translate(self) -> list:
+        body = []
+        for block in self.blocks:
+            body.append(f"if pc == {block}:")
+            body.extend("    " + line for line in self.translate_block(block))
+        body.extend(self.leave("pc"))  # not the start of a block: the VM takes over
+
+        header = [f"def {self.name}(vm, regs, pc):"]
+        header.append("    mem = vm.memory")
+        header.append("    mem_size = len(mem)")
+        header.append("    print_char = vm.print_char")
+        for reg in sorted(self.read):
+            header.append(f'    r_{reg} = regs["{reg}"]')
+        header.append("    while True:")
+        lines = header
+        for line in body:
+            if line.strip() == SPILL_MARKER:
+                indent = "        " + line[:len(line) - len(line.lstrip())]
+                lines.extend(f'{indent}regs["{reg}"] = r_{reg}' for reg in sorted(self.written))
+            else:
+                lines.append("        " + line)
+        return lines
+
+    def translate_block(self, block) -> list:
+        lines = []
+        for idx in range(block, self.block_ends[block]):
+            instr, args = self.program_code[idx]
+            try:
+                instruction_lines, ends_block = self.translate_instruction(block, idx, instr, args)
+            except (TrapInstruction, ValueError, IndexError):
+                lines.extend(self.leave(f"{idx} | TRAP"))
+                return lines
+            lines.append(f"# {instr} {', '.join(args)}")
+            lines.extend(instruction_lines)
+            if ends_block:
+                return lines
+        lines.extend(self.jump(block, self.block_ends[block]))
+        return lines
+
+    def translate_instruction(self, block, idx, instr, args):
+        # returns the lines of python, and whether they always leave the block
+        spec = OPCODES.get(instr)
+        if spec is None or (instr == "xor" and args == ["zero", "zero", "zero"]):
+            raise TrapInstruction(instr)
+
+        if spec.fmt == "none":
+            return ["pass"], False
+        elif spec.fmt == "printc":
+            return [f"print_char({self.reg(args[0])} & 0xFF)"], False
+        elif spec.fmt == "r" and instr in ALU_EXPRESSIONS:
+            expression = ALU_EXPRESSIONS[instr].format(x=self.reg(args[1]), y=self.reg(args[2]))
+            return self.assign(args[0], expression), False
+        elif spec.fmt == "i" and instr[:-1] in ALU_EXPRESSIONS:
+            immediate = int(args[2], 0)
+            if args[1] == "zero":
+                # a constant, such as the li idiom addi rd, zero, K
+                return self.assign(args[0], str(spec.semantics(0, immediate) & MASK_32)), False
+            if instr in SHIFT_IMMEDIATES:
+                if immediate < 0:
+                    raise TrapInstruction("Negative shift count")  # raises in the VM
+                operand = str(immediate)
+            else:
+                operand = str(immediate & MASK_32)
+            expression = ALU_EXPRESSIONS[instr[:-1]].format(x=self.reg(args[1]), y=operand)
+            return self.assign(args[0], expression), False
+        elif spec.fmt == "la":
+            data_labels = self.translator.vm.data_labels
+            if args[1] not in data_labels:
+                raise TrapInstruction(f"Label '{args[1]}' not found")
+            return self.assign(args[0], str(data_labels[args[1]])), False
+        elif spec.fmt == "load" and instr in LOAD_EXPRESSIONS:
+            offset, base_reg = parse_address(args[1], "lw")
+            lines = self.address_check(idx, base_reg, offset, ACCESS_SIZES[instr])
+            return lines + self.assign(args[0], LOAD_EXPRESSIONS[instr]), False
+        elif spec.fmt == "store" and instr in ACCESS_SIZES:
+            offset, base_reg = parse_address(args[0], "sw")
+            lines = self.address_check(idx, base_reg, offset, ACCESS_SIZES[instr])
+            value = self.reg(args[1])
+            for byte in range(ACCESS_SIZES[instr]):
+                if value == "0":
+                    byte_value = "0"
+                elif byte == 0:
+                    byte_value = f"{value} & 0xFF"
+                else:
+                    byte_value = f"{value} >> {8 * byte} & 0xFF"
+                lines.append(f"mem[addr{f' + {byte}' if byte else ''}] = {byte_value}")
+            return lines, False
+        elif spec.fmt == "branch" and instr in BRANCH_CONDITIONS:
+            target = self.translator.branch_target(idx, args[2])
+            condition = BRANCH_CONDITIONS[instr].format(x=self.reg(args[0]), y=self.reg(args[1]))
+            lines = [f"if {condition}:"]
+            lines.extend("    " + line for line in self.jump(block, target))
+            lines.append("else:")
+            lines.extend("    " + line for line in self.jump(block, idx + 1))
+            return lines, True
+        elif spec.fmt == "jal":
+            target = self.translator.branch_target(idx, args[1])
+            return self.assign(args[0], str(idx + 1)) + self.jump(block, target), True
+        elif spec.fmt == "jalr":
+            target_offset = int(args[2] if len(args) > 2 else "0", 0)
+            lines = [f"target = ({self.reg(args[1])} + {target_offset}) & M"]
+            return lines + self.assign(args[0], str(idx + 1)) + self.leave("target"), True
+        raise TrapInstruction(instr)
+
+    def assign(self, dest_reg, expression) -> list:
+        if dest_reg == "zero":
+            return []  # writes to zero are dropped (none of the expressions can raise)
+        return [f"{self.dest(dest_reg)} = {expression}"]
+
+    def address_check(self, idx, base_reg, offset, size) -> list:
+        lines = [f"addr = ({self.reg(base_reg)} + {offset}) & M"]
+        fault = f"addr & {size - 1} or addr + {size} > mem_size" if size > 1 else f"addr + 1 > mem_size"
+        lines.append(f"if {fault}:")
+        lines.extend("    " + line for line in self.leave(f"{idx} | TRAP"))
+        return lines
+
+
+def translate_program(program: Parser, data_base=DEFAULT_DATA_BASE, source_name="<asm>") -> str:
+    return Translator(program, data_base).translate(source_name)
+
+def translate_file(asm_filename: str, py_filename: str, data_base=DEFAULT_DATA_BASE):
+    source = translate_program(parser.parse_file(asm_filename), data_base, asm_filename)
+    with open(py_filename, "w") as f:
+        f.write(source)
+    # a hash-checked .pyc is never stale, even if the module is retranslated within the same second
+    py_compile.compile(py_filename, invalidation_mode=py_compile.PycInvalidationMode.CHECKED_HASH, doraise=True)
+
+def load_module(py_filename: str):
+    # imports a translated module from its path, which caches its bytecode like any other import
+    module_name = "aot_" + re.sub(r'\W', '_', os.path.splitext(os.path.basename(py_filename))[0])
+    spec = importlib.util.spec_from_file_location(module_name, py_filename)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    if getattr(module, "AOT_VERSION", None) != AOT_VERSION:
+        raise ValueError(f"{py_filename} was not translated by this version of aot.py")
+    return module
+
+def module_program(module) -> Parser:
+    # the program embedded in a translated module, for the VM to load
+    program = Parser()
+    program.code = [(instr, args) for instr, args in module.CODE]
+    program.code_labels = module.CODE_LABELS
+    program.data = bytearray(module.DATA)
+    program.data_labels = module.DATA_LABELS
+    return program
+
+def run_module(module, vm: VM):
+    """
+    Runs the VM (which has the module's program loaded, with the module's data base)
+    until it halts, running the translated functions wherever possible
+    """
+    if vm.layout.data_base != module.DATA_BASE:
+        raise ValueError(f"The module was translated for data at {hex(module.DATA_BASE)}, not {hex(vm.layout.data_base)}")
+    entry_points = module.ENTRY_POINTS
+    regs = vm.registers.regs
+    pc = vm.program_counter
+    while pc != HALT_PC:
+        function = entry_points.get(pc)
+        if function is not None:
+            pc = function(vm, regs, pc)
+            if not pc & TRAP:
+                continue
+            pc ^= TRAP
+        # the VM runs this instruction itself, or raises for a bad program counter
+        vm.program_counter = pc
+        vm.interpret_step()
+        pc = vm.program_counter
+    vm.program_counter = pc
+
+
+if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) != 3:
+        print("Please enter the name of the asm file to translate, and the python file to write")
+        print(f"Usage: python3 {sys.argv[0]} <asm_file> <py_file>")
+        sys.exit(1)
+
+    translate_file(sys.argv[1], sys.argv[2])
+    print(f"Translated {sys.argv[1]} into {sys.argv[2]}")
+    print(f"Run it with: python3 interpreter.py {sys.argv[2]}")
@@ -0,0 +1,177 @@
+# Runs many programs and entry points across a pool of worker processes
+
+"""
+The manifest is a JSONL file with one job per line, for example:
+    {"asm": "mathlang/user_output.txt", "link": ["mathlang/lib_asm.obj"], "entry": "main",
+     "mem_size": 4096, "input": "text for readc", "max_steps": 1000000}
+Only "asm" is required; "input_file" may name a file to read the input from instead.
+A job which has not halted after max_steps instructions (DEFAULT_MAX_STEPS unless given, or no limit for null)
+is stopped and reported as an error, so a program which never halts cannot hold up the whole batch.
+
+Every distinct program (asm file plus the objects it links) is assembled once, up front, and sent to each
+worker once when the pool starts. Workers decode a program the first time one of its jobs runs there,
+and reuse the decoded instructions for every later job, so a job only costs a fresh VM.
+Each job's output, status, return value (a0), instruction count and time is written to a JSONL result file.
+"""
+
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import linker
+from interpreter import VM, MemoryLayout, DEFAULT_MEM_SIZE
+
+JOBS_PER_CHUNK = 16  # jobs sent to a worker at once, so tiny jobs are not dominated by the round trip
+DEFAULT_MAX_STEPS = 10_000_000
+
+def program_key(job: dict) -> tuple:
+    return (job["asm"],) + tuple(job.get("link", []))
+
+def assemble_programs(jobs: list) -> tuple:
+    """
+    Assembles and links every distinct program of the jobs.
+    Returns (program key -> Parser, program key -> error message for the programs which failed)
+    """
+    objects = {}  # file name -> ObjectFile, since many programs link the same library
+    def load_object(filename):
+        if filename not in objects:
+            objects[filename] = linker.load_object_or_asm(filename)
+        return objects[filename]
+
+    programs = {}
+    errors = {}
+    for job in jobs:
+        key = program_key(job)
+        if key in programs or key in errors:
+            continue
+        try:
+            if job.get("link"):
+                programs[key] = linker.link([load_object(name) for name in job["link"]] + [linker.assemble_file(job["asm"])])
+            else:
+                programs[key] = linker.assemble_file(job["asm"]).program
+        except (ValueError, OSError) as e:
+            errors[key] = str(e)
+    return programs, errors
+
+# the state of each worker process
+worker_programs = {}  # program key -> Parser, set once by init_worker
+worker_code = {}  # program key -> decoded instructions, which do not depend on the memory size
+
+def init_worker(programs: dict):
+    global worker_programs
+    worker_programs = programs
+
+def new_vm(key, mem_size) -> VM:
+    program = worker_programs[key]
+    layout = MemoryLayout.for_program(program, min_mem_size=mem_size)
+    vm = VM(layout=layout)
+    if key in worker_code:
+        vm.load_program(program, lazy=True)  # only copies the data segment and labels
+        vm.code = list(worker_code[key])
+    else:
+        vm.load_program(program)
+        worker_code[key] = list(vm.code)
+    return vm
+
+def run_job(job: dict) -> dict:
+    result = { "job": job["index"], "asm": job["asm"], "entry": job.get("entry", "main") }
+    start = time.perf_counter()
+    vm = None
+    try:
+        vm = new_vm(program_key(job), job.get("mem_size", DEFAULT_MEM_SIZE))
+        if "input_file" in job:
+            with open(job["input_file"], "rb") as f:
+                vm.input_buffer = f.read()
+        else:
+            vm.input_buffer = job.get("input", "").encode("utf-8")
+        vm.output_buffer = []
+        vm.call_function(result["entry"])
+        max_steps = job.get("max_steps", DEFAULT_MAX_STEPS)
+        if vm.run(max_steps):
+            result["status"] = "halted"
+            result["error"] = None
+        else:
+            result["status"] = "error"
+            result["error"] = f"Did not halt within {max_steps} instructions"
+    except Exception as e:
+        result["status"] = "error"
+        result["error"] = str(e)
+    result["time"] = time.perf_counter() - start
+    result["output"] = "".join(vm.output_buffer) if vm is not None and vm.output_buffer else ""
+    result["steps"] = vm.step_count if vm is not None else 0
+    result["return_value"] = vm.registers.read("a0") if vm is not None else None
+    return result
+
+def run_chunk(jobs: list) -> list:
+    return [run_job(job) for job in jobs]
+
+def read_manifest(filename: str) -> list:
+    jobs = []
+    with open(filename, "r") as f:
+        for line_number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            job = json.loads(line)
+            if "asm" not in job:
+                raise ValueError(f"Line {line_number}: job has no asm file")
+            job["index"] = len(jobs)
+            jobs.append(job)
+    return jobs
+
+def run_batch(jobs: list, results_filename: str, workers: int = None) -> dict:
+    """
+    Runs every job, writing one result line per job (in manifest order) to results_filename.
+    Returns a count of the jobs by status
+    """
+    programs, errors = assemble_programs(jobs)
+    runnable = [job for job in jobs if program_key(job) in programs]
+    chunks = [runnable[i:i + JOBS_PER_CHUNK] for i in range(0, len(runnable), JOBS_PER_CHUNK)]
+
+    results = {}
+    for job in jobs:
+        key = program_key(job)
+        if key in errors:
+            results[job["index"]] = { "job": job["index"], "asm": job["asm"], "entry": job.get("entry", "main"),
+                                      "status": "error", "error": errors[key], "time": 0.0,
+                                      "output": "", "steps": 0, "return_value": None }
+
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count(), initializer=init_worker, initargs=(programs,)) as pool:
+        for chunk_results in pool.map(run_chunk, chunks):
+            for result in chunk_results:
+                results[result["job"]] = result
+
+    counts = {}
+    with open(results_filename, "w") as f:
+        for index in range(len(jobs)):
+            result = results[index]
+            f.write(json.dumps(result) + "\n")
+            counts[result["status"]] = counts.get(result["status"], 0) + 1
+    return counts
+
+
+if __name__ == "__main__":
+    import sys
+
+    args = sys.argv[1:]
+    workers = None
+    if "--workers" in args:
+        idx = args.index("--workers")
+        if idx + 1 >= len(args):
+            print("--workers must be followed by a number")
+            sys.exit(1)
+        workers = int(args[idx + 1])
+        del args[idx:idx + 2]
+
+    if len(args) != 2:
+        print("Please enter the name of the manifest file, and the result file to write")
+        print(f"Usage: python3 {sys.argv[0]} <manifest_file> <result_file> [--workers N]")
+        sys.exit(1)
+
+    # go through the module, so the workers can find the functions they are sent
+    import batch
+    start = time.perf_counter()
+    jobs = batch.read_manifest(args[0])
+    counts = batch.run_batch(jobs, args[1], workers)
+    elapsed = time.perf_counter() - start
+    summary = ", ".join(f"{count} {status}" for status, count in sorted(counts.items()))
+    print(f"Ran {len(jobs)} jobs in {elapsed:.2f}s ({summary})")
@@ -0,0 +1,300 @@
+# Differential testing and timing of every way to run a mathlang program
+
+"""
+Random mathlang programs are run through every engine, and each engine's final values of a, b and c
+are compared against what its semantics predict:
+  - the Python engines (mathlang, mathlang2, and mathlang++ compiled to mathlang2) use unbounded ints
+    and floor division, so they must agree exactly with mathlang's interpreter
+  - the VM engines (the mathlang compiler's asm, run plainly, fused, natively or translated ahead of time)
+    use 32-bit registers, so they must agree with a 32-bit model of the program instead: values wrap around,
+    division truncates towards zero, and dividing by zero gives -1 rather than raising
+
+The generated programs first assign a, b and c literals, and then only use non-negative literals,
+so the same source is valid mathlang, mathlang2 and mathlang++.
+Where the 32-bit model differs from the unbounded result, the reason is counted as a known difference.
+Each engine's time is split into preparing a program (parsing, compiling, assembling, decoding) and running it.
+"""
+
+import platform
+import random
+import time
+import types
+import linker
+import aot
+import superinstructions
+from interpreter import VM, MemoryLayout, to_signed_32
+from mathlang.parser import Parser as MathlangParser
+from mathlang.interpreter import Interpreter as MathlangInterpreter
+from mathlang.compiler import Compiler as MathlangCompiler, LIB_FILE
+from mathlang2.parser import Parser as Mathlang2Parser
+from mathlang2.interpreter import Interpreter as Mathlang2Interpreter, compile_code
+from mathlangplusplus.parser import Code as MathlangPlusPlusCode, parse_chunk
+from mathlangplusplus.compiler import Compiler as MathlangPlusPlusCompiler
+
+VARIABLES = ["a", "b", "c"]
+OPERATORS = ["+", "-", "*", "/"]
+
+def random_literal(rng: random.Random, nonzero=False) -> int:
+    # mostly small, sometimes large enough that a few multiplications overflow 32 bits
+    value = rng.randint(0, 100) if rng.random() < 0.8 else rng.randint(0, 100000)
+    return max(value, 1) if nonzero else value
+
+def random_program(rng: random.Random, statements: int) -> str:
+    lines = [f"{var} = {random_literal(rng)}" for var in VARIABLES]
+    for _ in range(statements):
+        lhs = rng.choice(VARIABLES)
+        kind = rng.random()
+        if kind < 0.15:
+            rhs = str(random_literal(rng))
+        elif kind < 0.3:
+            rhs = rng.choice(VARIABLES)
+        else:
+            op = rng.choice(OPERATORS)
+            left = rng.choice(VARIABLES) if rng.random() < 0.7 else str(random_literal(rng))
+            right = rng.choice(VARIABLES) if rng.random() < 0.7 else str(random_literal(rng, nonzero=op == "/"))
+            rhs = f"{left} {op} {right}"
+        lines.append(f"{lhs} = {rhs}")
+    return "\n".join(lines) + "\n"
+
+def run_wrapped_model(source: str, differences: set) -> tuple:
+    """
+    Evaluates a program with the VM's 32-bit semantics, adding to differences the reasons
+    for which any operation's result differs from the unbounded one
+    """
+    values = { var: 0 for var in VARIABLES }
+    for line in source.splitlines():
+        lhs, rhs = [part.strip() for part in line.split("=")]
+        tokens = rhs.split()
+        operand = lambda token: values[token] if token in values else to_signed_32(int(token))
+        if len(tokens) == 1:
+            values[lhs] = operand(tokens[0])
+            continue
+        x, op, y = operand(tokens[0]), tokens[1], operand(tokens[2])
+        if op == "/":
+            if y == 0:
+                differences.add("division by zero")
+                result = -1
+            else:
+                quotient = abs(x) // abs(y)
+                result = quotient if (x < 0) == (y < 0) else -quotient
+                if result != x // y:
+                    differences.add("division rounding")
+        else:
+            result = x + y if op == "+" else x - y if op == "-" else x * y
+        if to_signed_32(result) != result:
+            differences.add("32-bit wraparound")
+        values[lhs] = to_signed_32(result)
+    return tuple(values[var] for var in VARIABLES)
+
+class Engine:
+    """
+    One way of running a program: prepare turns the source into something runnable, and run returns (a, b, c)
+    """
+    def __init__(self, name, semantics, prepare, run):
+        self.name = name
+        self.semantics = semantics  # "unbounded" or "32-bit"
+        self.prepare = prepare
+        self.run = run
+        self.prepare_time = 0.0
+        self.run_time = 0.0
+        self.passed = 0
+        self.mismatches = []  # (program index, expected, got)
+
+def parse_mathlang(source):
+    parser = MathlangParser()
+    for line in source.splitlines():
+        parser.parse_line(line)
+    parser.validate()
+    return parser.code
+
+def run_mathlang(code):
+    interpreter = MathlangInterpreter()
+    interpreter.initialize_variables(code.variables)
+    interpreter.interpret_code(code)
+    return tuple(interpreter.variables[var] for var in VARIABLES)
+
+def parse_mathlang2(source):
+    parser = Mathlang2Parser()
+    for line in source.splitlines():
+        parser.parse_line(line)
+    parser.validate()
+    return parser.code
+
+def run_mathlang2(code):
+    interpreter = Mathlang2Interpreter()
+    interpreter.initialize_variables(code.variables)
+    interpreter.interpret_code(code)
+    return tuple(interpreter.variables[var] for var in VARIABLES)
+
+def run_mathlang2_compiled(compiled):
+    slots = compiled.run([0] * len(compiled.variable_list))
+    return tuple(slots[compiled.variable_list.index(var)] for var in VARIABLES)
+
+def compile_mathlangplusplus(source):
+    code = MathlangPlusPlusCode()
+    code.lines = parse_chunk(source)
+    return parse_mathlang2("\n".join(MathlangPlusPlusCompiler(code).compile()))
+
+def vm_engines(library_object) -> list:
+    # the compiled asm, linked against the library (assembled once up front, as a warm toolchain would)
+    def assemble(source):
+        return linker.link([library_object, linker.assemble_lines(compile_mathlang_asm(source))])
+
+    def load(program, fuse=False):
+        vm = VM(layout=MemoryLayout.for_program(program))
+        vm.load_program(program)
+        if fuse:
+            superinstructions.fuse_program(vm)
+        return vm
+
+    def finish(vm):
+        # print_state prints the variables and restores them into a0, a1 and a2
+        values = tuple(to_signed_32(vm.registers.read(reg)) for reg in ("a0", "a1", "a2"))
+        expected_output = "".join(f"Value in {var}: {value}\n" for var, value in zip(VARIABLES, values))
+        if "".join(vm.output_buffer) != expected_output:
+            raise ValueError(f"Printed {''.join(vm.output_buffer)!r} for {values}")
+        return values
+
+    def run_interpreted(vm):
+        vm.output_buffer = []
+        vm.call_function("main")
+        vm.run()
+        return finish(vm)
+
+    def prepare_native(source):
+        import x86_backend
+        vm = load(assemble(source))
+        return vm, x86_backend.NativeCode(vm)
+
+    def run_native(prepared):
+        vm, native_code = prepared
+        vm.output_buffer = []
+        vm.call_function("main")
+        native_code.run(vm)
+        return finish(vm)
+
+    def prepare_aot(source):
+        program = assemble(source)
+        module = types.ModuleType("aot_differential")
+        exec(compile(aot.translate_program(program), "<aot>", "exec"), module.__dict__)
+        vm = VM(layout=MemoryLayout.for_program(program, data_base=module.DATA_BASE))
+        vm.load_program(program, lazy=True)
+        return vm, module
+
+    def run_aot(prepared):
+        vm, module = prepared
+        vm.output_buffer = []
+        vm.call_function("main")
+        aot.run_module(module, vm)
+        return finish(vm)
+
+    engines = [
+        Engine("vm", "32-bit", lambda source: load(assemble(source)), run_interpreted),
+        Engine("vm --fuse", "32-bit", lambda source: load(assemble(source), fuse=True), run_interpreted),
+        Engine("vm aot", "32-bit", prepare_aot, run_aot),
+    ]
+    if platform.machine() in ("x86_64", "AMD64"):
+        engines.append(Engine("vm --native", "32-bit", prepare_native, run_native))
+    return engines
+
+def compile_mathlang_asm(source) -> list:
+    parser = MathlangParser()
+    for line in source.splitlines():
+        parser.parse_line(line)
+    parser.validate()
+    return MathlangCompiler(parser).compile(include_library=False)
+
+def all_engines() -> list:
+    library_object = linker.assemble_file(LIB_FILE)
+    return [
+        Engine("mathlang", "unbounded", parse_mathlang, run_mathlang),
+        Engine("mathlang2", "unbounded", parse_mathlang2, run_mathlang2),
+        Engine("mathlang2 --compiled", "unbounded", lambda source: compile_code(parse_mathlang2(source)), run_mathlang2_compiled),
+        Engine("mathlang++ -> mathlang2", "unbounded", compile_mathlangplusplus, run_mathlang2),
+    ] + vm_engines(library_object)
+
+def outcome(func, *args):
+    # the engine's result, or the name of the exception it raised (such as ZeroDivisionError)
+    try:
+        return func(*args)
+    except ZeroDivisionError:
+        return "ZeroDivisionError"  # the message differs between engines
+    except Exception as e:
+        return f"{type(e).__name__}: {e}"
+
+def run_differential(programs: int, statements: int, seed: int = 0) -> tuple:
+    """
+    Runs every engine on the same random programs.
+    Returns (the engines with their counters, known differences -> number of programs, the programs)
+    """
+    rng = random.Random(seed)
+    engines = all_engines()
+    known_differences = {}
+    sources = [random_program(rng, statements) for _ in range(programs)]
+    for index, source in enumerate(sources):
+        unbounded = outcome(run_mathlang, parse_mathlang(source))
+        differences = set()
+        wrapped = run_wrapped_model(source, differences)
+        for reason in differences:
+            known_differences[reason] = known_differences.get(reason, 0) + 1
+
+        for engine in engines:
+            expected = unbounded if engine.semantics == "unbounded" else wrapped
+            start = time.perf_counter()
+            prepared = outcome(engine.prepare, source)
+            middle = time.perf_counter()
+            got = prepared if isinstance(prepared, str) else outcome(engine.run, prepared)
+            end = time.perf_counter()
+            engine.prepare_time += middle - start
+            engine.run_time += end - middle
+            if got == expected:
+                engine.passed += 1
+            else:
+                engine.mismatches.append((index, expected, got))
+    return engines, known_differences, sources
+
+def print_report(engines, known_differences, sources):
+    programs = len(sources)
+    print(f"{'engine':<26}{'semantics':<11}{'passed':>8}{'prepare ms':>12}{'run ms':>10}{'total ms':>10}")
+    for engine in sorted(engines, key=lambda engine: engine.prepare_time + engine.run_time):
+        prepare_ms = 1000 * engine.prepare_time / programs
+        run_ms = 1000 * engine.run_time / programs
+        print(f"{engine.name:<26}{engine.semantics:<11}{engine.passed:>5}/{programs:<3}"
+              f"{prepare_ms:>11.3f}{run_ms:>10.3f}{prepare_ms + run_ms:>10.3f}")
+    print("(times are per program)")
+
+    if known_differences:
+        print("Programs where 32-bit results differ from unbounded ones (expected, not failures):")
+        for reason, count in sorted(known_differences.items()):
+            print(f"  {reason}: {count}")
+
+    for engine in engines:
+        for index, expected, got in engine.mismatches[:3]:
+            print(f"\nMISMATCH in {engine.name} on program {index}: expected {expected}, got {got}")
+            print(sources[index])
+
+
+if __name__ == "__main__":
+    import sys
+
+    args = sys.argv[1:]
+    seed = 0
+    if "--seed" in args:
+        idx = args.index("--seed")
+        if idx + 1 >= len(args):
+            print("--seed must be followed by a number")
+            sys.exit(1)
+        seed = int(args[idx + 1])
+        del args[idx:idx + 2]
+
+    if len(args) > 2:
+        print("Please enter the number of programs to generate, and the number of statements in each")
+        print("Usage: python3 -m benchmarks.differential [programs] [statements] [--seed N]")
+        sys.exit(1)
+
+    programs = int(args[0]) if len(args) > 0 else 100
+    statements = int(args[1]) if len(args) > 1 else 20
+    engines, known_differences, sources = run_differential(programs, statements, seed)
+    print_report(engines, known_differences, sources)
+    if any(engine.mismatches for engine in engines):
+        sys.exit(1)
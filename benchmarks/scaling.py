@@ -0,0 +1,220 @@
+# Scaling benchmarks for the front-end stages, on synthetic programs of growing size
+
+"""
+Each generator writes a program of a given number of lines, with its other dimensions
+(variables, expression depth, parenthesis nesting, labels, data size) set by its arguments.
+The runner times every front-end stage on programs of doubling size, and fits a power law
+time = k * size^slope to each stage by least squares on a log-log scale.
+A stage whose slope is clearly above 1 grows super-linearly, and is flagged: such hot spots
+(like a linear label lookup done once per instruction) only show up on programs far larger than the examples.
+"""
+
+import math
+import os
+import random
+import tempfile
+import time
+import parser as assembler
+from interpreter import VM, MemoryLayout
+from mathlang.parser import parse_file as parse_mathlang_file
+from mathlang2.parser import parse_file as parse_mathlang2_file
+from mathlangplusplus.lexer import lex_file, NewlineToken
+from mathlangplusplus.parser import Parser as MathlangPlusPlusParser, Code as MathlangPlusPlusCode
+from mathlangplusplus.expression_parser import UnresolvedNode, substitute_multiplication_division, substitute_addition_subtraction
+from mathlangplusplus.compiler import Compiler as MathlangPlusPlusCompiler
+
+SUPERLINEAR_SLOPE = 1.3  # some noise (and the garbage collector) pushes linear stages a little above 1
+REPEATS = 3  # each measurement is the fastest of this many runs
+
+# generators
+
+def generate_mathlang(rng: random.Random, lines: int) -> str:
+    output = []
+    for _ in range(lines):
+        left = rng.choice("abc") if rng.random() < 0.7 else str(rng.randint(0, 100))
+        right = rng.choice("abc") if rng.random() < 0.7 else str(rng.randint(1, 100))
+        output.append(f"{rng.choice('abc')} = {left} {rng.choice('+-*/')} {right}  # comment")
+    return "\n".join(output) + "\n"
+
+def generate_mathlang2(rng: random.Random, lines: int, variables: int) -> str:
+    # every variable is assigned once before any line may read it
+    names = [f"var_{i}" for i in range(variables)]
+    output = [f"{name} = {rng.randint(0, 100)}" for name in names]
+    for _ in range(lines - len(output)):
+        output.append(f"{rng.choice(names)} = {rng.choice(names)} {rng.choice('+-*/')} {rng.choice(names)}")
+    return "\n".join(output) + "\n"
+
+def random_expression(rng: random.Random, names: list, depth: int, nesting: int) -> str:
+    # a binary expression tree of the given depth, with up to nesting levels of parentheses around subexpressions
+    if depth == 0:
+        return rng.choice(names) if rng.random() < 0.7 else str(rng.randint(0, 100))
+    left = random_expression(rng, names, depth - 1, nesting)
+    right = random_expression(rng, names, depth - 1, max(nesting - 1, 0))
+    expression = f"{left} {rng.choice('+-*/')} {right}"
+    return f"({expression})" if nesting > 0 and rng.random() < 0.5 else expression
+
+def generate_mathlangplusplus(rng: random.Random, lines: int, variables: int, depth: int = 3, nesting: int = 2) -> str:
+    names = [f"var_{i}" for i in range(variables)]
+    output = [f"{name} = {rng.randint(0, 100)}" for name in names]
+    for _ in range(lines - len(output)):
+        output.append(f"{rng.choice(names)} = {random_expression(rng, names, depth, nesting)}")
+    return "\n".join(output) + "\n"
+
+def generate_asm(rng: random.Random, lines: int, labels: int, data_size: int) -> str:
+    # arithmetic and data addresses, with branches to named and numeric labels
+    data_labels = [f"data_{i}" for i in range(max(1, labels // 4))]
+    words_per_label = max(1, data_size // (4 * len(data_labels)))
+    output = [".data"]
+    for label in data_labels:
+        output.append(f"{label}:")
+        output.append("  .word " + ", ".join(str(rng.randint(0, 1000)) for _ in range(words_per_label)))
+
+    code_labels = [f"label_{i}" for i in range(labels)]
+    label_every = max(1, lines // max(1, labels))
+    output.append(".text")
+    output.append("main:")
+    for i in range(lines):
+        if i % label_every == 0 and i // label_every < labels:
+            output.append(f"{code_labels[i // label_every]}:")
+            output.append("0:")
+        kind = rng.random()
+        if kind < 0.5:
+            output.append(f"  addi a{rng.randint(0, 3)}, a{rng.randint(0, 3)}, {rng.randint(-100, 100)}")
+        elif kind < 0.7:
+            output.append(f"  add a{rng.randint(0, 3)}, a{rng.randint(0, 3)}, a{rng.randint(0, 3)}")
+        elif kind < 0.8:
+            output.append(f"  la a{rng.randint(0, 3)}, {rng.choice(data_labels)}")
+        elif kind < 0.9:
+            output.append(f"  beq a{rng.randint(0, 3)}, a{rng.randint(0, 3)}, {rng.choice(code_labels) if code_labels else '0f'}")
+        else:
+            output.append(f"  bne a{rng.randint(0, 3)}, zero, 0f")
+    output.append("0:")
+    output.append("  jalr zero, ra")
+    return "\n".join(output) + "\n"
+
+# stages, each of which is (name, setup(size, directory) -> input, run(input)); only run is timed
+
+def write_source(directory: str, name: str, source: str) -> str:
+    filename = os.path.join(directory, name)
+    with open(filename, "w") as f:
+        f.write(source)
+    return filename
+
+def mathlangplusplus_lines(tokens: list) -> list:
+    # the expression tokens of each statement, as Parser.parse_line splits them
+    lines = []
+    start = 0
+    for i, token in enumerate(tokens):
+        if isinstance(token, NewlineToken):
+            if i > start:
+                lines.append(tokens[start + 2:i])  # skip the variable and the assignment
+            start = i + 1
+    return lines
+
+def rewrite_expressions(nodes: list):
+    for node in nodes:
+        node.rewrite_depth_first(substitute_multiplication_division)
+        node.rewrite_depth_first(substitute_addition_subtraction)
+
+def mathlangplusplus_code(size, directory) -> MathlangPlusPlusCode:
+    parser = MathlangPlusPlusParser()
+    parser.parse_code(lex_file(mathlangplusplus_file(size, directory)))
+    return parser.code
+
+def mathlangplusplus_file(size, directory) -> str:
+    source = generate_mathlangplusplus(random.Random(size), size, variables=max(1, size // 10))
+    return write_source(directory, f"mathlangplusplus_{size}.txt", source)
+
+def asm_program(size, directory):
+    return assembler.parse_file(asm_file(size, directory))
+
+def asm_file(size, directory) -> str:
+    source = generate_asm(random.Random(size), size, labels=max(1, size // 8), data_size=size * 4)
+    return write_source(directory, f"asm_{size}.txt", source)
+
+def load_program(program, lazy):
+    vm = VM(layout=MemoryLayout.for_program(program))
+    vm.load_program(program, lazy=lazy)
+
+STAGES = [
+    ("mathlang parse_file",
+     lambda size, directory: write_source(directory, f"mathlang_{size}.txt", generate_mathlang(random.Random(size), size)),
+     parse_mathlang_file),
+    ("mathlang2 parse_file",
+     lambda size, directory: write_source(directory, f"mathlang2_{size}.txt",
+                                          generate_mathlang2(random.Random(size), size, variables=max(1, size // 10))),
+     parse_mathlang2_file),
+    ("mathlang++ lex_file", mathlangplusplus_file, lex_file),
+    ("mathlang++ Parser.parse_code",
+     lambda size, directory: lex_file(mathlangplusplus_file(size, directory)),
+     lambda tokens: MathlangPlusPlusParser().parse_code(tokens)),
+    ("mathlang++ parse_parentheses",
+     lambda size, directory: mathlangplusplus_lines(lex_file(mathlangplusplus_file(size, directory))),
+     lambda lines: [UnresolvedNode.parse_parentheses(line) for line in lines]),
+    ("mathlang++ expression rewrites",
+     lambda size, directory: [UnresolvedNode.parse_parentheses(line)
+                              for line in mathlangplusplus_lines(lex_file(mathlangplusplus_file(size, directory)))],
+     rewrite_expressions),
+    ("mathlang++ Compiler.compile", mathlangplusplus_code, lambda code: MathlangPlusPlusCompiler(code).compile()),
+    ("asm parser.parse_file", asm_file, assembler.parse_file),
+    ("VM.load_program", asm_program, lambda program: load_program(program, lazy=False)),
+    ("VM.load_program lazy", asm_program, lambda program: load_program(program, lazy=True)),
+]
+
+def measure(setup, run, size, directory) -> float:
+    # the fastest of REPEATS runs, each on a freshly set up input (some stages modify theirs)
+    best = math.inf
+    for _ in range(REPEATS):
+        stage_input = setup(size, directory)
+        start = time.perf_counter()
+        run(stage_input)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def fit_slope(sizes: list, times: list) -> float:
+    # least squares fit of log(time) = slope * log(size) + c
+    xs = [math.log(size) for size in sizes]
+    ys = [math.log(max(t, 1e-9)) for t in times]
+    mean_x = sum(xs) / len(xs)
+    mean_y = sum(ys) / len(ys)
+    variance = sum((x - mean_x) ** 2 for x in xs)
+    return sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / variance
+
+def run_scaling(sizes: list, stage_names=None) -> list:
+    """
+    Times every stage (or only those named) at every size.
+    Returns a list of (stage name, times in seconds, fitted slope)
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for name, setup, run in STAGES:
+            if stage_names and name not in stage_names:
+                continue
+            times = [measure(setup, run, size, directory) for size in sizes]
+            results.append((name, times, fit_slope(sizes, times)))
+    return results
+
+def print_report(sizes: list, results: list):
+    header = "".join(f"{size:>10}" for size in sizes)
+    print(f"{'stage (ms at each size)':<32}{header}{'slope':>8}")
+    for name, times, slope in results:
+        row = "".join(f"{1000 * t:>10.2f}" for t in times)
+        flag = "  SUPER-LINEAR" if slope > SUPERLINEAR_SLOPE else ""
+        print(f"{name:<32}{row}{slope:>8.2f}{flag}")
+
+
+if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) > 3:
+        print("Please enter the smallest program size (in lines), and how many times to double it")
+        print("Usage: python3 -m benchmarks.scaling [smallest_size] [doublings]")
+        sys.exit(1)
+
+    smallest_size = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    doublings = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    sizes = [smallest_size * 2 ** i for i in range(doublings + 1)]
+    results = run_scaling(sizes)
+    print_report(sizes, results)
+    if any(slope > SUPERLINEAR_SLOPE for _, _, slope in results):
+        sys.exit(1)
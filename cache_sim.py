@@ -0,0 +1,204 @@
+# Simulates a cache hierarchy in front of the VM's memory, to see how a program would use real caches
+
+"""
+attach() re-decodes every load and store of a loaded program so that it reports its address to a MemoryHierarchy
+(the atomic instructions are observed through the VM's load_word and store_word instead).
+Nothing else changes, so a VM without the model attached runs exactly as fast as before.
+Attach it to a program which is not fused, since a superinstruction runs its loads and stores directly.
+
+Every level is a set-associative cache with LRU replacement, which allocates lines on both reads and writes.
+An access missing every level goes to memory. Hits are counted per instruction, and summed up per function.
+"""
+
+import json
+from collections import OrderedDict
+from interpreter import VM, OPCODES, FORMAT_DECODERS
+from linker import LOCAL_LABEL_PATTERN
+
+# small by real standards, since the VM's whole memory is usually only a few KiB
+DEFAULT_LEVELS = [
+    { "name": "L1", "size": 256, "associativity": 2, "line_size": 16 },
+    { "name": "L2", "size": 2048, "associativity": 4, "line_size": 32 },
+]
+
+class Cache:
+    def __init__(self, name, size, associativity, line_size):
+        if line_size <= 0 or line_size & (line_size - 1):
+            raise ValueError(f"{name}: line size must be a power of two, not {line_size}")
+        if associativity <= 0:
+            raise ValueError(f"{name}: associativity must be positive, not {associativity}")
+        if size <= 0 or size % (associativity * line_size) != 0:
+            raise ValueError(f"{name}: size {size} is not a positive multiple of associativity * line size")
+        self.name = name
+        self.size = size
+        self.associativity = associativity
+        self.line_size = line_size
+        self.num_sets = size // (associativity * line_size)
+        self.sets = [OrderedDict() for _ in range(self.num_sets)]  # line number -> None, least recently used first
+        self.hits = 0
+        self.misses = 0
+
+    def access(self, address) -> bool:
+        # returns whether the line was cached, caching it either way
+        line = address // self.line_size
+        cache_set = self.sets[line % self.num_sets]
+        if line in cache_set:
+            cache_set.move_to_end(line)
+            self.hits += 1
+            return True
+        self.misses += 1
+        if len(cache_set) >= self.associativity:
+            cache_set.popitem(last=False)  # evict the least recently used line
+        cache_set[line] = None
+        return False
+
+    def __repr__(self):
+        return f"Cache({self.name}, {self.size}B, {self.associativity}-way, {self.line_size}B lines)"
+
+class AccessCounts:
+    def __init__(self, num_levels):
+        self.accesses = 0
+        self.hits = [0] * num_levels  # hits at each level, the rest went to memory
+
+    def add(self, other):
+        self.accesses += other.accesses
+        for level, hits in enumerate(other.hits):
+            self.hits[level] += hits
+
+class MemoryHierarchy:
+    def __init__(self, levels=DEFAULT_LEVELS):
+        self.levels = [Cache(**level) for level in levels]
+        self.per_instruction = {}  # code index -> AccessCounts
+
+    @classmethod
+    def from_config(cls, config: list):
+        # e.g. [{ "name": "L1", "size": 32768, "associativity": 8, "line_size": 64 }, ...], closest to the VM first
+        return cls(config)
+
+    def access(self, pc, address):
+        counts = self.per_instruction.get(pc)
+        if counts is None:
+            counts = self.per_instruction[pc] = AccessCounts(len(self.levels))
+        counts.accesses += 1
+        for level, cache in enumerate(self.levels):
+            if cache.access(address):
+                counts.hits[level] += 1
+                return
+        # missed every level, so the line came from memory (and is now cached at every level)
+
+    def per_function(self, program) -> dict:
+        # sums the counts of each function, which runs from one global label to the next
+        functions = {}
+        function = "<start>"
+        counts_by_index = self.per_instruction
+        for idx, labels in enumerate(program.code_labels[:len(program.code)]):
+            for label in labels:
+                if not LOCAL_LABEL_PATTERN.match(label):
+                    function = label
+                    break
+            if idx in counts_by_index:
+                functions.setdefault(function, AccessCounts(len(self.levels))).add(counts_by_index[idx])
+        return functions
+
+def observe(hierarchy, method):
+    # wraps a VM memory method, reporting each address to the hierarchy before accessing it
+    def observed(vm, address, *value):
+        hierarchy.access(vm.program_counter, address)
+        return method(vm, address, *value)
+    return observed
+
+def attach(vm: VM, hierarchy: MemoryHierarchy):
+    """
+    Makes every memory access of the program loaded in the VM go through the hierarchy
+    """
+    for idx, (instr, args) in enumerate(vm.program.code):
+        spec = OPCODES.get(instr)
+        if spec is not None and spec.fmt in ("load", "store"):
+            vm.code[idx] = FORMAT_DECODERS[spec.fmt](vm, idx, args, observe(hierarchy, spec.semantics))
+    # the atomic instructions call these directly, and the instance attributes shadow the methods
+    vm.load_word = observe(hierarchy, VM.load_word).__get__(vm)
+    vm.store_word = observe(hierarchy, VM.store_word).__get__(vm)
+
+def format_counts(hierarchy, counts) -> str:
+    parts = [f"{counts.accesses} accesses"]
+    for cache, hits in zip(hierarchy.levels, counts.hits):
+        parts.append(f"{cache.name} {100 * hits / counts.accesses:.1f}%")
+    return ", ".join(parts)
+
+def print_report(hierarchy: MemoryHierarchy, program, top_instructions=10):
+    print("Cache hierarchy:")
+    for cache in hierarchy.levels:
+        total = cache.hits + cache.misses
+        hit_rate = 100 * cache.hits / total if total else 0.0
+        print(f"  {cache}: {cache.hits} hits, {cache.misses} misses ({hit_rate:.1f}% hit rate)")
+
+    print("Per function (share of accesses hitting each level):")
+    functions = hierarchy.per_function(program)
+    for function, counts in sorted(functions.items(), key=lambda item: -item[1].accesses):
+        print(f"  {function}: {format_counts(hierarchy, counts)}")
+
+    print("Busiest memory instructions:")
+    busiest = sorted(hierarchy.per_instruction.items(), key=lambda item: -item[1].accesses)[:top_instructions]
+    for idx, counts in busiest:
+        instr, args = program.code[idx]
+        print(f"  {idx}: {instr} {', '.join(args)}: {format_counts(hierarchy, counts)}")
+
+
+if __name__ == "__main__":
+    import sys
+    import io
+    import contextlib
+    import parser
+    from interpreter import MemoryLayout
+
+    args = sys.argv[1:]
+    def pop_option_values(flag):
+        # removes every "<flag> <value>" pair from the arguments, returning the values
+        values = []
+        while flag in args:
+            idx = args.index(flag)
+            if idx + 1 >= len(args):
+                print(f"{flag} must be followed by a file name")
+                sys.exit(1)
+            values.append(args[idx + 1])
+            del args[idx:idx + 2]
+        return values
+
+    link_filenames = pop_option_values("--link")
+    # --config <file> names a JSON list of cache levels, otherwise DEFAULT_LEVELS is used
+    config_filenames = pop_option_values("--config")
+
+    if len(args) < 1:
+        print("Please enter the name of the asm file to simulate")
+        print(f"Usage: python3 {sys.argv[0]} <asm_file> [function] [--link <file>] [--config <file>]")
+        sys.exit(1)
+
+    if link_filenames:
+        import linker
+        objects = [linker.load_object_or_asm(name) for name in link_filenames]
+        program = linker.link(objects + [linker.assemble_file(args[0])])
+    else:
+        program = parser.parse_file(args[0])
+
+    if config_filenames:
+        try:
+            with open(config_filenames[-1], "r") as f:
+                hierarchy = MemoryHierarchy.from_config(json.load(f))
+        except (ValueError, TypeError) as e:
+            # a TypeError means a level is missing a key (or has an unknown one), or is not an object at all
+            print(f"Invalid cache configuration in {config_filenames[-1]}: {e}")
+            print('Each level needs a name, size, associativity and line_size, e.g. '
+                  '{ "name": "L1", "size": 32768, "associativity": 8, "line_size": 64 }')
+            print(f"Usage: python3 {sys.argv[0]} <asm_file> [function] [--link <file>] [--config <file>]")
+            sys.exit(1)
+    else:
+        hierarchy = MemoryHierarchy()
+
+    vm = VM(layout=MemoryLayout.for_program(program))
+    vm.load_program(program)
+    attach(vm, hierarchy)
+    vm.call_function(args[1] if len(args) > 1 else "main")
+    with contextlib.redirect_stdout(io.StringIO()):  # only the report is of interest
+        vm.run()
+    print(f"Ran {vm.step_count} instructions")
+    print_report(hierarchy, program)
@@ -1,5 +1,7 @@
 import array
+import contextlib
 import re
+import time
 import parser
 from parser import Parser
 
@@ -25,11 +27,62 @@ def to_signed_8(n):
 def trunc_divmod(a, b):
     q = int(a / b)
     r = a - b * q
-    return (q, r)
+    return q, r
 
 # The VM has only these general-purpose registers
 REGISTERS = [ "zero", "sp", "a0", "a1", "a2", "a3" ]
 
+DEFAULT_MEM_SIZE = 1024
+DEFAULT_DATA_BASE = 256  # data segment starts at address 256
+DEFAULT_STACK_SIZE = 256  # bytes below the stack top which data may not occupy
+STACK_TOP_GAP = 16  # the stack pointer starts this far below the top of memory
+MEM_SIZE_GRANULE = 1024  # derived memory sizes are rounded up to this
+
+class MemoryLayout:
+    """
+    Where each segment of a program lives in guest memory:
+    the data segment grows up from data_base, and the stack grows down from stack_top
+    """
+    def __init__(self, mem_size=DEFAULT_MEM_SIZE, data_base=DEFAULT_DATA_BASE,
+                 stack_top=None, stack_size=DEFAULT_STACK_SIZE):
+        self.mem_size = mem_size
+        self.data_base = data_base
+        self.stack_top = mem_size - STACK_TOP_GAP if stack_top is None else stack_top
+        self.stack_size = stack_size
+        if not 0 <= self.data_base <= self.mem_size:
+            raise ValueError(f"Data segment base {hex(self.data_base)} is outside memory")
+        if self.stack_top - self.stack_size < 0 or self.stack_top > self.mem_size:
+            raise ValueError(f"Stack [{hex(self.stack_top - self.stack_size)}, {hex(self.stack_top)}) does not fit in memory")
+
+    def check_data_fits(self, data_size):
+        # the data segment may neither run off the end of memory nor into the stack
+        data_end = self.data_base + data_size
+        if data_end > self.mem_size:
+            raise ValueError(f"Data segment ({data_size} bytes) does not fit in {self.mem_size} bytes of memory")
+        if self.data_base < self.stack_top and data_end > self.stack_top - self.stack_size:
+            raise ValueError(f"Data segment [{hex(self.data_base)}, {hex(data_end)}) collides with the stack "
+                             f"[{hex(self.stack_top - self.stack_size)}, {hex(self.stack_top)})")
+
+    @classmethod
+    def for_program(cls, program: Parser, min_mem_size=DEFAULT_MEM_SIZE,
+                    data_base=DEFAULT_DATA_BASE, stack_size=DEFAULT_STACK_SIZE):
+        # the smallest memory holding the program's data segment with a whole stack above it
+        needed = data_base + len(program.data) + stack_size + STACK_TOP_GAP
+        mem_size = max(min_mem_size, -(-needed // MEM_SIZE_GRANULE) * MEM_SIZE_GRANULE)
+        return cls(mem_size, data_base, stack_size=stack_size)
+
+    @classmethod
+    def from_config(cls, config: dict):
+        # linker-style configuration, e.g. { "mem_size": 65536, "data_base": 4096, "stack_size": 4096 }
+        unknown = set(config) - { "mem_size", "data_base", "stack_top", "stack_size" }
+        if unknown:
+            raise ValueError(f"Unknown memory layout settings: {', '.join(sorted(unknown))}")
+        return cls(**config)
+
+    def __repr__(self):
+        return (f"MemoryLayout(mem_size={self.mem_size}, data_base={hex(self.data_base)}, "
+                f"stack_top={hex(self.stack_top)}, stack_size={self.stack_size})")
+
 class RegisterFile:
     def __init__(self):
         self.regs = { reg: 0 for reg in REGISTERS }
@@ -42,16 +95,38 @@ class RegisterFile:
             self.regs[reg] = val & MASK_32
 
 class VM:
-    def __init__(self, mem_size = 1024):
+    def __init__(self, mem_size = DEFAULT_MEM_SIZE, layout: MemoryLayout = None):
+        self.layout = MemoryLayout(mem_size) if layout is None else layout
         self.registers = RegisterFile()
-        self.memory = array.array('B', [0] * mem_size)
-        self.registers.write("sp", mem_size - 16)  # Initialize stack pointer
+        self.memory = array.array('B', bytes(self.layout.mem_size))
+        self.registers.write("sp", self.layout.stack_top)  # Initialize stack pointer
         self.code = None
         self.program_counter = 0xFFFFFFFF  # invalid initial PC
         self.label_locator = None  # function to locate labels
+        self.data_labels = None  # data label -> address
+        self.program = None  # the loaded Parser, which lazily decoded instructions are read from
+        self.input_buffer = b""  # bytes which readc consumes
+        self.input_position = 0
+        self.output_buffer = None  # if a list, printc appends to it instead of printing
+        self.step_count = 0  # instructions executed by run, which the counter instructions read
+        self.running = False  # whether run is executing, holding the latest instruction count in a local
+        self.hart_id = 0  # which hart this is, when several share one memory (see multihart.py)
+        self.atomic_lock = contextlib.nullcontext()  # held by atomic instructions, a real lock once memory is shared
+        self.reservation = None  # (address, value) of the last lr.w, until the next sc.w
 
     def print_char(self, data):
-        print(chr(data & MASK_8), end='')
+        if self.output_buffer is not None:
+            self.output_buffer.append(chr(data & MASK_8))
+        else:
+            print(chr(data & MASK_8), end='')
+
+    def read_char(self):
+        # the next input byte, or 0xFFFFFFFF (-1) once the input is exhausted
+        if self.input_position >= len(self.input_buffer):
+            return 0xFFFFFFFF
+        data = self.input_buffer[self.input_position]
+        self.input_position += 1
+        return data
 
     def load_word(self, address):
         if address % 4 != 0:
@@ -102,17 +177,27 @@ class VM:
     def store_byte(self, address, value):
         self.memory[address] = value & MASK_8
 
-    def load_program(self, parse_result: Parser):
-        data_start = 256  # data segment starts at address 256
+    def load_program(self, parse_result: Parser, lazy=False, copy_data=True):
+        # with lazy=True, instructions are only decoded when they first run,
+        # so errors such as unknown instructions or labels surface at that point instead.
+        # with copy_data=False, the data segment must already be in memory (such as memory shared with other harts)
+        data_start = self.layout.data_base
+        data = parse_result.data
+        self.layout.check_data_fits(len(data))
 
         data_labels = {}
-        # Load data segment
-        for i, byte in enumerate(parse_result.data):
-            self.store_byte(data_start + i, byte)
+        # Load data segment, copying the whole image at once
+        if copy_data:
+            memoryview(self.memory)[data_start:data_start + len(data)] = data if isinstance(data, (bytes, bytearray)) else bytes(data)
         
         for label_idx, labels in enumerate(parse_result.data_labels):
             for label in labels:
                 data_labels[label] = data_start + label_idx
+        code_label_indices = {}  # named label -> index of its first occurrence
+        for idx, labels in enumerate(parse_result.code_labels):
+            for label in labels:
+                code_label_indices.setdefault(label, idx)
+
         def find_code_label(label, from_idx=None):
             # for int labels such as 0f or 0b, find the nearest matching label
             if re.match(r'^\d+$', label):
@@ -132,128 +217,34 @@ class VM:
                             return idx
                 raise ValueError(f"Label {label} not found")
             else:
-                for idx, labels in enumerate(parse_result.code_labels):
-                    if label in labels:
-                        return idx
-                raise ValueError(f"Label {label} not found")
-        
-        def label_locator_with(from_idx):
-            def locator(label):
-                return find_code_label(label, from_idx)
-            return locator
+                if label not in code_label_indices:
+                    raise ValueError(f"Label {label} not found")
+                return code_label_indices[label]
         
         self.label_locator = find_code_label
+        self.data_labels = data_labels
 
         # Load code (separate memory)
-        self.code = []
-        for i, (instr, args) in enumerate(parse_result.code):
-            # For simplicity, we will just store a lambda for each instruction
-            # In a real VM, you would convert instructions to binary opcodes
-            # Each instruction would be a function that takes the VM as an argument
-            # https://www.cs.sfu.ca/~ashriram/Courses/CS295/assets/notebooks/RISCV/RISCV_CARD.pdf
-            if instr == "nop":
-                self.code.append(advance_pc)
-            elif instr == "printc":
-                self.code.append(make_printc(args))
-            elif instr == "lw":
-                self.code.append(make_load(args, VM.load_word))
-            elif instr == "sw":
-                self.code.append(make_store(args, VM.store_word))
-            elif instr == "lh":
-                self.code.append(make_load(args, VM.load_half))
-            elif instr == "lhu":
-                self.code.append(make_load(args, VM.load_half_unsigned))
-            elif instr == "sh":
-                self.code.append(make_store(args, VM.store_half))
-            elif instr == "lb":
-                self.code.append(make_load(args, VM.load_byte))
-            elif instr == "lbu":
-                self.code.append(make_load(args, VM.load_byte_unsigned))
-            elif instr == "sb":
-                self.code.append(make_store(args, VM.store_byte))
-            elif instr == "la":
-                self.code.append(make_load_addr(args, data_labels))
-            elif instr == "add":
-                self.code.append(make_binary_op(args, lambda x, y: x + y))
-            elif instr == "addi":
-                self.code.append(make_binary_opi(args, lambda x, y: x + y))
-            elif instr == "sub":
-                self.code.append(make_binary_op(args, lambda x, y: to_signed_32(x) - to_signed_32(y)))
-            elif instr == "subi":
-                self.code.append(make_binary_opi(args, lambda x, y: to_signed_32(x) - to_signed_32(y)))
-            elif instr == "and":
-                self.code.append(make_binary_op(args, lambda x, y: x & y))
-            elif instr == "andi":
-                self.code.append(make_binary_opi(args, lambda x, y: x & y))
-            elif instr == "or":
-                self.code.append(make_binary_op(args, lambda x, y: x | y))
-            elif instr == "ori":
-                self.code.append(make_binary_opi(args, lambda x, y: x | y))
-            elif instr == "xor":
-                if args == ["zero", "zero", "zero"]:
-                    def debug_insn(vm):
-                        print("\n--- DEBUG INSN HIT ---")
-                        vm.dump_state()
-                        print("----------------------\n")
-                        advance_pc(vm)
-                    # special case: xor zero, zero, zero is a debug insn
-                    self.code.append(debug_insn)
-                else:
-                    self.code.append(make_binary_op(args, lambda x, y: x ^ y))
-            elif instr == "xori":
-                self.code.append(make_binary_opi(args, lambda x, y: x ^ y))
-            elif instr == "sll":
-                self.code.append(make_binary_op(args, lambda x, y: (x << y) & MASK_32))
-            elif instr == "slli":
-                self.code.append(make_binary_opi(args, lambda x, y: (x << y) & MASK_32))
-            elif instr == "srl":
-                self.code.append(make_binary_op(args, lambda x, y: (x & MASK_32) >> y))
-            elif instr == "srli":
-                self.code.append(make_binary_opi(args, lambda x, y: (x & MASK_32) >> y))
-            elif instr == "sra":
-                self.code.append(make_binary_op(args, lambda x, y: to_signed_32(x) >> y))
-            elif instr == "srai":
-                self.code.append(make_binary_opi(args, lambda x, y: to_signed_32(x) >> y))
-            elif instr == "slt":
-                self.code.append(make_binary_op(args, lambda x, y: 1 if to_signed_32(x) < to_signed_32(y) else 0))
-            elif instr == "slti":
-                self.code.append(make_binary_opi(args, lambda x, y: 1 if to_signed_32(x) < to_signed_32(y) else 0))
-            elif instr == "sltu":
-                self.code.append(make_binary_op(args, lambda x, y: 1 if (x & MASK_32) < (y & MASK_32) else 0))
-            elif instr == "sltui":
-                self.code.append(make_binary_opi(args, lambda x, y: 1 if (x & MASK_32) < (y & MASK_32) else 0))
-            elif instr == "beq":
-                self.code.append(make_branch_op(args, label_locator_with(i), lambda x, y: x == y))
-            elif instr == "bne":
-                self.code.append(make_branch_op(args, label_locator_with(i), lambda x, y: x != y))
-            elif instr == "blt":
-                self.code.append(make_branch_op(args, label_locator_with(i), lambda x, y: to_signed_32(x) < to_signed_32(y)))
-            elif instr == "bge":
-                self.code.append(make_branch_op(args, label_locator_with(i), lambda x, y: to_signed_32(x) >= to_signed_32(y)))
-            elif instr == "bltu":
-                self.code.append(make_branch_op(args, label_locator_with(i), lambda x, y: (x & MASK_32) < (y & MASK_32)))
-            elif instr == "bgeu":
-                self.code.append(make_branch_op(args, label_locator_with(i), lambda x, y: (x & MASK_32) >= (y & MASK_32)))
-            elif instr == "jalr":
-                self.code.append(make_jalr(args))
-            elif instr == "jal":
-                self.code.append(make_jal(args, label_locator_with(i)))
-            elif instr == "mul":
-                self.code.append(make_binary_op(args, lambda x, y: to_signed_32(x) * to_signed_32(y)))
-            elif instr == "mulh":
-                self.code.append(make_binary_op(args, lambda x, y: (to_signed_32(x) * to_signed_32(y)) >> 32))
-            elif instr == "mulhu":
-                self.code.append(make_binary_op(args, lambda x, y: ((x & MASK_32) * (y & MASK_32)) >> 32))
-            elif instr == "div":
-                self.code.append(make_binary_op(args, lambda x, y: trunc_divmod(to_signed_32(x), to_signed_32(y))[0] if y != 0 else 0xFFFFFFFF))
-            elif instr == "divu":
-                self.code.append(make_binary_op(args, lambda x, y: (x & MASK_32) // (y & MASK_32) if y != 0 else 0xFFFFFFFF))
-            elif instr == "rem":
-                self.code.append(make_binary_op(args, lambda x, y: trunc_divmod(to_signed_32(x), to_signed_32(y))[1] if y != 0 else 0xFFFFFFFF))
-            elif instr == "remu":
-                self.code.append(make_binary_op(args, lambda x, y: (x & MASK_32) % (y & MASK_32) if y != 0 else 0xFFFFFFFF))
-            else:
-                raise ValueError(f"Unknown instruction: {instr}")
+        self.program = parse_result
+        if lazy:
+            # every slot starts as the same stub, which decodes its instruction the first time it runs,
+            # so code which never executes is never decoded
+            self.code = [decode_on_first_use] * len(parse_result.code)
+        else:
+            self.code = [self.decode_instruction(i, instr, args) for i, (instr, args) in enumerate(parse_result.code)]
+
+    def decode_instruction(self, i, instr, args):
+        # For simplicity, we will just store a closure for each instruction
+        # In a real VM, you would convert instructions to binary opcodes
+        # Each instruction would be a function that takes the VM as an argument
+        # https://www.cs.sfu.ca/~ashriram/Courses/CS295/assets/notebooks/RISCV/RISCV_CARD.pdf
+        if instr == "xor" and args == ["zero", "zero", "zero"]:
+            # special case: xor zero, zero, zero is a debug insn
+            return debug_insn
+        spec = OPCODES.get(instr)
+        if spec is None:
+            raise ValueError(f"Unknown instruction: {instr}")
+        return spec.decode(self, i, args)
 
     def interpret_step(self) -> bool:
         # Returns whether is halted
@@ -271,6 +262,89 @@ class VM:
         instr(self)  # execute instruction
         return False  # not halted
     
+    class CounterSync(Exception):
+        # hands control back to run, so it writes the step count back before a counter is read
+        pass
+
+    def run(self, max_steps=None) -> bool:
+        # runs until halted (returning True), or until max_steps instructions have run (returning False).
+        # the count of instructions run is kept in a local (one increment per instruction), and only written back
+        # to step_count when the loop exits, or when a counter instruction asks for it by raising CounterSync.
+        # the loop dispatches directly rather than through interpret_step, which saves more than the increment costs
+        if max_steps is not None:
+            return self.run_bounded(max_steps)
+        steps = 0
+        code = self.code
+        if code is None:
+            raise ValueError("No program loaded")
+        self.running = True
+        try:
+            while True:
+                try:
+                    while True:
+                        pc = self.program_counter
+                        if pc == 0xFFFFFFFF:
+                            return True  # halted
+                        if pc < 0 or pc >= len(code):
+                            raise ValueError("Program counter out of bounds")
+                        code[pc](self)
+                        steps += 1
+                except self.CounterSync:
+                    steps = self.sync_counters(steps)
+        finally:
+            self.running = False
+            self.step_count += steps
+
+    def run_bounded(self, max_steps) -> bool:
+        # a superinstruction (see superinstructions.py) runs its whole length in one dispatch, and counts the rest itself;
+        # where it would run past max_steps, only its first instruction runs, so the limit is never overshot
+        steps = 0
+        remaining = max_steps
+        code = self.code
+        if code is None:
+            raise ValueError("No program loaded")
+        self.running = True
+        try:
+            while True:
+                try:
+                    while remaining > 0:
+                        pc = self.program_counter
+                        if pc == 0xFFFFFFFF:
+                            return True  # halted
+                        if pc < 0 or pc >= len(code):
+                            raise ValueError("Program counter out of bounds")
+                        instr = code[pc]
+                        length = getattr(instr, "length", 1)
+                        if length > remaining:
+                            instr = instr.single
+                            length = 1
+                        instr(self)
+                        steps += 1
+                        remaining -= length
+                    return False
+                except self.CounterSync:
+                    steps = self.sync_counters(steps)
+                    remaining -= 1
+        finally:
+            self.running = False
+            self.step_count += steps
+
+    def sync_counters(self, steps) -> int:
+        # writes back the steps counted by run, and runs the counter instruction which asked for them.
+        # returns the steps run since (just that instruction)
+        self.step_count += steps
+        self.running = False
+        try:
+            self.interpret_step()  # the counter instruction again, which can now read step_count
+        finally:
+            self.running = True
+        return 1
+
+    def instructions_retired(self):
+        if self.running:
+            raise self.CounterSync()
+        return self.step_count
+
     def call_function(self, function_label):
         # sets the VM to call a function at addr
         # should only be called when halted
@@ -291,6 +365,21 @@ class VM:
 def advance_pc(vm):
     vm.program_counter += 1
 
+def decode_on_first_use(vm):
+    # stub for a code slot which has not been decoded yet (the one being executed):
+    # decode it, replace the stub so later executions skip this, and run it
+    idx = vm.program_counter
+    instr, args = vm.program.code[idx]
+    decoded = vm.decode_instruction(idx, instr, args)
+    vm.code[idx] = decoded
+    decoded(vm)
+
+def debug_insn(vm):
+    print("\n--- DEBUG INSN HIT ---")
+    vm.dump_state()
+    print("----------------------\n")
+    advance_pc(vm)
+
 def make_printc(args):
     dest_reg = args[0]
     def printc_instr(vm):
@@ -298,15 +387,27 @@ def make_printc(args):
         advance_pc(vm)
     return printc_instr
 
+ADDRESS_REGEX = re.compile(r'(-?\d+)\((\w+)\)')
+
+def parse_address(operand, instr_name):
+    # example: 4(a3) -> (4, "a3")
+    match = ADDRESS_REGEX.match(operand)
+    if not match:
+        raise ValueError(f"Invalid address format for {instr_name}")
+    return int(match.group(1), 0), match.group(2)
+
+def make_readc(args):
+    # example: readc a0
+    dest_reg = args[0]
+    def readc_instr(vm):
+        vm.registers.write(dest_reg, vm.read_char())
+        advance_pc(vm)
+    return readc_instr
+
 def make_load(args, method_handle):
     # example: lw a1, 4(a3)
     dest_reg = args[0]
-    pattern = r'(-?\d+)\((\w+)\)'
-    match = re.match(pattern, args[1])
-    if not match:
-        raise ValueError("Invalid address format for lw")
-    offset = int(match.group(1), 0)
-    base_reg = match.group(2)
+    offset, base_reg = parse_address(args[1], "lw")
     def load_instr(vm):
         addr = (vm.registers.read(base_reg) + offset) & MASK_32
         val = method_handle(vm, addr) & MASK_32
@@ -316,12 +417,7 @@ def make_load(args, method_handle):
 
 def make_store(args, method_handle):
     # example: sw 0(sp), a0
-    pattern = r'(-?\d+)\((\w+)\)'
-    match = re.match(pattern, args[0])
-    if not match:
-        raise ValueError("Invalid address format for sw")
-    offset = int(match.group(1), 0)
-    base_reg = match.group(2)
+    offset, base_reg = parse_address(args[0], "sw")
     src_reg = args[1]
     def store_instr(vm):
         addr = (vm.registers.read(base_reg) + offset) & MASK_32
@@ -330,6 +426,61 @@ def make_store(args, method_handle):
         advance_pc(vm)
     return store_instr
 
+def make_csr_read(args, read_func):
+    # example: hartid a0
+    dest_reg = args[0]
+    def csr_read_instr(vm):
+        vm.registers.write(dest_reg, read_func(vm))
+        advance_pc(vm)
+    return csr_read_instr
+
+def make_amo(args, op_func):
+    # example: amoadd.w a0, a1, 0(a2), which sets a0 to the old word
+    dest_reg = args[0]
+    src_reg = args[1]
+    offset, base_reg = parse_address(args[2], "amo")
+    def amo_instr(vm):
+        addr = (vm.registers.read(base_reg) + offset) & MASK_32
+        val = vm.registers.read(src_reg)
+        with vm.atomic_lock:
+            old = vm.load_word(addr)
+            vm.store_word(addr, op_func(old, val))
+        vm.registers.write(dest_reg, old)
+        advance_pc(vm)
+    return amo_instr
+
+def make_load_reserved(args):
+    # example: lr.w a0, 0(a1)
+    dest_reg = args[0]
+    offset, base_reg = parse_address(args[1], "lr.w")
+    def load_reserved_instr(vm):
+        addr = (vm.registers.read(base_reg) + offset) & MASK_32
+        with vm.atomic_lock:
+            val = vm.load_word(addr)
+        vm.reservation = (addr, val)
+        vm.registers.write(dest_reg, val)
+        advance_pc(vm)
+    return load_reserved_instr
+
+def make_store_conditional(args):
+    # example: sc.w a0, a2, 0(a1), which sets a0 to 0 if the store happened and 1 otherwise.
+    # the reservation holds if the word still has the value lr.w read (so, unlike hardware, an A-B-A change goes unnoticed)
+    dest_reg = args[0]
+    src_reg = args[1]
+    offset, base_reg = parse_address(args[2], "sc.w")
+    def store_conditional_instr(vm):
+        addr = (vm.registers.read(base_reg) + offset) & MASK_32
+        val = vm.registers.read(src_reg)
+        failed = 1
+        with vm.atomic_lock:
+            if vm.reservation is not None and vm.reservation[0] == addr and vm.load_word(addr) == vm.reservation[1]:
+                vm.store_word(addr, val)
+                failed = 0
+        vm.reservation = None
+        vm.registers.write(dest_reg, failed)
+        advance_pc(vm)
+    return store_conditional_instr
+
 def make_load_addr(args, data_labels):
     # example: la a0, my_label
     dest_reg = args[0]
@@ -399,20 +550,195 @@ def make_jal(args, find_label_func):
         vm.program_counter = target
     return jal_instr
 
+class OpcodeSpec:
+    """
+    Everything the VM knows about one mnemonic: its operand format (which picks the make_* decoder),
+    its semantic function, and flags describing its effects for analysis passes
+    """
+    def __init__(self, mnemonic, fmt, semantics=None, is_branch=False, reads_memory=False, writes_memory=False):
+        if fmt not in FORMAT_DECODERS:
+            raise ValueError(f"Unknown operand format: {fmt}")
+        self.mnemonic = mnemonic
+        self.fmt = fmt
+        self.semantics = semantics  # op_func, condition_func or memory method, depending on the format
+        self.is_branch = is_branch  # may set the program counter to something other than the next instruction
+        self.reads_memory = reads_memory
+        self.writes_memory = writes_memory
+
+    def decode(self, vm, idx, args):
+        return FORMAT_DECODERS[self.fmt](vm, idx, args, self.semantics)
+
+    def __repr__(self):
+        return f"OpcodeSpec({self.mnemonic}, {self.fmt})"
+
+def code_label_locator(vm, idx):
+    def locator(label):
+        return vm.label_locator(label, idx)
+    return locator
+
+# operand format -> decoder(vm, instruction index, args, semantics), returning the instruction's closure
+FORMAT_DECODERS = {
+    "none": lambda vm, idx, args, semantics: advance_pc,  # nop
+    "printc": lambda vm, idx, args, semantics: make_printc(args),  # printc rs
+    "readc": lambda vm, idx, args, semantics: make_readc(args),  # readc rd
+    "load": lambda vm, idx, args, semantics: make_load(args, semantics),  # lw rd, offset(rs)
+    "store": lambda vm, idx, args, semantics: make_store(args, semantics),  # sw offset(rs), rs2
+    "la": lambda vm, idx, args, semantics: make_load_addr(args, vm.data_labels),  # la rd, label
+    "csr": lambda vm, idx, args, semantics: make_csr_read(args, semantics),  # hartid rd
+    "amo": lambda vm, idx, args, semantics: make_amo(args, semantics),  # amoadd.w rd, rs2, offset(rs1)
+    "lr": lambda vm, idx, args, semantics: make_load_reserved(args),  # lr.w rd, offset(rs)
+    "sc": lambda vm, idx, args, semantics: make_store_conditional(args),  # sc.w rd, rs2, offset(rs1)
+    "r": lambda vm, idx, args, semantics: make_binary_op(args, semantics),  # add rd, rs1, rs2
+    "i": lambda vm, idx, args, semantics: make_binary_opi(args, semantics),  # addi rd, rs, imm
+    "branch": lambda vm, idx, args, semantics: make_branch_op(args, code_label_locator(vm, idx), semantics),  # beq rs1, rs2, label
+    "jal": lambda vm, idx, args, semantics: make_jal(args, code_label_locator(vm, idx)),  # jal rd, label
+    "jalr": lambda vm, idx, args, semantics: make_jalr(args),  # jalr rd, rs, offset
+}
+
+OPCODES = {}  # mnemonic -> OpcodeSpec
+
+def register_opcode(mnemonic, fmt, semantics=None, **flags):
+    # new instructions (such as ISA extensions) are added by registering them here
+    spec = OpcodeSpec(mnemonic, fmt, semantics, **flags)
+    OPCODES[mnemonic] = spec
+    return spec
+
+register_opcode("nop", "none")
+register_opcode("printc", "printc")
+register_opcode("readc", "readc")
+register_opcode("lw", "load", VM.load_word, reads_memory=True)
+register_opcode("sw", "store", VM.store_word, writes_memory=True)
+register_opcode("lh", "load", VM.load_half, reads_memory=True)
+register_opcode("lhu", "load", VM.load_half_unsigned, reads_memory=True)
+register_opcode("sh", "store", VM.store_half, writes_memory=True)
+register_opcode("lb", "load", VM.load_byte, reads_memory=True)
+register_opcode("lbu", "load", VM.load_byte_unsigned, reads_memory=True)
+register_opcode("sb", "store", VM.store_byte, writes_memory=True)
+register_opcode("la", "la")
+register_opcode("hartid", "csr", lambda vm: vm.hart_id)
+
+# 64-bit counters, read 32 bits at a time like on RV32. Each instruction counts as one cycle,
+# and time is in microseconds. Instructions run by the native or translated code are not counted
+register_opcode("rdcycle", "csr", lambda vm: vm.instructions_retired())
+register_opcode("rdcycleh", "csr", lambda vm: vm.instructions_retired() >> 32)
+register_opcode("rdinstret", "csr", lambda vm: vm.instructions_retired())
+register_opcode("rdinstreth", "csr", lambda vm: vm.instructions_retired() >> 32)
+register_opcode("rdtime", "csr", lambda vm: time.monotonic_ns() // 1000)
+register_opcode("rdtimeh", "csr", lambda vm: (time.monotonic_ns() // 1000) >> 32)
+
+# atomic memory operations on words, which only matter once several harts share memory
+register_opcode("amoadd.w", "amo", lambda old, val: old + val, reads_memory=True, writes_memory=True)
+register_opcode("amoswap.w", "amo", lambda old, val: val, reads_memory=True, writes_memory=True)
+register_opcode("amoand.w", "amo", lambda old, val: old & val, reads_memory=True, writes_memory=True)
+register_opcode("amoor.w", "amo", lambda old, val: old | val, reads_memory=True, writes_memory=True)
+register_opcode("amoxor.w", "amo", lambda old, val: old ^ val, reads_memory=True, writes_memory=True)
+register_opcode("lr.w", "lr", reads_memory=True)
+register_opcode("sc.w", "sc", reads_memory=True, writes_memory=True)
+
+for mnemonic, op_func in [
+    ("add", lambda x, y: x + y),
+    ("sub", lambda x, y: to_signed_32(x) - to_signed_32(y)),
+    ("and", lambda x, y: x & y),
+    ("or", lambda x, y: x | y),
+    ("xor", lambda x, y: x ^ y),
+    ("sll", lambda x, y: (x << y) & MASK_32),
+    ("srl", lambda x, y: (x & MASK_32) >> y),
+    ("sra", lambda x, y: to_signed_32(x) >> y),
+    ("slt", lambda x, y: 1 if to_signed_32(x) < to_signed_32(y) else 0),
+    ("sltu", lambda x, y: 1 if (x & MASK_32) < (y & MASK_32) else 0),
+]:
+    # each of these also has an immediate form, with the same semantics
+    register_opcode(mnemonic, "r", op_func)
+    register_opcode(mnemonic + "i", "i", op_func)
+
+register_opcode("mul", "r", lambda x, y: to_signed_32(x) * to_signed_32(y))
+register_opcode("mulh", "r", lambda x, y: (to_signed_32(x) * to_signed_32(y)) >> 32)
+register_opcode("mulhu", "r", lambda x, y: ((x & MASK_32) * (y & MASK_32)) >> 32)
+register_opcode("div", "r", lambda x, y: trunc_divmod(to_signed_32(x), to_signed_32(y))[0] if y != 0 else 0xFFFFFFFF)
+register_opcode("divu", "r", lambda x, y: (x & MASK_32) // (y & MASK_32) if y != 0 else 0xFFFFFFFF)
+register_opcode("rem", "r", lambda x, y: trunc_divmod(to_signed_32(x), to_signed_32(y))[1] if y != 0 else 0xFFFFFFFF)
+register_opcode("remu", "r", lambda x, y: (x & MASK_32) % (y & MASK_32) if y != 0 else 0xFFFFFFFF)
+
+register_opcode("beq", "branch", lambda x, y: x == y, is_branch=True)
+register_opcode("bne", "branch", lambda x, y: x != y, is_branch=True)
+register_opcode("blt", "branch", lambda x, y: to_signed_32(x) < to_signed_32(y), is_branch=True)
+register_opcode("bge", "branch", lambda x, y: to_signed_32(x) >= to_signed_32(y), is_branch=True)
+register_opcode("bltu", "branch", lambda x, y: (x & MASK_32) < (y & MASK_32), is_branch=True)
+register_opcode("bgeu", "branch", lambda x, y: (x & MASK_32) >= (y & MASK_32), is_branch=True)
+register_opcode("jal", "jal", is_branch=True)
+register_opcode("jalr", "jalr", is_branch=True)
+
 if __name__ == "__main__":
     import sys
 
-    if len(sys.argv) <= 1:
+    args = sys.argv[1:]
+    def pop_option_values(flag):
+        # removes every "<flag> <value>" pair from the arguments, returning the values
+        values = []
+        while flag in args:
+            idx = args.index(flag)
+            if idx + 1 >= len(args):
+                print(f"{flag} must be followed by a file name")
+                sys.exit(1)
+            values.append(args[idx + 1])
+            del args[idx:idx + 2]
+        return values
+
+    # every --link <file> names an asm or .obj file to link in, such as a precompiled library
+    link_filenames = pop_option_values("--link")
+    # --layout <file> names a JSON memory layout, otherwise it is sized to fit the program
+    layout_filenames = pop_option_values("--layout")
+    # --fuse-profile <file> names a profile written by superinstructions.py, whose hot pairs are fused too
+    fuse_profile_filenames = pop_option_values("--fuse-profile")
+    # --input <file> names a file whose bytes readc consumes
+    input_filenames = pop_option_values("--input")
+    positional_args = [arg for arg in args if not arg.startswith("--")]
+
+    if len(positional_args) < 1:
         print("Please enter the name of the asm file to run")
         sys.exit(1)
 
-    filename = sys.argv[1]
-    asm_parser = parser.parse_file(filename)
-
-    vm = VM(mem_size=1024)
-    vm.load_program(asm_parser)
-
-    target_function = sys.argv[2] if len(sys.argv) > 2 else "main"
+    filename = positional_args[0]
+    translated_module = None
+    if filename.endswith(".py"):
+        # a module translated ahead of time by aot.py, which embeds its program
+        import aot
+        if link_filenames:
+            print("Translated modules cannot be linked, translate the linked program instead")
+            sys.exit(1)
+        translated_module = aot.load_module(filename)
+        asm_parser = aot.module_program(translated_module)
+    elif link_filenames:
+        import linker
+        objects = [linker.load_object_or_asm(name) for name in link_filenames]
+        asm_parser = linker.link(objects + [linker.assemble_file(filename)])
+    else:
+        asm_parser = parser.parse_file(filename)
+
+    if layout_filenames:
+        import json
+        with open(layout_filenames[-1], "r") as layout_file:
+            layout = MemoryLayout.from_config(json.load(layout_file))
+    elif translated_module is not None:
+        layout = MemoryLayout.for_program(asm_parser, data_base=translated_module.DATA_BASE)
+    else:
+        layout = MemoryLayout.for_program(asm_parser)
+
+    vm = VM(layout=layout)
+    for input_filename in input_filenames:
+        with open(input_filename, "rb") as input_file:
+            vm.input_buffer += input_file.read()
+    # --lazy only decodes the instructions which actually run (translated modules hardly run any)
+    vm.load_program(asm_parser, lazy="--lazy" in args or translated_module is not None)
+    if "--fuse" in args or fuse_profile_filenames:
+        # replace common instruction sequences with superinstructions
+        import superinstructions
+        patterns = list(superinstructions.STATIC_PATTERNS)
+        for profile_filename in fuse_profile_filenames:
+            patterns += superinstructions.patterns_from_profile(superinstructions.load_profile(profile_filename))
+        superinstructions.fuse_program(vm, patterns)
+
+    target_function = positional_args[1] if len(positional_args) > 1 else "main"
     vm.call_function(target_function)
 
     verbose = "--verbose" in sys.argv[1:]
@@ -426,7 +752,7 @@ if __name__ == "__main__":
 
     if verbose:
         print("ASM Dump:\n")
-        parser.dump_asm(asm_parser)
+        parser.dump_asm(asm_parser, data_start_addr=vm.layout.data_base)
         print("\n")
 
     debug_print(f"Calling function '{target_function}'...\n")
@@ -436,9 +762,18 @@ if __name__ == "__main__":
     pre_sp = vm.registers.read("sp")
 
     try:
-        while not vm.interpret_step():
-            debug_dump(vm)
-            # pass
+        if translated_module is not None:
+            aot.run_module(translated_module, vm)
+        elif "--native" in args:
+            # lower the program to x86-64 machine code, only returning to the VM for traps
+            import x86_backend
+            x86_backend.NativeCode(vm).run(vm)
+        elif verbose:
+            while not vm.interpret_step():
+                vm.step_count += 1  # for the counter instructions, since run is not counting
+                debug_dump(vm)
+        else:
+            vm.run()
     except Exception as e:
         print(f"\nError during execution: {e}")
         vm.dump_state()
@@ -0,0 +1,135 @@
+# Assembles asm files into reusable objects, and links objects together into one program
+
+import pickle
+import re
+import parser
+from parser import Parser
+
+# instructions which refer to a label, and the index of the label argument
+CODE_LABEL_ARGS = {
+    "beq": 2, "bne": 2, "blt": 2, "bge": 2, "bltu": 2, "bgeu": 2,
+    "jal": 1,
+}
+DATA_LABEL_ARGS = {
+    "la": 1,
+}
+LOCAL_LABEL_PATTERN = re.compile(r'^\d+[fb]?$')  # numeric labels never leave their object
+DATA_ALIGNMENT = 16  # each object's data starts on this boundary, so its .align directives still hold
+
+class ObjectFile:
+    """
+    An assembled program together with its symbol table:
+    the global labels it exports, and the global labels it needs from other objects
+    """
+    def __init__(self, program: Parser):
+        self.program = program
+        self.code_symbols = {}  # label -> code index
+        self.data_symbols = {}  # label -> data offset
+        self.external_symbols = set()  # labels referenced but not defined here
+
+        for idx, labels in enumerate(program.code_labels):
+            for label in labels:
+                if not LOCAL_LABEL_PATTERN.match(label):
+                    self.code_symbols.setdefault(label, idx)
+        for idx, labels in enumerate(program.data_labels):
+            for label in labels:
+                if not LOCAL_LABEL_PATTERN.match(label):
+                    self.data_symbols.setdefault(label, idx)
+
+        for instr, args in program.code:
+            if instr in CODE_LABEL_ARGS and len(args) > CODE_LABEL_ARGS[instr]:
+                label = args[CODE_LABEL_ARGS[instr]]
+                if not LOCAL_LABEL_PATTERN.match(label) and label not in self.code_symbols:
+                    self.external_symbols.add(label)
+            elif instr in DATA_LABEL_ARGS and len(args) > DATA_LABEL_ARGS[instr]:
+                label = args[DATA_LABEL_ARGS[instr]]
+                if label not in self.data_symbols:
+                    self.external_symbols.add(label)
+
+    def exported_symbols(self) -> set:
+        return set(self.code_symbols) | set(self.data_symbols)
+
+    def __repr__(self):
+        return f"ObjectFile(exports={sorted(self.exported_symbols())}, externals={sorted(self.external_symbols)})"
+
+def assemble_lines(lines: list) -> ObjectFile:
+    # remove comments and whitespaces
+    lines = [parser.trim_line(line) for line in lines]
+    lines = [line for line in lines if len(line) > 0]
+    return ObjectFile(parser.parse_lines(lines))
+
+def assemble_file(filename: str) -> ObjectFile:
+    with open(filename, "r") as file:
+        return assemble_lines(file.readlines())
+
+def save_object(obj: ObjectFile, filename: str):
+    with open(filename, "wb") as file:
+        pickle.dump(obj, file, protocol=pickle.HIGHEST_PROTOCOL)
+
+def load_object(filename: str) -> ObjectFile:
+    with open(filename, "rb") as file:
+        obj = pickle.load(file)
+    if not isinstance(obj, ObjectFile):
+        raise ValueError(f"Not an object file: {filename}")
+    return obj
+
+def load_object_or_asm(filename: str) -> ObjectFile:
+    # .obj files are already assembled, anything else is treated as asm source
+    if filename.endswith(".obj"):
+        return load_object(filename)
+    return assemble_file(filename)
+
+def link(objects: list) -> Parser:
+    """
+    Concatenates the code and data segments of the objects, in order,
+    after checking that every external label is exported by exactly one object
+    """
+    defined = {}
+    for obj in objects:
+        for symbol in obj.exported_symbols():
+            if symbol in defined:
+                raise ValueError(f"Duplicate symbol: {symbol}")
+            defined[symbol] = obj
+    for obj in objects:
+        for symbol in obj.external_symbols:
+            if symbol not in defined:
+                raise ValueError(f"Undefined symbol: {symbol}")
+
+    # labels are kept by name, so the segments only need to be concatenated
+    linked = Parser()
+    for obj in objects:
+        padding = -len(linked.data) % DATA_ALIGNMENT
+        append_segment(linked.data, linked.data_labels, [0] * padding, [])
+        append_segment(linked.code, linked.code_labels, obj.program.code, obj.program.code_labels)
+        append_segment(linked.data, linked.data_labels, obj.program.data, obj.program.data_labels)
+    linked.pad_label_list()
+    return linked
+
+def append_segment(items: list, labels: list, new_items, new_labels: list):
+    # a label list may run one past the end of its segment (a label on the last line),
+    # in which case those labels attach to whatever comes next
+    labels.extend([parser.NO_LABELS] * (len(items) + 1 - len(labels)))
+    start = len(items)
+    items.extend(new_items)
+    labels.extend([parser.NO_LABELS] * (len(items) + 1 - len(labels)))
+    for idx, label_names in enumerate(new_labels):
+        if label_names:
+            labels[start + idx] = list(labels[start + idx]) + list(label_names)
+
+
+if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) != 3:
+        print("Please enter the name of the asm file to assemble, and the object file to write")
+        print(f"Usage: python3 {sys.argv[0]} <asm_file> <object_file>")
+        sys.exit(1)
+
+    # go through the module, so the pickled classes are not recorded as part of __main__
+    import linker
+    obj = linker.assemble_file(sys.argv[1])
+    linker.save_object(obj, sys.argv[2])
+    print(f"Assembled {len(obj.program.code)} instructions and {len(obj.program.data)} data bytes")
+    print(f"Exported symbols: {', '.join(sorted(obj.exported_symbols()))}")
+    if obj.external_symbols:
+        print(f"External symbols: {', '.join(sorted(obj.external_symbols))}")
@@ -1,9 +1,16 @@
 # the compiler for the mathlang language
 
+import hashlib
+import os
+import pickle
+import parser as assembler
+import linker
 from mathlang.parser import Parser, Code, parse_file, LeftExpr, RightExpr
 
 
 LIB_FILE = "mathlang/lib_asm.txt"
+COMPILER_VERSION = "1"  # bump whenever the emitted assembly (or the assembled object format) changes
+CACHE_DIR = ".mathlang_cache"
 
 class Compiler:
     def __init__(self, parser: Parser):
@@ -75,10 +82,13 @@ class Compiler:
 
         return [f"  // {left} = {right}"] + asm_lines + [""]  # add a blank line for readability
     
-    def compile(self) -> list:
-        # load the library file
-        with open(LIB_FILE, "r") as lib_file:
-            lib_lines = lib_file.readlines()
+    def compile(self, lib_lines: list = None, include_library: bool = True) -> list:
+        # load the library file, unless it is linked in separately
+        if not include_library:
+            lib_lines = []
+        elif lib_lines is None:
+            with open(LIB_FILE, "r") as lib_file:
+                lib_lines = lib_file.readlines()
         
         output = []
         
@@ -105,25 +115,110 @@ class Compiler:
         return lib_lines + [line + "\n" for line in output]
 
 
+def cache_key(source: str, library: str) -> str:
+    # content address of a compilation: the same inputs always produce the same assembly
+    digest = hashlib.sha256()
+    for part in (COMPILER_VERSION, source, library):
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+def write_atomically(filename: str, data: bytes):
+    # concurrent builds may race on the same entry, so never expose a half-written file
+    temp_filename = f"{filename}.{os.getpid()}.tmp"
+    with open(temp_filename, "wb") as f:
+        f.write(data)
+    os.replace(temp_filename, filename)
+
+def compile_cached(src_filename: str, cache_dir: str = CACHE_DIR) -> list:
+    """
+    Compiles the source file, reusing the stored assembly if this exact source
+    and library have been compiled before. Returns the assembly lines.
+    """
+    with open(src_filename, "r") as src_file:
+        source = src_file.read()
+    with open(LIB_FILE, "r") as lib_file:
+        library = lib_file.read()
+
+    asm_filename = os.path.join(cache_dir, cache_key(source, library) + ".asm")
+    if os.path.exists(asm_filename):
+        with open(asm_filename, "r") as asm_file:
+            return asm_file.readlines()
+
+    parser = Parser()
+    for line in source.splitlines():
+        parser.parse_line(line)
+    parser.validate()
+    asm_output = Compiler(parser).compile(library.splitlines(keepends=True))
+
+    os.makedirs(cache_dir, exist_ok=True)
+    write_atomically(asm_filename, "".join(asm_output).encode("utf-8"))
+    return asm_output
+
+def library_object(library: str, cache_dir: str = CACHE_DIR) -> linker.ObjectFile:
+    # the library is assembled once into an object, and then linked into every program
+    obj_filename = os.path.join(cache_dir, cache_key("", library) + ".lib.obj")
+    if os.path.exists(obj_filename):
+        return linker.load_object(obj_filename)
+
+    obj = linker.assemble_lines(library.splitlines())
+    os.makedirs(cache_dir, exist_ok=True)
+    write_atomically(obj_filename, pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL))
+    return obj
+
+def assemble_cached(src_filename: str, cache_dir: str = CACHE_DIR) -> assembler.Parser:
+    """
+    Compiles and assembles the source file into a program ready for VM.load_program,
+    reusing the stored object if this exact source and library have been assembled before.
+    Only the user's code is assembled; the library is linked in as a precompiled object.
+    """
+    with open(src_filename, "r") as src_file:
+        source = src_file.read()
+    with open(LIB_FILE, "r") as lib_file:
+        library = lib_file.read()
+
+    obj_filename = os.path.join(cache_dir, cache_key(source, library) + ".obj")
+    if os.path.exists(obj_filename):
+        with open(obj_filename, "rb") as obj_file:
+            return pickle.load(obj_file)
+
+    parser = Parser()
+    for line in source.splitlines():
+        parser.parse_line(line)
+    parser.validate()
+    user_object = linker.assemble_lines(Compiler(parser).compile(include_library=False))
+    program = linker.link([library_object(library, cache_dir), user_object])
+
+    os.makedirs(cache_dir, exist_ok=True)
+    write_atomically(obj_filename, pickle.dumps(program, protocol=pickle.HIGHEST_PROTOCOL))
+    return program
+
+
 if __name__ == "__main__":
     import sys
 
-    if len(sys.argv) <= 2:
+    args = [arg for arg in sys.argv[1:] if arg not in ("--cache", "--no-lib")]
+    if len(args) < 2:
         print("Please enter the name of the source file and output file")
-        print(f"Usage: python3 {sys.argv[0]} <source_file> <output_file>")
+        print(f"Usage: python3 {sys.argv[0]} <source_file> <output_file> [--cache | --no-lib]")
         sys.exit(1)
 
-    src_filename = sys.argv[1]
+    src_filename = args[0]
 
-    asm_parser = parse_file(src_filename)
+    if "--cache" in sys.argv:
+        # reuse the assembly from an identical earlier compilation
+        asm_output = compile_cached(src_filename)
+    else:
+        asm_parser = parse_file(src_filename)
 
-    for i, (left, right) in enumerate(asm_parser.code.lines):
-        print(f"{i}: \t{left} = {right}")
-    
-    compiler = Compiler(asm_parser)
-    asm_output = compiler.compile()
+        for i, (left, right) in enumerate(asm_parser.code.lines):
+            print(f"{i}: \t{left} = {right}")
+        
+        compiler = Compiler(asm_parser)
+        # with --no-lib, the library is linked in when running instead of being prepended
+        asm_output = compiler.compile(include_library="--no-lib" not in sys.argv)
 
-    output_filename = sys.argv[2]
+    output_filename = args[1]
 
     with open(output_filename, "w") as output_file:
         output_file.writelines(asm_output)
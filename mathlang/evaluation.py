@@ -0,0 +1,90 @@
+# Streaming and batch evaluation, shared by the mathlang and mathlang 2.0 interpreters
+
+"""
+Both languages parse into the same shape of Code (lines of (LeftExpr, RightExpr), variables and inputs),
+so they evaluate it the same way. The one difference is which variables may be read before being assigned:
+any variable in mathlang, but only the declared inputs in mathlang 2.0, so batch evaluation takes that list.
+"""
+
+try:
+    import numpy as np
+except ImportError:  # numpy is only needed for batch evaluation
+    np = None
+
+def interpret_stream(interpreter, parser, lines):
+    """
+    Parses and runs each line as soon as it is read (e.g. from a file or pipe),
+    so that only the variable state is kept in memory. Returns the parser
+    """
+    interpreter.initialize_variables(parser.code.variables)
+    interpreter.variable_list = parser.code.variables  # grows as new variables are assigned
+    known_variables = len(parser.code.variables)
+    for line in lines:
+        statement = parser.parse_statement(line)
+        for variable_name in parser.code.variables[known_variables:]:
+            interpreter.variables.setdefault(variable_name, 0)  # e.g. declared inputs
+        known_variables = len(parser.code.variables)
+        if statement is None:
+            continue
+        left, right = statement
+        left.validate()
+        right.validate()
+        interpreter.interpret_line(left, right)
+    return parser
+
+def interpret_batch(code, inputs: dict, zeroed_variables: list) -> dict:
+    """
+    Evaluates the program over many rows of inputs at once, one vectorized operation per line.
+    inputs maps each declared input variable to an array of initial values,
+    and every variable of zeroed_variables without one starts as 0.
+    Returns a dict of the final int64 array (possibly a read-only view) for every variable.
+    Unlike interpret_code, values wrap around at 64 bits instead of growing without bound.
+    """
+    if np is None:
+        raise ImportError("numpy is required for batch evaluation")
+
+    for name in inputs:
+        if name not in code.inputs:
+            raise ValueError(f"Not a declared input variable: {name}")
+    columns = {name: np.asarray(values, dtype=np.int64) for name, values in inputs.items()}
+    lengths = {len(column) for column in columns.values()}
+    if len(lengths) > 1:
+        raise ValueError("All input arrays must have the same length")
+    rows = lengths.pop() if lengths else 1
+
+    for variable in zeroed_variables:
+        if variable not in columns:
+            columns[variable] = np.zeros(rows, dtype=np.int64)
+
+    def operand(expr):
+        # literals stay scalars, numpy broadcasts them across the rows
+        return columns[expr.data[0]] if expr.type == "variable" else expr.data[0]
+
+    for left, right in code.lines:
+        if right.type == "literal":
+            result = right.data[0]
+        elif right.type == "variable":
+            result = columns[right.data[0]]  # arrays are never modified in place, so sharing is safe
+        elif right.type == "arithmetic":
+            op, left_expr, right_expr = right.data
+            left_value = operand(left_expr)
+            right_value = operand(right_expr)
+
+            if op == "+":
+                result = np.add(left_value, right_value)
+            elif op == "-":
+                result = np.subtract(left_value, right_value)
+            elif op == "*":
+                result = np.multiply(left_value, right_value)
+            elif op == "/":
+                # numpy silently yields 0 when dividing by zero
+                if np.any(np.asarray(right_value) == 0):
+                    raise ZeroDivisionError("integer division or modulo by zero")
+                result = np.floor_divide(left_value, right_value)  # same rounding as //
+            else:
+                raise ValueError(f"Unsupported operator: {op}")
+        else:
+            raise ValueError(f"Unsupported right expression type: {right.type}")
+        columns[left.var_name] = np.broadcast_to(np.asarray(result, dtype=np.int64), (rows,))
+
+    return columns
@@ -1,6 +1,7 @@
 # the interpreter for the mathlang language
 
-from mathlang.parser import Parser, Code, parse_file
+from mathlang.parser import Parser, Code, LeftExpr, RightExpr, parse_file
+from mathlang import evaluation
 
 class Interpreter:
     def __init__(self):
@@ -13,25 +14,37 @@ class Interpreter:
 
     def interpret_code(self, code: Code):  # code is a list of (left, right) tuples
         for left, right in code.lines:
-            if right.type == "literal":
-                self.variables[left.var_name] = right.data[0]
-            elif right.type == "variable":
-                self.variables[left.var_name] = self.variables[right.data[0]]
-            elif right.type == "arithmetic":
-                op, left_expr, right_expr = right.data
-                left_value = self.variables[left_expr.data[0]] if left_expr.type == "variable" else left_expr.data[0]
-                right_value = self.variables[right_expr.data[0]] if right_expr.type == "variable" else right_expr.data[0]
-
-                if op == "+":
-                    self.variables[left.var_name] = left_value + right_value
-                elif op == "-":
-                    self.variables[left.var_name] = left_value - right_value
-                elif op == "*":
-                    self.variables[left.var_name] = left_value * right_value
-                elif op == "/":
-                    self.variables[left.var_name] = left_value // right_value  # integer division
-                else:
-                    raise ValueError(f"Unsupported operator: {op}")
+            self.interpret_line(left, right)
+
+    def interpret_line(self, left: LeftExpr, right: RightExpr):
+        if right.type == "literal":
+            self.variables[left.var_name] = right.data[0]
+        elif right.type == "variable":
+            self.variables[left.var_name] = self.variables[right.data[0]]
+        elif right.type == "arithmetic":
+            op, left_expr, right_expr = right.data
+            left_value = self.variables[left_expr.data[0]] if left_expr.type == "variable" else left_expr.data[0]
+            right_value = self.variables[right_expr.data[0]] if right_expr.type == "variable" else right_expr.data[0]
+
+            if op == "+":
+                self.variables[left.var_name] = left_value + right_value
+            elif op == "-":
+                self.variables[left.var_name] = left_value - right_value
+            elif op == "*":
+                self.variables[left.var_name] = left_value * right_value
+            elif op == "/":
+                self.variables[left.var_name] = left_value // right_value  # integer division
+            else:
+                raise ValueError(f"Unsupported operator: {op}")
+
+    def interpret_stream(self, lines) -> Parser:
+        # parses and runs each line as soon as it is read, keeping only the variable state
+        return evaluation.interpret_stream(self, Parser(), lines)
+
+    def interpret_batch(self, code: Code, inputs: dict) -> dict:
+        # evaluates the program over NumPy arrays of input values (see mathlang/evaluation.py);
+        # variables read before being assigned start as 0
+        return evaluation.interpret_batch(code, inputs, code.variables)
     
     def print_state(self):
         if self.variables is None:
@@ -47,11 +60,22 @@ if __name__ == "__main__":
 
     if len(sys.argv) <= 1:
         print("Please enter the name of the source file")
-        print(f"Usage: python3 {sys.argv[0]} <source_file>")
+        print(f"Usage: python3 {sys.argv[0]} <source_file> [--stream]")
         sys.exit(1)
 
     src_filename = sys.argv[1]
 
+    if "--stream" in sys.argv[2:]:
+        # run each line as it is read; a source file of "-" reads from stdin
+        interpreter = Interpreter()
+        if src_filename == "-":
+            interpreter.interpret_stream(sys.stdin)
+        else:
+            with open(src_filename, "r") as src_file:
+                interpreter.interpret_stream(src_file)
+        interpreter.print_state()
+        sys.exit(0)
+
     asm_parser = parse_file(src_filename)
 
     # for i, (left, right) in enumerate(asm_parser.code.lines):
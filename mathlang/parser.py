@@ -12,14 +12,18 @@ Expressions are either arithmetic operations, variable names, or literal numbers
 The two sides of an arithmetic operation can be a variable name or a literal
 +, -, *, /
 a = 15 - a  # lol
+Variables may be declared as inputs, whose initial values are supplied by the caller
+input a, b
 """
 
 VARIABLES = [ "a", "b", "c" ]
+INPUT_KEYWORD = "input"
 
 class Code:
     def __init__(self):
         self.variables = VARIABLES
         self.lines = []  # list of (LeftExpr, RightExpr) tuples
+        self.inputs = []  # variables declared as program inputs
 
 def trim_line(line):
     # remove comments
@@ -88,10 +92,25 @@ class Parser:
         self.code = Code()
     
     def parse_line(self, line: str):
+        statement = self.parse_statement(line)
+        if statement is not None:
+            self.code.lines.append(statement)
+
+    def parse_statement(self, line: str):
+        """
+        Parses one line of code, returning its (LeftExpr, RightExpr) statement,
+        or None if the line holds no statement
+        """
         line = trim_line(line)
 
         if len(line) == 0:
-            return  # skip empty lines
+            return None  # skip empty lines
+
+        # input declarations are the only statement without an equals sign
+        keyword, _, declared = line.partition(" ")
+        if keyword == INPUT_KEYWORD and "=" not in line:
+            self.parse_input_declaration(declared)
+            return None
 
         # split by equals sign
         if "=" not in line:
@@ -103,7 +122,18 @@ class Parser:
         left_expr = LeftExpr(lhs)
         right_expr = self.parse_right_expr(rhs)
 
-        self.code.lines.append((left_expr, right_expr))
+        return (left_expr, right_expr)
+
+    def parse_input_declaration(self, declared: str):
+        names = [name.strip() for name in declared.split(",")]
+        names = [name for name in names if len(name) > 0]
+        if not names:
+            raise ValueError("No variables declared in input statement")
+        for name in names:
+            if name not in VARIABLES:
+                raise ValueError(f"Invalid input variable name: {name}")
+            if name not in self.code.inputs:
+                self.code.inputs.append(name)
     
     def parse_primitive(self, token: str):
         # check if it's a variable
@@ -148,12 +178,10 @@ class Parser:
 
 
 def parse_file(filename):
-    with open(filename, "r") as file:
-        lines = file.readlines()
-
     parser = Parser()
-    for line in lines:
-        parser.parse_line(line)
+    with open(filename, "r") as file:
+        for line in file:
+            parser.parse_line(line)
     parser.validate()
 
     return parser
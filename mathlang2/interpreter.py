@@ -1,6 +1,85 @@
 # the interpreter for the mathlang language
 
-from mathlang2.parser import Parser, Code, parse_file
+import operator
+from mathlang2.parser import Parser, Code, LeftExpr, RightExpr, parse_file
+from mathlang import evaluation
+
+OPERATOR_FUNCTIONS = {
+    "+": operator.add,
+    "-": operator.sub,
+    "*": operator.mul,
+    "/": operator.floordiv,  # integer division
+}
+
+class CompiledCode:
+    """
+    A program lowered into a flat list of closures, each operating on a list of variable slots
+    """
+    def __init__(self, variable_list: list, steps: list):
+        self.variable_list = variable_list  # slot index -> variable name
+        self.steps = steps
+
+    def run(self, slots: list) -> list:
+        for step in self.steps:
+            step(slots)
+        return slots
+
+def compile_line(left: LeftExpr, right: RightExpr):
+    # the symbol ids assigned by the parser are used directly as slots
+    dest = left.slot
+
+    if right.type == "literal":
+        value = right.data[0]
+        def literal_step(slots):
+            slots[dest] = value
+        return literal_step
+    elif right.type == "variable":
+        src = right.slot
+        def variable_step(slots):
+            slots[dest] = slots[src]
+        return variable_step
+    elif right.type == "arithmetic":
+        op, left_expr, right_expr = right.data
+        if op not in OPERATOR_FUNCTIONS:
+            raise ValueError(f"Unsupported operator: {op}")
+        op_func = OPERATOR_FUNCTIONS[op]
+
+        if left_expr.type == "variable" and right_expr.type == "variable":
+            src1 = left_expr.slot
+            src2 = right_expr.slot
+            def var_var_step(slots):
+                slots[dest] = op_func(slots[src1], slots[src2])
+            return var_var_step
+        elif left_expr.type == "variable":
+            src1 = left_expr.slot
+            value2 = right_expr.data[0]
+            def var_lit_step(slots):
+                slots[dest] = op_func(slots[src1], value2)
+            return var_lit_step
+        elif right_expr.type == "variable":
+            value1 = left_expr.data[0]
+            src2 = right_expr.slot
+            def lit_var_step(slots):
+                slots[dest] = op_func(value1, slots[src2])
+            return lit_var_step
+        else:
+            value1 = left_expr.data[0]
+            value2 = right_expr.data[0]
+            if op == "/" and value2 == 0:
+                # leave the division by zero to raise when the program runs
+                def lit_lit_step(slots):
+                    slots[dest] = op_func(value1, value2)
+                return lit_lit_step
+            folded = op_func(value1, value2)
+            def folded_step(slots):
+                slots[dest] = folded
+            return folded_step
+    else:
+        raise ValueError(f"Unsupported right expression type: {right.type}")
+
+def compile_code(code: Code) -> CompiledCode:
+    steps = [compile_line(left, right) for left, right in code.lines]
+    return CompiledCode(list(code.variables), steps)
 
 class Interpreter:
     def __init__(self):
@@ -13,25 +92,43 @@ class Interpreter:
 
     def interpret_code(self, code: Code):  # code is a list of (left, right) tuples
         for left, right in code.lines:
-            if right.type == "literal":
-                self.variables[left.var_name] = right.data[0]
-            elif right.type == "variable":
-                self.variables[left.var_name] = self.variables[right.data[0]]
-            elif right.type == "arithmetic":
-                op, left_expr, right_expr = right.data
-                left_value = self.variables[left_expr.data[0]] if left_expr.type == "variable" else left_expr.data[0]
-                right_value = self.variables[right_expr.data[0]] if right_expr.type == "variable" else right_expr.data[0]
-
-                if op == "+":
-                    self.variables[left.var_name] = left_value + right_value
-                elif op == "-":
-                    self.variables[left.var_name] = left_value - right_value
-                elif op == "*":
-                    self.variables[left.var_name] = left_value * right_value
-                elif op == "/":
-                    self.variables[left.var_name] = left_value // right_value  # integer division
-                else:
-                    raise ValueError(f"Unsupported operator: {op}")
+            self.interpret_line(left, right)
+
+    def interpret_line(self, left: LeftExpr, right: RightExpr):
+        if right.type == "literal":
+            self.variables[left.var_name] = right.data[0]
+        elif right.type == "variable":
+            self.variables[left.var_name] = self.variables[right.data[0]]
+        elif right.type == "arithmetic":
+            op, left_expr, right_expr = right.data
+            left_value = self.variables[left_expr.data[0]] if left_expr.type == "variable" else left_expr.data[0]
+            right_value = self.variables[right_expr.data[0]] if right_expr.type == "variable" else right_expr.data[0]
+
+            if op == "+":
+                self.variables[left.var_name] = left_value + right_value
+            elif op == "-":
+                self.variables[left.var_name] = left_value - right_value
+            elif op == "*":
+                self.variables[left.var_name] = left_value * right_value
+            elif op == "/":
+                self.variables[left.var_name] = left_value // right_value  # integer division
+            else:
+                raise ValueError(f"Unsupported operator: {op}")
+
+    def interpret_stream(self, lines) -> Parser:
+        # parses and runs each line as soon as it is read, keeping only the variable state
+        return evaluation.interpret_stream(self, Parser(), lines)
+
+    def interpret_compiled(self, compiled: CompiledCode):
+        # the slots start from the current variable state, and are written back afterwards
+        slots = [self.variables.get(var, 0) for var in compiled.variable_list]
+        compiled.run(slots)
+        self.variables.update(zip(compiled.variable_list, slots))
+
+    def interpret_batch(self, code: Code, inputs: dict) -> dict:
+        # evaluates the program over NumPy arrays of input values (see mathlang/evaluation.py);
+        # only the declared inputs can be read before being assigned
+        return evaluation.interpret_batch(code, inputs, code.inputs)
     
     def print_state(self):
         if self.variables is None:
@@ -50,11 +147,22 @@ if __name__ == "__main__":
 
     if len(sys.argv) <= 1:
         print("Please enter the name of the source file")
-        print(f"Usage: python3 {sys.argv[0]} <source_file>")
+        print(f"Usage: python3 {sys.argv[0]} <source_file> [--compiled | --stream]")
         sys.exit(1)
 
     src_filename = sys.argv[1]
 
+    if "--stream" in sys.argv[2:]:
+        # run each line as it is read; a source file of "-" reads from stdin
+        interpreter = Interpreter()
+        if src_filename == "-":
+            interpreter.interpret_stream(sys.stdin)
+        else:
+            with open(src_filename, "r") as src_file:
+                interpreter.interpret_stream(src_file)
+        interpreter.print_state()
+        sys.exit(0)
+
     asm_parser = parse_file(src_filename)
 
     # for i, (left, right) in enumerate(asm_parser.code.lines):
@@ -65,5 +173,8 @@ if __name__ == "__main__":
 
     print(f"Interpreting {len(asm_parser.code.lines)} lines of code!\n")
 
-    interpreter.interpret_code(asm_parser.code)
+    if "--compiled" in sys.argv[2:]:
+        interpreter.interpret_compiled(compile_code(asm_parser.code))
+    else:
+        interpreter.interpret_code(asm_parser.code)
     interpreter.print_state()
\ No newline at end of file
@@ -0,0 +1,246 @@
+# Whole-program optimizer for the mathlang 2.0 language
+
+"""
+A mathlang 2.0 program has no control flow, so the final value of every variable
+is a single expression over the program's inputs.
+The optimizer composes the assignments into one expression DAG (with shared nodes),
+and then emits a minimized program which only computes what the outputs depend on:
+dead stores, overwritten variables and copies all disappear.
+
+The outputs are the variables which the interpreter prints (names not starting with two underscores).
+Arithmetic is never reassociated, so integer division keeps its exact semantics.
+Note that a division by zero in a dead store no longer raises, since the store is never run,
+and that the outputs may be defined (and therefore printed) in a different order.
+0 * x is only folded to 0 when x cannot raise, that is when every division in it has a non-zero literal divisor,
+so a live division by zero still raises.
+"""
+
+from mathlang2.parser import Code, parse_file
+
+# expression DAG nodes are tuples, interned to integer ids:
+# ("literal", value), ("input", var_name), or (op, left_id, right_id)
+LITERAL = "literal"
+INPUT = "input"
+
+class ExpressionGraph:
+    def __init__(self):
+        self.nodes = []  # node id -> node tuple; operands always have smaller ids
+        self.node_ids = {}  # node tuple -> node id
+        self.may_raise = []  # node id -> whether evaluating the node may divide by zero
+
+    def intern(self, node: tuple) -> int:
+        node_id = self.node_ids.get(node)
+        if node_id is None:
+            node_id = len(self.nodes)
+            self.nodes.append(node)
+            self.node_ids[node] = node_id
+            if node[0] in (LITERAL, INPUT):
+                self.may_raise.append(False)
+            else:
+                op, left_id, right_id = node
+                divisor = self.literal_value(right_id)
+                self.may_raise.append(self.may_raise[left_id] or self.may_raise[right_id]
+                                      or (op == "/" and (divisor is None or divisor == 0)))
+        return node_id
+
+    def literal(self, value: int) -> int:
+        return self.intern((LITERAL, value))
+
+    def literal_value(self, node_id: int):
+        node = self.nodes[node_id]
+        return node[1] if node[0] == LITERAL else None
+
+    def operation(self, op: str, left_id: int, right_id: int) -> int:
+        left_value = self.literal_value(left_id)
+        right_value = self.literal_value(right_id)
+
+        # constant folding; division by zero is left for the program to raise
+        if left_value is not None and right_value is not None:
+            if op == "+":
+                return self.literal(left_value + right_value)
+            elif op == "-":
+                return self.literal(left_value - right_value)
+            elif op == "*":
+                return self.literal(left_value * right_value)
+            elif op == "/" and right_value != 0:
+                return self.literal(left_value // right_value)
+
+        # identities which hold for all integers
+        if right_value == 0 and op in ("+", "-"):
+            return left_id
+        if left_value == 0 and op == "+":
+            return right_id
+        if right_value == 1 and op in ("*", "/"):
+            return left_id
+        if left_value == 1 and op == "*":
+            return right_id
+        if op == "*" and ((left_value == 0 and not self.may_raise[right_id])
+                          or (right_value == 0 and not self.may_raise[left_id])):
+            return self.literal(0)
+
+        return self.intern((op, left_id, right_id))
+
+
+def is_output(var_name: str) -> bool:
+    # the interpreter does not print variables starting with two underscores
+    return not var_name.startswith("__")
+
+def live_lines(code: Code, outputs: list) -> list:
+    # backwards liveness pass: keep only the assignments which an output depends on
+    needed = set(outputs)
+    live = []
+    for left, right in reversed(code.lines):
+        if left.var_name not in needed:
+            continue  # dead store, or overwritten before it is read
+        live.append((left, right))
+        needed.discard(left.var_name)
+        if right.type == "variable":
+            needed.add(right.data[0])
+        elif right.type == "arithmetic":
+            for operand in right.data[1:]:
+                if operand.type == "variable":
+                    needed.add(operand.data[0])
+    live.reverse()
+    return live
+
+def compose(code: Code, lines: list) -> tuple:
+    # forward pass: map every variable to the DAG node holding its value
+    graph = ExpressionGraph()
+    values = {}
+
+    def value_of(var_name: str) -> int:
+        if var_name not in values:
+            # only inputs are read before being assigned; anything else starts as 0
+            if var_name in code.inputs:
+                values[var_name] = graph.intern((INPUT, var_name))
+            else:
+                values[var_name] = graph.literal(0)
+        return values[var_name]
+
+    def operand_of(expr) -> int:
+        if expr.type == "literal":
+            return graph.literal(expr.data[0])
+        return value_of(expr.data[0])
+
+    for left, right in lines:
+        if right.type == "literal":
+            node_id = graph.literal(right.data[0])
+        elif right.type == "variable":
+            node_id = value_of(right.data[0])  # copies share the node
+        elif right.type == "arithmetic":
+            op, left_expr, right_expr = right.data
+            node_id = graph.operation(op, operand_of(left_expr), operand_of(right_expr))
+        else:
+            raise ValueError(f"Unsupported right expression type: {right.type}")
+        values[left.var_name] = node_id
+
+    return graph, values
+
+def optimize_code(code: Code) -> list:
+    """
+    Returns the minimized program as a list of mathlang 2.0 source lines
+    """
+    outputs = [var for var in code.variables if is_output(var)]
+    graph, values = compose(code, live_lines(code, outputs))
+    final_values = {var: values[var] if var in values else graph.intern((INPUT, var)) for var in outputs}
+
+    # collect the operation nodes reachable from the outputs
+    reachable = set()
+    stack = list(final_values.values())
+    while stack:
+        node_id = stack.pop()
+        if node_id in reachable:
+            continue
+        reachable.add(node_id)
+        node = graph.nodes[node_id]
+        if node[0] not in (LITERAL, INPUT):
+            stack.extend(node[1:])
+
+    taken_names = set(code.variables)
+    temp_count = 0
+    def new_temp() -> str:
+        nonlocal temp_count
+        while True:
+            temp_count += 1
+            name = f"__opt_{temp_count}"
+            if name not in taken_names:
+                taken_names.add(name)
+                return name
+
+    output = []
+    if code.inputs:
+        output.append(f"input {', '.join(code.inputs)}")
+
+    # every emitted variable is assigned exactly once, so an input which is reassigned
+    # has to be copied out first if its initial value is still needed
+    names = {}
+    for node_id in sorted(reachable):
+        node = graph.nodes[node_id]
+        if node[0] == INPUT:
+            var_name = node[1]
+            if final_values.get(var_name, node_id) != node_id:
+                names[node_id] = new_temp()
+                output.append(f"{names[node_id]} = {var_name}")
+            else:
+                names[node_id] = var_name
+
+    # name each operation after the first output holding it, otherwise a temp
+    holders = {}
+    for var, node_id in final_values.items():
+        holders.setdefault(node_id, var)
+
+    def operand_text(node_id: int) -> str:
+        value = graph.literal_value(node_id)
+        if value is None:
+            return names[node_id]
+        if value < 0:
+            # the parser only accepts negative literals in some operand positions
+            if node_id not in names:
+                names[node_id] = new_temp()
+                output.append(f"{names[node_id]} = {value}")
+            return names[node_id]
+        return str(value)
+
+    for node_id in sorted(reachable):
+        node = graph.nodes[node_id]
+        if node[0] in (LITERAL, INPUT):
+            continue
+        op, left_id, right_id = node
+        left_text = operand_text(left_id)
+        right_text = operand_text(right_id)
+        names[node_id] = holders.get(node_id) or new_temp()
+        output.append(f"{names[node_id]} = {left_text} {op} {right_text}")
+
+    # finally, outputs which are constants, inputs, or share another output's value
+    for var, node_id in final_values.items():
+        value = graph.literal_value(node_id)
+        if value is not None:
+            output.append(f"{var} = {value}")
+        elif names[node_id] != var:
+            output.append(f"{var} = {names[node_id]}")
+
+    return output
+
+def optimize_file(src_filename: str) -> list:
+    parser = parse_file(src_filename)
+    return optimize_code(parser.code)
+
+
+if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) != 2 and len(sys.argv) != 3:
+        print("Please enter the name of the source file")
+        print(f"Usage: python3 {sys.argv[0]} <source_file> <output_file>")
+        sys.exit(1)
+
+    src_filename = sys.argv[1]
+    output_filename = sys.argv[2] if len(sys.argv) == 3 else None
+    optimized_output = optimize_file(src_filename)
+    print("Optimized Output:")
+    for line in optimized_output:
+        print(line)
+    if output_filename:
+        with open(output_filename, "w") as f:
+            for line in optimized_output:
+                f.write(line + "\n")
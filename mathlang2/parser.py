@@ -1,12 +1,17 @@
 # The parser for the mathlang 2.0 language
-import re
+from mathlang2.symbols import SymbolTable, VAR_NAME_PATTERN, VAR_NAME_REGEX
 
-VAR_NAME_PATTERN = r"^[a-zA-Z_][a-zA-Z0-9_]*$"
+INPUT_KEYWORD = "input"  # input x, y declares variables supplied by the caller
 
 class Code:
     def __init__(self):
-        self.variables = []
+        self.symbols = SymbolTable()  # every defined variable, in order of definition
         self.lines = []  # list of (LeftExpr, RightExpr) tuples
+        self.inputs = []  # variables declared as program inputs
+
+    @property
+    def variables(self) -> list:
+        return self.symbols.names
 
 def trim_line(line):
     # remove comments
@@ -23,11 +28,13 @@ class LeftExpr:
     """
     Left-hand side expression - must be a variable name
     """
-    def __init__(self, var_name):
+    def __init__(self, var_name, slot=None):
         self.var_name = var_name
+        self.slot = slot  # symbol id, if the name has been interned
 
     def validate(self):
-        if not re.match(VAR_NAME_PATTERN, self.var_name):
+        # interned names were already validated by the symbol table
+        if self.slot is None and not VAR_NAME_REGEX.match(self.var_name):
             raise ValueError(f"Invalid lhs variable name: {self.var_name}")
     
     def __repr__(self):
@@ -40,18 +47,19 @@ class RightExpr:
     """
     Right-hand side expression - can be a variable name, literal, or arithmetic expression
     """
-    def __init__(self, type: str, data: list):
+    def __init__(self, type: str, data: list, slot=None):
         if type not in RIGHT_EXPR_TYPES:
             raise ValueError(f"Invalid right expression type: {type}")
         self.type = type
         self.data = data
+        self.slot = slot  # symbol id of a variable expression, if interned
     
     def validate(self):
         if self.type == "literal":
             if len(self.data) != 1 or not isinstance(self.data[0], int):
                 raise ValueError("Literal right expression must contain one integer value")
         elif self.type == "variable":
-            if len(self.data) != 1 or not re.match(VAR_NAME_PATTERN, self.data[0]):
+            if len(self.data) != 1 or (self.slot is None and not VAR_NAME_REGEX.match(self.data[0])):
                 raise ValueError("Variable right expression must contain one valid variable name")
         elif self.type == "arithmetic":
             if len(self.data) != 3:
@@ -73,10 +81,25 @@ class Parser:
         self.code = Code()
     
     def parse_line(self, line: str):
+        statement = self.parse_statement(line)
+        if statement is not None:
+            self.code.lines.append(statement)
+
+    def parse_statement(self, line: str):
+        """
+        Parses one line of code, returning its (LeftExpr, RightExpr) statement,
+        or None if the line holds no statement
+        """
         line = trim_line(line)
 
         if len(line) == 0:
-            return  # skip empty lines
+            return None  # skip empty lines
+
+        # input declarations are the only statement without an equals sign
+        keyword, _, declared = line.partition(" ")
+        if keyword == INPUT_KEYWORD and "=" not in line:
+            self.parse_input_declaration(declared)
+            return None
 
         # split by equals sign
         if "=" not in line:
@@ -85,23 +108,37 @@ class Parser:
         lhs = lhs.strip()
         rhs = rhs.strip()
 
-        left_expr = LeftExpr(lhs)
+        # the right side is parsed first, as the assignment only defines the variable afterwards
         right_expr = self.parse_right_expr(rhs)
-
-        # push variable name to variable list if not already present !
-        if left_expr.var_name not in self.code.variables:
-            self.code.variables.append(left_expr.var_name)
-
-        self.code.lines.append((left_expr, right_expr))
+        left_expr = LeftExpr(lhs, self.code.symbols.intern(lhs))
+
+        return (left_expr, right_expr)
+
+    def parse_input_declaration(self, declared: str):
+        names = [name.strip() for name in declared.split(",")]
+        names = [name for name in names if len(name) > 0]
+        if not names:
+            raise ValueError("No variables declared in input statement")
+        for name in names:
+            if not VAR_NAME_REGEX.match(name):
+                raise ValueError(f"Invalid input variable name: {name}")
+            if name in self.code.inputs:
+                continue
+            if name in self.code.symbols:
+                raise ValueError(f"Input variable declared after definition: {name}")
+            # inputs count as defined from the start of the program
+            self.code.symbols.intern(name)
+            self.code.inputs.append(name)
     
     def parse_primitive(self, token: str):
-        # check if it's a variable
-        if re.match(VAR_NAME_PATTERN, token):
-            # variable must already be defined !
-            if token in self.code.variables:
-                return RightExpr("variable", [token])
-            else:
-                raise ValueError(f"Variable used before definition: {token}")    
+        # check if it's a variable which is already defined
+        slot = self.code.symbols.lookup(token)
+        if slot is not None:
+            return RightExpr("variable", [token], slot)
+
+        # variable must already be defined !
+        if VAR_NAME_REGEX.match(token):
+            raise ValueError(f"Variable used before definition: {token}")
         
         # check if it's a literal number
         try:
@@ -141,12 +178,10 @@ class Parser:
 
 
 def parse_file(filename):
-    with open(filename, "r") as file:
-        lines = file.readlines()
-
     parser = Parser()
-    for line in lines:
-        parser.parse_line(line)
+    with open(filename, "r") as file:
+        for line in file:
+            parser.parse_line(line)
     parser.validate()
 
     return parser
@@ -0,0 +1,40 @@
+# The symbol table for the mathlang 2.0 language
+import re
+import sys
+
+VAR_NAME_PATTERN = r"^[a-zA-Z_][a-zA-Z0-9_]*$"
+VAR_NAME_REGEX = re.compile(VAR_NAME_PATTERN)
+
+class SymbolTable:
+    """
+    Interns each variable name to an integer id, validating the name once when it is first seen.
+    Ids are handed out densely in order of definition (0, 1, 2, ...),
+    so the interpreter and compilers can use them directly as slot numbers.
+    """
+    def __init__(self):
+        self.names = []  # id -> name
+        self.ids = {}  # name -> id
+
+    def intern(self, name: str) -> int:
+        symbol_id = self.ids.get(name)
+        if symbol_id is None:
+            if not VAR_NAME_REGEX.match(name):
+                raise ValueError(f"Invalid variable name: {name}")
+            name = sys.intern(name)
+            symbol_id = len(self.names)
+            self.names.append(name)
+            self.ids[name] = symbol_id
+        return symbol_id
+
+    def lookup(self, name: str):
+        # returns the id of the name, or None if it has not been interned
+        return self.ids.get(name)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.ids
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def __repr__(self):
+        return f"SymbolTable({self.names})"
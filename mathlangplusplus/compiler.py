@@ -1,21 +1,22 @@
 from mathlangplusplus.lexer import *
 from mathlangplusplus.expression_parser import *
-from mathlangplusplus.parser import Code, parse_file
+from mathlangplusplus.parser import Code, parse_file, parse_file_parallel
 
 # Compiles mathlang++ into lower-level mathlang2 instructions
 
 class Compiler:
     def __init__(self, code: Code):
         self.code = code
-        self.defined_variables = []  # variable must be here before use
+        self.defined_variables = set()  # variable must be here before use
+        self.require_definitions = True  # when False, the caller checks define-before-use itself
     
     def compile(self):
         output = []
         for lhs, rhs in self.code.lines:
             output.extend(self.compile_line(lhs, rhs))
-            self.defined_variables.append(lhs.data())
+            self.defined_variables.add(lhs.data())
         return output
-    
+
     def compile_line(self, lhs: VariableToken, rhs) -> list:
         # allocate temp variables for intermediate results
         output = []
@@ -25,7 +26,7 @@ class Compiler:
             if isinstance(node, LiteralToken):
                 return str(node.numeric_value())
             elif isinstance(node, VariableToken):
-                if node.data() not in self.defined_variables:
+                if self.require_definitions and node.data() not in self.defined_variables:
                     raise ValueError(f"Variable {node.data()} used before definition")
                 return node.data()
             elif isinstance(node, BinOpNode):
@@ -46,22 +47,42 @@ class Compiler:
         output.append(f"{lhs.data()} = {final_result}")
         return output
 
-def compile_file(src_filename: str) -> list:
-    code = parse_file(src_filename)
+def referenced_variables(node) -> list:
+    # the variable names read by an expression tree, in evaluation order
+    variables = []
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, VariableToken):
+            variables.append(node.data())
+        elif isinstance(node, BinOpNode):
+            stack.append(node.right)
+            stack.append(node.left)
+    return variables
+
+def compile_file(src_filename: str, parallel: bool = False) -> list:
+    code = parse_file_parallel(src_filename) if parallel else parse_file(src_filename)
     compiler = Compiler(code)
     return compiler.compile()
 
 if __name__ == "__main__":
     import sys
 
-    if len(sys.argv) != 2 and len(sys.argv) != 3:
+    args = [arg for arg in sys.argv[1:] if arg != "--parallel"]
+    if len(args) != 1 and len(args) != 2:
         print("Please enter the name of the source file")
         print(f"Usage: python3 {sys.argv[0]} <source_file> <output_file>")
+        print(f"       python3 -m mathlangplusplus.compiler <source_file> <output_file> --parallel")
+        sys.exit(1)
+    if "--parallel" in sys.argv and __spec__ is None:
+        # run as a script, this folder's math.py shadows the standard module which the worker pool imports
+        print("--parallel only works when run as a module:")
+        print(f"python3 -m mathlangplusplus.compiler <source_file> <output_file> --parallel")
         sys.exit(1)
     
-    src_filename = sys.argv[1]
-    output_filename = sys.argv[2] if len(sys.argv) == 3 else None
-    compiled_output = compile_file(src_filename)
+    src_filename = args[0]
+    output_filename = args[1] if len(args) == 2 else None
+    compiled_output = compile_file(src_filename, parallel="--parallel" in sys.argv)
     print("Compiled Output:")
     for line in compiled_output:
         print(line)
@@ -5,6 +5,8 @@ from abc import ABC, abstractmethod
 
 # A expression contains a list of tokens which does not contain equals or newlines
 class TokenExpression:
+    __slots__ = ("tokens",)
+
     def __init__(self, tokens: list):
         self.tokens = tokens
     
@@ -17,6 +19,8 @@ class TokenExpression:
         return f"Expression({self.tokens})"
 
 class Node(ABC):
+    __slots__ = ()
+
     @abstractmethod
     def rewrite_depth_first(self, rewrite_function):
         """
@@ -47,6 +51,8 @@ class Node(ABC):
 
 # Parse a TokenExpression into a abstract syntax tree
 class UnresolvedNode(Node):
+    __slots__ = ("tokens",)
+
     def __init__(self, tokens: list):
         """Not quite a standalone AST node yet; a string of nodes or tokens to be further parsed"""
         self.tokens = tokens
@@ -120,6 +126,8 @@ class UnresolvedNode(Node):
         return format_tree(self, indent=0, indent_string="", separator=" ")
 
 class BinOpNode(Node):
+    __slots__ = ("operation", "left", "right")
+
     def __init__(self, operation: OperatorToken, left, right):
         """Resolved Node with an operation, left value, and right value"""
         self.operation = operation
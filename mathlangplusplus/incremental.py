@@ -0,0 +1,133 @@
+# Incremental compilation of mathlang++ into mathlang2, reusing the work of previous runs
+
+"""
+Every mathlang++ statement sits on its own line, and a line always lexes, parses and compiles
+to the same output no matter what surrounds it (temp variables are numbered per line).
+So the compiler keeps a persistent cache from the hash of each line's text to its compiled
+mathlang2 lines, and only lexes, parses and compiles the lines it has not seen before.
+(The parsed trees themselves are not persisted, since nothing reads them once a line is compiled.)
+
+The only thing which depends on other lines is define-before-use, and whether that holds
+never changes the compiled output. It is rechecked in one cheap pass over the cached
+(assigned variable, referenced variables) of every line, so nothing downstream of an edit is recompiled.
+"""
+
+import hashlib
+import os
+import pickle
+from mathlangplusplus.parser import Code, parse_chunk
+from mathlangplusplus.compiler import Compiler, referenced_variables
+
+CACHE_VERSION = 1  # bump whenever the lexer, parser or compiler output changes
+CACHE_SUFFIX = ".mlcache"
+
+# cache entries are plain tuples, so the cache file stays small and quick to load:
+# (assigned variable name or None if the line holds no statement, referenced variable names, mathlang2 lines)
+EMPTY_LINE = (None, (), ())
+
+def hash_line(line: str) -> str:
+    return hashlib.sha1(line.encode("utf-8")).hexdigest()
+
+class IncrementalCompiler:
+    def __init__(self, cache_filename: str = None):
+        self.cache_filename = cache_filename
+        self.entries = {}  # line hash -> cache entry tuple
+        self.reused_lines = 0
+        self.compiled_lines = 0
+        self.load_cache()
+
+    def load_cache(self):
+        if self.cache_filename is None or not os.path.exists(self.cache_filename):
+            return
+        try:
+            with open(self.cache_filename, "rb") as f:
+                version, entries = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError, ValueError):
+            return  # a corrupt cache is just a cold cache
+        if version == CACHE_VERSION:
+            self.entries = entries
+
+    def save_cache(self):
+        if self.cache_filename is None:
+            return
+        # write to a temporary file first, so an interrupted save never leaves a broken cache
+        temp_filename = self.cache_filename + ".tmp"
+        with open(temp_filename, "wb") as f:
+            pickle.dump((CACHE_VERSION, self.entries), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_filename, self.cache_filename)
+
+    def compile_line_source(self, line: str) -> tuple:
+        statements = parse_chunk(line)
+        if not statements:
+            return EMPTY_LINE
+        lhs, rhs = statements[0]
+        compiler = Compiler(Code())
+        compiler.require_definitions = False  # checked across all lines afterwards
+        compiled = compiler.compile_line(lhs, rhs)
+        return (lhs.data(), tuple(referenced_variables(rhs)), tuple(compiled))
+
+    def compile_source(self, source: str) -> list:
+        entries = {}
+        output = []
+        defined_variables = set()
+
+        for line_number, line in enumerate(source.split("\n"), start=1):
+            line_hash = hash_line(line)
+            entry = entries.get(line_hash) or self.entries.get(line_hash)
+            if entry is None:
+                try:
+                    entry = self.compile_line_source(line)
+                except ValueError as e:
+                    raise ValueError(f"Line {line_number}: {e}") from e
+                self.compiled_lines += 1
+            else:
+                self.reused_lines += 1
+            entries[line_hash] = entry
+
+            assigned, referenced, compiled = entry
+            if assigned is None:
+                continue
+            for variable in referenced:
+                if variable not in defined_variables:
+                    raise ValueError(f"Line {line_number}: Variable {variable} used before definition")
+            defined_variables.add(assigned)
+            output.extend(compiled)
+
+        # only keep the lines of the current version, so the cache does not grow without bound
+        self.entries = entries
+        return output
+
+    def compile_file(self, src_filename: str) -> list:
+        with open(src_filename, "r") as f:
+            source = f.read()
+        output = self.compile_source(source)
+        self.save_cache()
+        return output
+
+def compile_file_incremental(src_filename: str, cache_filename: str = None) -> list:
+    compiler = IncrementalCompiler(cache_filename or src_filename + CACHE_SUFFIX)
+    return compiler.compile_file(src_filename)
+
+
+if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) != 2 and len(sys.argv) != 3:
+        print("Please enter the name of the source file")
+        print("Usage: python3 -m mathlangplusplus.incremental <source_file> <output_file>")
+        sys.exit(1)
+
+    src_filename = sys.argv[1]
+    output_filename = sys.argv[2] if len(sys.argv) == 3 else None
+
+    compiler = IncrementalCompiler(src_filename + CACHE_SUFFIX)
+    compiled_output = compiler.compile_file(src_filename)
+    print(f"Reused {compiler.reused_lines} lines, compiled {compiler.compiled_lines} lines")
+    if output_filename:
+        with open(output_filename, "w") as f:
+            for line in compiled_output:
+                f.write(line + "\n")
+    else:
+        print("Compiled Output:")
+        for line in compiled_output:
+            print(line)
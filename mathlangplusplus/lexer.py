@@ -2,6 +2,7 @@
 
 from abc import ABC, abstractmethod
 import re
+import sys
 
 VAR_NAME_PATTERN = r"^[a-zA-Z_][a-zA-Z0-9_]*$"  # can be split into two parts
 VAR_NAME_START_CHAR_PATTERN = r"[a-zA-Z_]"
@@ -22,6 +23,8 @@ COMMENT_START = "#"
 
 # token types (lexemes): variable, literal, operator, assignment, newline, open_paren, close_paren
 class Token(ABC):
+    __slots__ = ()
+
     @abstractmethod
     def data(self) -> str:
         pass
@@ -33,6 +36,8 @@ class Token(ABC):
         pass
 
 class VariableToken(Token):
+    __slots__ = ("name",)
+
     def __init__(self, name: str):
         self.name = name
     
@@ -47,6 +52,8 @@ class VariableToken(Token):
         return f"VariableToken({self.name})"
 
 class LiteralToken(Token):
+    __slots__ = ("str_value",)
+
     def __init__(self, str_value: str):
         self.str_value = str_value
     
@@ -64,8 +71,21 @@ class LiteralToken(Token):
         return f"LiteralToken({self.str_value})"
 
 class OperatorToken(Token):
-    def __init__(self, operator: str):
-        self.operator = operator
+    __slots__ = ("operator",)
+    _instances = {}  # one shared token per valid operator
+
+    def __new__(cls, operator: str):
+        instance = cls._instances.get(operator)
+        if instance is None:
+            instance = super().__new__(cls)
+            instance.operator = operator
+            if operator in ARITHMETIC_OPERATORS:
+                cls._instances[operator] = instance
+        return instance
+
+    def __reduce__(self):
+        # keep the singletons shared when pickled (e.g. across processes)
+        return (OperatorToken, (self.operator,))
     
     def data(self) -> str:
         return self.operator
@@ -77,7 +97,25 @@ class OperatorToken(Token):
     def __repr__(self):
         return f"OperatorToken({self.operator})"
 
-class AssignmentToken(Token):
+class FixedToken(Token):
+    """
+    Token with fixed content - every instantiation of a subclass returns the same shared object
+    """
+    __slots__ = ()
+
+    def __new__(cls):
+        instance = cls.__dict__.get("_instance")
+        if instance is None:
+            instance = super().__new__(cls)
+            cls._instance = instance
+        return instance
+
+    def __reduce__(self):
+        return (type(self), ())
+
+class AssignmentToken(FixedToken):
+    __slots__ = ()
+
     def data(self) -> str:
         return ASSIGNMENT_CHAR
     
@@ -87,7 +125,9 @@ class AssignmentToken(Token):
     def __repr__(self):
         return f"AssignmentToken({ASSIGNMENT_CHAR})"
 
-class NewlineToken(Token):
+class NewlineToken(FixedToken):
+    __slots__ = ()
+
     def data(self) -> str:
         return NEWLINE_CHAR
     
@@ -97,7 +137,9 @@ class NewlineToken(Token):
     def __repr__(self):
         return "NewlineToken(\\n)"
 
-class OpenParenToken(Token):
+class OpenParenToken(FixedToken):
+    __slots__ = ()
+
     def data(self) -> str:
         return OPEN_PAREN_CHAR
     
@@ -107,7 +149,9 @@ class OpenParenToken(Token):
     def __repr__(self):
         return f"OpenParenToken({OPEN_PAREN_CHAR})"
 
-class CloseParenToken(Token):
+class CloseParenToken(FixedToken):
+    __slots__ = ()
+
     def data(self) -> str:
         return CLOSE_PAREN_CHAR
     
@@ -127,6 +171,9 @@ class Lexer:
     
     def finalize(self):
         if self.current_lexeme is not None:
+            if isinstance(self.current_lexeme, VariableToken):
+                # share one string object per variable name
+                self.current_lexeme.name = sys.intern(self.current_lexeme.name)
             self.tokens.append(self.current_lexeme)
             self.current_lexeme = None
     
@@ -221,18 +268,18 @@ class Lexer:
         return list(self.tokens)
 
 
-def lex_file(src_filename: str) -> list:
+def lex_string(source: str) -> list:
     # return token list
     lexer = Lexer()
-    with open(src_filename, "r") as f:
-        while True:
-            char = f.read(1)
-            if not char:
-                break
-            lexer.add_char(char)
+    for char in source:
+        lexer.add_char(char)
     lexer.add_char(NEWLINE_CHAR)  # ensure final newline
     return lexer.get_completed_tokens()
 
+def lex_file(src_filename: str) -> list:
+    with open(src_filename, "r") as f:
+        return lex_string(f.read())
+
 if __name__ == "__main__":
     import sys
 
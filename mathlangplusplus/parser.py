@@ -46,16 +46,68 @@ def parse_file(src_filename: str) -> Code:
     parser.parse_code(tokens)
     return parser.code
 
+def parse_chunk(source: str) -> list:
+    # lexes and parses a chunk of whole lines, returning its statements
+    parser = Parser()
+    parser.parse_code(lex_string(source))
+    return parser.code.lines
+
+def split_into_chunks(source: str, chunk_count: int) -> list:
+    # statements and comments both end at a newline, so chunks of whole lines are independent
+    chunk_size = max(1, len(source) // chunk_count)
+    chunks = []
+    start = 0
+    while start < len(source):
+        end = source.find(NEWLINE_CHAR, start + chunk_size)
+        end = len(source) if end == -1 else end + 1
+        chunks.append(source[start:end])
+        start = end
+    return chunks
+
+def parse_file_parallel(src_filename: str, max_workers: int = None, chunks_per_worker: int = 4) -> Code:
+    """
+    Lexes and parses the file in chunks across worker processes, merging the statements in order.
+    Define-before-use is not checked here; the compiler checks it in one sequential pass.
+    """
+    # imported here, since they load the standard math module, which this folder's math.py shadows
+    # when one of its files is run as a script
+    import os
+    from concurrent.futures import ProcessPoolExecutor
+
+    with open(src_filename, "r") as f:
+        source = f.read()
+
+    max_workers = max_workers or os.cpu_count() or 1
+    chunks = split_into_chunks(source, max_workers * chunks_per_worker)
+
+    code = Code()
+    if len(chunks) <= 1 or max_workers == 1:
+        for chunk in chunks:
+            code.lines.extend(parse_chunk(chunk))
+        return code
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        for lines in executor.map(parse_chunk, chunks):
+            code.lines.extend(lines)
+    return code
+
 if __name__ == "__main__":
     import sys
 
-    if len(sys.argv) != 2:
+    args = [arg for arg in sys.argv[1:] if arg != "--parallel"]
+    if len(args) != 1:
         print("Please enter the name of the source file")
         print(f"Usage: python3 {sys.argv[0]} <source_file>")
+        print(f"       python3 -m mathlangplusplus.parser <source_file> --parallel")
+        sys.exit(1)
+    if "--parallel" in sys.argv and __spec__ is None:
+        # run as a script, this folder's math.py shadows the standard module which the worker pool imports
+        print("--parallel only works when run as a module:")
+        print(f"python3 -m mathlangplusplus.parser <source_file> --parallel")
         sys.exit(1)
     
-    src_filename = sys.argv[1]
-    code = parse_file(src_filename)
+    src_filename = args[0]
+    code = parse_file_parallel(src_filename) if "--parallel" in sys.argv else parse_file(src_filename)
     print(f"Parsed {len(code.lines)} lines of code.")
 
     for lhs, rhs in code.lines:
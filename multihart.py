@@ -0,0 +1,115 @@
+# Runs one program on several harts (hardware threads), each in its own process, all sharing one guest memory
+
+"""
+The guest memory lives in multiprocessing.shared_memory, so every hart (a VM with its own registers and
+program counter) sees the same data segment, and the harts run truly in parallel rather than taking turns under the GIL.
+Each hart gets its own stack, carved out of the top of memory, and starts at the same entry function
+with a0 set to its hart id and a1 to the number of harts; `hartid rd` also reads the hart id.
+
+Plain loads and stores are not synchronized. Harts which share data should use the atomic instructions
+(amoadd.w, amoswap.w, amoand.w, amoor.w, amoxor.w, and lr.w / sc.w), which all hold one lock shared by the harts.
+"""
+
+import multiprocessing
+import time
+from multiprocessing import shared_memory
+from interpreter import VM, MemoryLayout, DEFAULT_STACK_SIZE
+
+def hart_layout(program, harts, stack_size=DEFAULT_STACK_SIZE) -> MemoryLayout:
+    # the layout's stack covers the stacks of every hart, which sit one below the other
+    return MemoryLayout.for_program(program, stack_size=stack_size * harts)
+
+def attach_hart(program, layout: MemoryLayout, memory, hart_id, harts, lock) -> VM:
+    # a VM for one hart, using memory which already holds the program's data
+    vm = VM(layout=layout)
+    vm.memory = memory
+    vm.hart_id = hart_id
+    vm.atomic_lock = lock
+    vm.load_program(program, lazy=True, copy_data=False)
+    vm.registers.write("sp", layout.stack_top - hart_id * (layout.stack_size // harts))
+    return vm
+
+def run_hart(memory_name, program, layout, hart_id, harts, function_label, lock, results, max_steps):
+    result = { "hart": hart_id, "status": "error", "error": None, "output": "", "steps": 0, "return_value": None }
+    shm = shared_memory.SharedMemory(name=memory_name)
+    memory = shm.buf[:layout.mem_size]
+    vm = None
+    start = time.perf_counter()
+    try:
+        vm = attach_hart(program, layout, memory, hart_id, harts, lock)
+        vm.output_buffer = []
+        vm.call_function(function_label)
+        vm.registers.write("a0", hart_id)
+        vm.registers.write("a1", harts)
+        result["status"] = "halted" if vm.run(max_steps) else "step_limit"
+    except Exception as e:
+        result["error"] = str(e)
+    finally:
+        result["time"] = time.perf_counter() - start
+        if vm is not None:
+            result["output"] = "".join(vm.output_buffer)
+            result["steps"] = vm.step_count
+            result["return_value"] = vm.registers.read("a0")
+            vm.memory = None
+        # every view of the shared memory has to be released before it can be closed
+        memory.release()
+        shm.close()
+        results.put(result)
+
+def run_harts(program, harts, function_label="main", max_steps=None, stack_size=DEFAULT_STACK_SIZE) -> tuple:
+    """
+    Runs function_label on the given number of harts, one process each, until all of them stop.
+    Returns (the result of each hart in hart order, the final contents of memory)
+    """
+    if harts < 1:
+        raise ValueError(f"Need at least one hart, not {harts}")
+    layout = hart_layout(program, harts, stack_size)
+    layout.check_data_fits(len(program.data))
+    shm = shared_memory.SharedMemory(create=True, size=layout.mem_size)
+    try:
+        shm.buf[layout.data_base:layout.data_base + len(program.data)] = bytes(program.data)
+        lock = multiprocessing.Lock()
+        results = multiprocessing.Queue()
+        processes = [
+            multiprocessing.Process(target=run_hart, args=(shm.name, program, layout, hart_id, harts,
+                                                           function_label, lock, results, max_steps))
+            for hart_id in range(harts)
+        ]
+        for process in processes:
+            process.start()
+        # drain the queue before joining, since a process does not exit until its result has been read
+        hart_results = sorted((results.get() for _ in processes), key=lambda result: result["hart"])
+        for process in processes:
+            process.join()
+        memory = bytes(shm.buf[:layout.mem_size])
+    finally:
+        shm.close()
+        shm.unlink()
+    return hart_results, memory
+
+
+if __name__ == "__main__":
+    import sys
+    import parser
+
+    if len(sys.argv) != 3 and len(sys.argv) != 4:
+        print("Please enter the name of the asm file to run, and the number of harts to run it on")
+        print(f"Usage: python3 {sys.argv[0]} <asm_file> <harts> [function]")
+        sys.exit(1)
+
+    program = parser.parse_file(sys.argv[1])
+    harts = int(sys.argv[2])
+    function_label = sys.argv[3] if len(sys.argv) == 4 else "main"
+
+    start = time.perf_counter()
+    hart_results, _ = run_harts(program, harts, function_label)
+    elapsed = time.perf_counter() - start
+
+    for result in hart_results:
+        print(f"Hart {result['hart']}: {result['status']} after {result['steps']} instructions "
+              f"in {result['time']:.3f}s, returning {result['return_value']}")
+        if result["error"]:
+            print(f"  Error: {result['error']}")
+        if result["output"]:
+            print(f"  Output: {result['output']!r}")
+    print(f"Ran {harts} harts in {elapsed:.3f}s")
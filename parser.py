@@ -1,5 +1,8 @@
 # lol
 
+import re
+import struct
+
 MASK_32 = 0xFFFFFFFF
 MASK_16 = 0xFFFF
 MASK_8 = 0xFF
@@ -7,27 +10,41 @@ WORD_SIZE = 4  # 4 bytes for a 32-bit word
 HALF_SIZE = 2  # 2 bytes for a 16-bit half
 BYTE_SIZE = 1  # 1 byte
 
+# everything before a // comment; strings may contain slashes, and \" does not open a string
+CODE_BEFORE_COMMENT_REGEX = re.compile(r'(?:[^"\\/]|\\[^/]?|/(?!/)|"(?:[^"\\]|\\.?)*"?)*', re.DOTALL)
+# a keyword (instruction, directive or label) followed by its operands
+LINE_REGEX = re.compile(r'(\S+)\s*(.*)', re.DOTALL)
+LIST_SEPARATOR_REGEX = re.compile(r'\s*,\s*')
+STRING_ESCAPE_REGEX = re.compile(r'\\(.?)', re.DOTALL)
+STRING_ESCAPES = { "n": "\n", "t": "\t", '"': '"', "\\": "\\", "": "" }
+
+NO_LABELS = ()  # shared placeholder for the (many) lines without labels
+
 def trim_line(line):
     # there are strings, so we need to be careful about comments
-    in_string = False
-    escaped = False
-    for i, char in enumerate(line):
-        if char == '"' and not escaped:
-            in_string = not in_string
-        if char == '\\' and not escaped:
-            escaped = True
-        else:
-            escaped = False
-        if not in_string and char == '/' and i + 1 < len(line) and line[i + 1] == '/':
-            return line[:i].strip()
-    return line.strip()
+    if '"' not in line and '\\' not in line:
+        comment_start = line.find("//")
+        return (line if comment_start == -1 else line[:comment_start]).strip()
+    return CODE_BEFORE_COMMENT_REGEX.match(line).group(0).strip()
+
+def split_list(text):
+    # splits comma-separated operands, dropping empty entries
+    return [i for i in LIST_SEPARATOR_REGEX.split(text.strip()) if len(i) > 0]
+
+def unescape_string(string_content):
+    def replace_escape(match):
+        char = match.group(1)
+        if char not in STRING_ESCAPES:
+            raise ValueError(f"Unknown escape sequence: \\{char}")
+        return STRING_ESCAPES[char]
+    return STRING_ESCAPE_REGEX.sub(replace_escape, string_content)
 
 
 class Parser:
     def __init__(self):
         self.code = []
         self.code_labels = []
-        self.data = []  # bytes
+        self.data = bytearray()
         self.data_labels = []
         self.mode = None  # should be either "code" or "data"
 
@@ -39,15 +56,20 @@ class Parser:
             self.mode = "data"
             return
 
-        kword, *remaining = line.split(" ", 1)
-        remaining_text = remaining[0] if remaining else ""
+        match = LINE_REGEX.match(line)
+        if match is None:
+            return  # blank line
+        kword, remaining_text = match.groups()
 
         if kword.endswith(":"):
             # this line is a label
             label_name = kword[:-1]
             label_list = self.data_labels if self.mode == "data" else self.code_labels
             label_idx = len(self.data if self.mode == "data" else self.code)
-            label_list.extend([] for i in range(label_idx - len(label_list) + 1))  # extend to fit
+            if len(label_list) <= label_idx:
+                # extend to fit, only allocating a list for this line
+                label_list.extend([NO_LABELS] * (label_idx - len(label_list)))
+                label_list.append([])
             label_list[label_idx].append(label_name)  # add the label to this line
             return
 
@@ -56,19 +78,12 @@ class Parser:
             if not self.mode == "data":
                 raise ValueError("Can only declare data in a .data section")
 
-            words = [i.strip() for i in remaining_text.split(",")]
-            words = [i for i in words if len(i) > 0]
+            words = split_list(remaining_text)
             if not words:
                 raise ValueError("No data declared in .word section")
 
-            for word in words:
-                literal_num = int(word, 0) & MASK_32  # autodetects hex, binary too
-                # store via little-endian
-                self.data.append((literal_num >> 0) & MASK_8)
-                self.data.append((literal_num >> 8) & MASK_8)
-                self.data.append((literal_num >> 16) & MASK_8)
-                self.data.append((literal_num >> 24) & MASK_8)
-
+            # autodetects hex, binary too; stored via little-endian
+            self.data += struct.pack(f"<{len(words)}I", *(int(word, 0) & MASK_32 for word in words))
             return
         
         if kword == ".half":
@@ -76,17 +91,11 @@ class Parser:
             if not self.mode == "data":
                 raise ValueError("Can only declare data in a .data section")
 
-            halves = [i.strip() for i in remaining_text.split(",")]
-            halves = [i for i in halves if len(i) > 0]
+            halves = split_list(remaining_text)
             if not halves:
                 raise ValueError("No data declared in .half section")
 
-            for half in halves:
-                literal_num = int(half, 0) & MASK_16  # autodetects hex, binary too
-                # store via little-endian
-                self.data.append((literal_num >> 0) & MASK_8)
-                self.data.append((literal_num >> 8) & MASK_8)
-
+            self.data += struct.pack(f"<{len(halves)}H", *(int(half, 0) & MASK_16 for half in halves))
             return
         
         if kword == ".byte":
@@ -94,15 +103,11 @@ class Parser:
             if not self.mode == "data":
                 raise ValueError("Can only declare data in a .data section")
 
-            bytes_list = [i.strip() for i in remaining_text.split(",")]
-            bytes_list = [i for i in bytes_list if len(i) > 0]
+            bytes_list = split_list(remaining_text)
             if not bytes_list:
                 raise ValueError("No data declared in .byte section")
 
-            for byte in bytes_list:
-                literal_num = int(byte, 0) & MASK_8  # autodetects hex, binary too
-                self.data.append(literal_num)
-
+            self.data += bytes(int(byte, 0) & MASK_8 for byte in bytes_list)
             return
         
         if kword == ".zero":
@@ -110,8 +115,7 @@ class Parser:
             if not self.mode == "data":
                 raise ValueError("Can only declare data in a .data section")
             num_zeros = int(remaining_text.strip(), 0)
-            for _ in range(num_zeros):
-                self.data.append(0)
+            self.data += bytes(num_zeros)
             return
         
         if kword == ".string":
@@ -124,32 +128,11 @@ class Parser:
             if not (remaining_text.startswith('"') and remaining_text.endswith('"')):
                 raise ValueError(".string data must be enclosed in double quotes")
 
-            string_content = remaining_text[1:-1]  # remove quotes
-
-            escaped = False
-            processed_string = ""
-
-            for char in string_content:
-                if escaped:
-                    if char == 'n':
-                        processed_string += '\n'
-                    elif char == 't':
-                        processed_string += '\t'
-                    elif char == '"':
-                        processed_string += '"'
-                    elif char == '\\':
-                        processed_string += '\\'
-                    else:
-                        raise ValueError(f"Unknown escape sequence: \\{char}")
-                    escaped = False
-                else:
-                    if char == '\\':
-                        escaped = True
-                    else:
-                        processed_string += char
-
-            for char in processed_string:
-                self.data.append(ord(char) & MASK_8)
+            processed_string = unescape_string(remaining_text[1:-1])  # remove quotes
+            try:
+                self.data += processed_string.encode("latin-1")
+            except UnicodeEncodeError:
+                self.data += bytes(ord(char) & MASK_8 for char in processed_string)
             self.data.append(0)  # null-terminate the string
 
             return
@@ -159,26 +142,22 @@ class Parser:
             if not self.mode == "data":  # only usable in data section for now
                 raise ValueError("Can only align data in a .data section")
             align_to = int(remaining_text.strip(), 0)
-            current_len = len(self.data)
-            padding_needed = (align_to - (current_len % align_to)) % align_to
-            for _ in range(padding_needed):
-                self.data.append(0)
+            padding_needed = -len(self.data) % align_to
+            self.data += bytes(padding_needed)
             return
 
         # otherwise, must be an asm insn
         if not self.mode == "code":
             raise ValueError("Can only declare insns in a .text section")
 
-        args = [i.strip() for i in remaining_text.split(",")]
-        args = [i for i in args if len(i) > 0]
-        self.code.append((kword, args))
+        self.code.append((kword, split_list(remaining_text)))
 
     def pad_label_list(self):
         # fills the label list with empty values
         for mode in ("data", "code"):
             label_list = self.data_labels if mode == "data" else self.code_labels
             label_idx = len(self.data if mode == "data" else self.code)
-            label_list.extend([] for i in range(label_idx - len(label_list)))
+            label_list.extend([NO_LABELS] * (label_idx - len(label_list)))
 
 
 def parse_lines(lines):
@@ -193,7 +172,7 @@ def print_asm(asm, comment=None, line_num=None, comment_col=32, line_num_col=4):
     header = " " * (line_num_col + 2) if line_num is None else f"{line_num:0{line_num_col}x}  " 
     print(header + asm_line)
 
-def dump_asm(parser):
+def dump_asm(parser, data_start_addr=256):
     print("Code:")
     print("============")
     for i in range(len(parser.code)):
@@ -205,7 +184,6 @@ def dump_asm(parser):
 
     print("\nData:")
     print("============")
-    data_start_addr = 256
     for i in range(len(parser.data)):
         for label in parser.data_labels[i]:
             print_asm(f"{label}:", "data reference label")
@@ -215,13 +193,9 @@ def dump_asm(parser):
 
 def parse_file(filename):
     with open(filename, "r") as file:
-        lines = file.readlines()
-
-    # remove comments and whitespaces
-    lines = [trim_line(line) for line in lines]
-    lines = [line for line in lines if len(line) > 0]
-
-    return parse_lines(lines)
+        # remove comments and whitespaces
+        lines = (trim_line(line) for line in file)
+        return parse_lines(line for line in lines if len(line) > 0)
 
 if __name__ == "__main__":
     import sys
@@ -0,0 +1,228 @@
+# Time-slicing many VMs on one asyncio event loop
+
+"""
+Each guest VM runs for at most a slice of instructions at a time, after which the scheduler picks the next guest
+by stride scheduling: every guest has a pass value which grows by (STRIDE_SCALE / priority) per instruction it runs,
+and the runnable guest with the lowest pass goes next. A guest with priority 2 thus gets twice the instructions of
+a guest with priority 1, and no guest can hold the loop for longer than one slice.
+
+Guests talk to the host through buffers rather than stdin and stdout. A guest whose readc finds no input yet
+(the host has neither fed more input nor closed it), or whose printc finds its output buffer full,
+leaves the run queue until the host feeds input or drains output, so blocked guests cost nothing.
+The blocked instruction has not yet done anything at that point, so it simply runs again when the guest resumes.
+Guests run unfused, since a superinstruction could not be resumed halfway through.
+"""
+
+import asyncio
+import heapq
+import itertools
+import time
+from interpreter import VM
+
+DEFAULT_SLICE_STEPS = 1000
+STRIDE_SCALE = 1 << 16
+OUTPUT_LIMIT = 4096  # characters a guest may print before the host has to read them
+
+class InputPending(Exception):
+    pass
+
+class OutputFull(Exception):
+    pass
+
+class Guest(VM):
+    """
+    A VM run by a Scheduler, with its host I/O, scheduling parameters and counters
+    """
+    def __init__(self, name, priority=1, quota=None, output_limit=OUTPUT_LIMIT, **kwargs):
+        super().__init__(**kwargs)
+        if priority <= 0:
+            raise ValueError(f"Priority must be positive, not {priority}")
+        self.name = name
+        self.priority = priority
+        self.quota = quota  # the most instructions the guest may run, or None
+        self.output_buffer = []
+        self.output_limit = output_limit
+        self.input_closed = False
+        self.scheduler = None
+        self.status = "runnable"  # runnable, blocked_input, blocked_output, halted, quota_exceeded or error
+        self.error = None
+        self.pass_value = 0
+        self.slices = 0
+        self.wait_time = 0.0  # seconds spent runnable but waiting for a slice
+        self.runnable_since = None
+        self.finished = None  # a future, resolved with the status once the guest stops for good
+        self.output_available = None  # an event, set once a slice leaves output behind or the guest stops
+
+    def read_char(self):
+        if self.input_position >= len(self.input_buffer) and not self.input_closed:
+            raise InputPending()
+        return super().read_char()
+
+    def print_char(self, data):
+        if len(self.output_buffer) >= self.output_limit:
+            raise OutputFull()
+        super().print_char(data)
+
+    # host side
+
+    def feed_input(self, data: bytes):
+        self.input_buffer = self.input_buffer[self.input_position:] + data
+        self.input_position = 0
+        if self.status == "blocked_input":
+            self.scheduler.wake(self)
+
+    def close_input(self):
+        # readc returns -1 from now on, once the buffered input is used up
+        self.input_closed = True
+        if self.status == "blocked_input":
+            self.scheduler.wake(self)
+
+    def take_output(self) -> str:
+        output = "".join(self.output_buffer)
+        self.output_buffer.clear()
+        if self.status == "blocked_output":
+            self.scheduler.wake(self)
+        return output
+
+    async def read_output(self) -> str:
+        # waits for the guest to print something, returning "" once it has stopped and all output was read
+        if not self.output_buffer and not self.finished.done():
+            self.output_available.clear()
+            await self.output_available.wait()
+        return self.take_output()
+
+    def counters(self) -> dict:
+        return {
+            "name": self.name,
+            "status": self.status,
+            "instructions": self.step_count,
+            "slices": self.slices,
+            "wait_time": self.wait_time,
+        }
+
+class Scheduler:
+    def __init__(self, slice_steps=DEFAULT_SLICE_STEPS):
+        self.slice_steps = slice_steps
+        self.guests = []
+        self.run_queue = []  # heap of (pass value, tie breaker, guest)
+        self.tie_breaker = itertools.count()
+        self.global_pass = 0  # the pass value of the guest which ran last
+        self.queue_changed = None  # set whenever a guest becomes runnable, so an idle loop wakes up
+        self.unfinished = 0
+
+    def add(self, guest: Guest, function_label="main") -> Guest:
+        # the guest's program must already be loaded, plainly (not fused)
+        guest.call_function(function_label)
+        guest.scheduler = self
+        guest.finished = asyncio.get_running_loop().create_future()
+        guest.output_available = asyncio.Event()
+        self.guests.append(guest)
+        self.unfinished += 1
+        self.wake(guest)
+        return guest
+
+    def wake(self, guest: Guest):
+        # a guest rejoining the queue starts from the current pass, rather than catching up for the time it was blocked
+        guest.status = "runnable"
+        guest.pass_value = max(guest.pass_value, self.global_pass)
+        guest.runnable_since = time.perf_counter()
+        heapq.heappush(self.run_queue, (guest.pass_value, next(self.tie_breaker), guest))
+        if self.queue_changed is not None:
+            self.queue_changed.set()
+
+    def finish(self, guest: Guest, status, error=None):
+        guest.status = status
+        guest.error = error
+        if not guest.finished.done():
+            guest.finished.set_result(status)
+            self.unfinished -= 1
+        guest.output_available.set()
+
+    def run_slice(self, guest: Guest):
+        now = time.perf_counter()
+        guest.wait_time += now - guest.runnable_since
+        guest.slices += 1
+        steps = self.slice_steps
+        if guest.quota is not None:
+            steps = min(steps, guest.quota - guest.step_count)
+        start_count = guest.step_count
+        halted, blocked_status, error = False, None, None
+        try:
+            halted = guest.run(steps)
+        except InputPending:
+            blocked_status = "blocked_input"
+        except OutputFull:
+            blocked_status = "blocked_output"
+        except Exception as e:
+            error = str(e)
+
+        # charge the guest for what it actually ran, so blocking early does not cost a whole slice
+        guest.pass_value += (guest.step_count - start_count + 1) * STRIDE_SCALE // guest.priority
+        self.global_pass = guest.pass_value
+        if guest.output_buffer:
+            guest.output_available.set()
+
+        if error is not None:
+            self.finish(guest, "error", error)
+        elif halted:
+            self.finish(guest, "halted")
+        elif blocked_status is not None:
+            guest.status = blocked_status
+        elif guest.quota is not None and guest.step_count >= guest.quota:
+            self.finish(guest, "quota_exceeded")
+        else:
+            self.wake(guest)
+
+    async def run(self):
+        # runs until every guest has halted or failed, yielding to the event loop after each slice
+        self.queue_changed = asyncio.Event()
+        while self.unfinished > 0:
+            if not self.run_queue:
+                self.queue_changed.clear()
+                await self.queue_changed.wait()  # every guest is blocked on the host
+                continue
+            _, _, guest = heapq.heappop(self.run_queue)
+            self.run_slice(guest)
+            await asyncio.sleep(0)
+
+
+if __name__ == "__main__":
+    import sys
+    import parser
+    from interpreter import MemoryLayout
+
+    if len(sys.argv) < 2:
+        print("Please enter the names of the asm files to run concurrently, optionally as <file>:<priority>")
+        print(f"Usage: python3 {sys.argv[0]} <asm_file>[:priority] ...")
+        sys.exit(1)
+
+    async def main():
+        scheduler = Scheduler()
+        guests = []
+        for arg in sys.argv[1:]:
+            filename, _, priority = arg.partition(":")
+            program = parser.parse_file(filename)
+            guest = Guest(arg, priority=int(priority or 1), layout=MemoryLayout.for_program(program))
+            guest.load_program(program)
+            guest.close_input()
+            guests.append(scheduler.add(guest))
+
+        async def drain(guest):
+            # the host side of each guest: collect its output until it stops
+            output = []
+            while True:
+                chunk = await guest.read_output()
+                if not chunk and guest.finished.done():
+                    return "".join(output)
+                output.append(chunk)
+
+        outputs = await asyncio.gather(scheduler.run(), *[drain(guest) for guest in guests])
+        for guest, output in zip(guests, outputs[1:]):
+            counters = guest.counters()
+            print(f"{guest.name}: {counters['status']} after {counters['instructions']} instructions "
+                  f"in {counters['slices']} slices, waited {counters['wait_time'] * 1000:.1f}ms")
+            if guest.error:
+                print(f"  Error: {guest.error}")
+            print(f"  Output: {output!r}")
+
+    asyncio.run(main())
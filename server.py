@@ -0,0 +1,312 @@
+# A persistent VM server, which keeps programs loaded between runs
+
+"""
+Running a program with interpreter.py pays for starting Python, importing the VM,
+parsing the asm and decoding every instruction, which for short programs costs far more than running them.
+The server pays for all of that once: it keeps each program it has seen (and every object file it links in)
+parsed and decoded, keyed by the sha256 of its source, and each run only needs a fresh VM.
+
+Clients talk to it over a Unix domain socket, one JSON object per line. Each request is answered by
+one or more JSON lines, so the output of a long run is streamed back while it is still running:
+    {"op": "load", "source": "...", "link": [...]}        -> {"program": <hash>}
+    {"op": "run", "program": <hash> or "source": "...",
+     "link": [...], "entry": "main", "input": "...", "max_steps": N}
+                                                          -> {"output": "..."} ... then
+                                                             {"status": "halted" | "step_limit" | "error",
+                                                              "steps": N, "registers": {...}, "time": seconds}
+    {"op": "stats"}                                       -> the throughput and latency counters
+Requests which fail before running answer {"error": "..."}.
+
+The names in "link" are relative to the server's library directory, and may not lead outside it:
+object files are unpickled, so the server only opens those its operator put there.
+Without a library directory, requests cannot link anything. The socket is only accessible to its owner.
+"""
+
+import hashlib
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+import linker
+from interpreter import VM, MemoryLayout, REGISTERS
+
+STREAM_STEPS = 10000  # instructions run between checks for output to stream back
+DEFAULT_WORKERS = 4
+
+def program_hash(source: str, link_filenames=()) -> str:
+    # the objects linked in are part of the program, so they (and when they last changed) are part of its hash
+    link_stamps = [f"{name}@{os.path.getmtime(name)}" for name in link_filenames]
+    return hashlib.sha256("\0".join([source] + link_stamps).encode("utf-8")).hexdigest()
+
+class CachedProgram:
+    """
+    A linked program along with its memory layout and decoded instructions.
+    The decoded closures only depend on the program's labels, so every VM running the program can share them
+    """
+    def __init__(self, program):
+        self.program = program
+        self.layout = MemoryLayout.for_program(program)
+        decoder = VM(layout=self.layout)
+        decoder.load_program(program)
+        self.code = decoder.code
+
+    def new_vm(self) -> VM:
+        vm = VM(layout=self.layout)
+        vm.load_program(self.program, lazy=True)  # copies the data segment and labels, without decoding
+        vm.code = list(self.code)
+        return vm
+
+class Counters:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start_time = time.monotonic()
+        self.requests = 0
+        self.runs = 0
+        self.errors = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.steps = 0
+        self.run_time = 0.0  # total seconds spent serving run requests
+        self.max_run_time = 0.0
+
+    def add(self, **amounts):
+        with self.lock:
+            for name, amount in amounts.items():
+                setattr(self, name, getattr(self, name) + amount)
+
+    def record_run(self, steps, elapsed, failed):
+        with self.lock:
+            self.runs += 1
+            self.errors += failed
+            self.steps += steps
+            self.run_time += elapsed
+            self.max_run_time = max(self.max_run_time, elapsed)
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            uptime = time.monotonic() - self.start_time
+            return {
+                "uptime": uptime,
+                "requests": self.requests,
+                "runs": self.runs,
+                "errors": self.errors,
+                "cache_hits": self.cache_hits,
+                "cache_misses": self.cache_misses,
+                "steps": self.steps,
+                "runs_per_second": self.runs / uptime if uptime > 0 else 0.0,
+                "mean_latency": self.run_time / self.runs if self.runs else 0.0,
+                "max_latency": self.max_run_time,
+            }
+
+class VMServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, workers=DEFAULT_WORKERS, library_dir=None):
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)  # left behind by a previous server
+        super().__init__(socket_path, RequestHandler)
+        self.socket_path = socket_path
+        self.library_dir = os.path.realpath(library_dir) if library_dir is not None else None
+        self.workers = threading.BoundedSemaphore(workers)  # at most this many programs run at once
+        self.cache_lock = threading.Lock()
+        self.programs = {}  # program hash -> CachedProgram
+        self.objects = {}  # object file name -> (modification time, ObjectFile)
+        self.counters = Counters()
+
+    def server_bind(self):
+        # any client may run code, so only the owner may connect: the socket is created without group or other
+        # permissions, rather than changed after binding, which would leave a moment when anyone could connect
+        old_umask = os.umask(0o177)
+        try:
+            super().server_bind()
+        finally:
+            os.umask(old_umask)
+
+    def resolve_link(self, name) -> str:
+        # the path of an object file in the library directory, refusing anything outside it
+        if self.library_dir is None:
+            raise ValueError("This server has no library directory to link from")
+        filename = os.path.realpath(os.path.join(self.library_dir, name))
+        if os.path.commonpath([self.library_dir, filename]) != self.library_dir:
+            raise ValueError(f"Not in the library directory: {name}")
+        return filename
+
+    def load_object(self, filename):
+        # object files are reloaded whenever they change on disk
+        mtime = os.path.getmtime(filename)
+        with self.cache_lock:
+            cached = self.objects.get(filename)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        obj = linker.load_object_or_asm(filename)
+        with self.cache_lock:
+            self.objects[filename] = (mtime, obj)
+        return obj
+
+    def load_program(self, source, link_names=()) -> str:
+        link_filenames = [self.resolve_link(name) for name in link_names]
+        key = program_hash(source, link_filenames)
+        with self.cache_lock:
+            if key in self.programs:
+                self.counters.add(cache_hits=1)
+                return key
+        self.counters.add(cache_misses=1)
+        obj = linker.assemble_lines(source.split("\n"))
+        if link_filenames:
+            program = linker.link([self.load_object(name) for name in link_filenames] + [obj])
+        else:
+            program = obj.program
+        cached = CachedProgram(program)
+        with self.cache_lock:
+            self.programs.setdefault(key, cached)
+        return key
+
+    def find_program(self, request) -> CachedProgram:
+        if "source" in request:
+            key = self.load_program(request["source"], request.get("link", []))
+        else:
+            key = request.get("program")
+            if key not in self.programs:
+                raise ValueError(f"Unknown program: {key}, load it first")
+            self.counters.add(cache_hits=1)
+        return self.programs[key]
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def send(self, message: dict):
+        self.wfile.write((json.dumps(message) + "\n").encode("utf-8"))
+        self.wfile.flush()
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            self.server.counters.add(requests=1)
+            try:
+                request = json.loads(line)
+                op = request.get("op", "run")
+                if op == "run":
+                    self.run(request)
+                elif op == "load":
+                    self.send({ "program": self.server.load_program(request["source"], request.get("link", [])) })
+                elif op == "stats":
+                    self.send(self.server.counters.snapshot())
+                else:
+                    raise ValueError(f"Unknown op: {op}")
+            except (ValueError, KeyError, OSError) as e:
+                self.server.counters.add(errors=1)
+                self.send({ "error": str(e) })
+
+    def run(self, request):
+        cached = self.server.find_program(request)
+        max_steps = request.get("max_steps")
+        with self.server.workers:
+            start = time.perf_counter()
+            vm = cached.new_vm()
+            vm.input_buffer = request.get("input", "").encode("utf-8")
+            vm.output_buffer = []
+            status, error = "step_limit", None
+            try:
+                vm.call_function(request.get("entry", "main"))
+                while True:
+                    slice_steps = STREAM_STEPS if max_steps is None else min(STREAM_STEPS, max_steps - vm.step_count)
+                    halted = vm.run(slice_steps)
+                    if vm.output_buffer:
+                        self.send({ "output": "".join(vm.output_buffer) })
+                        vm.output_buffer.clear()
+                    if halted:
+                        status = "halted"
+                        break
+                    if max_steps is not None and vm.step_count >= max_steps:
+                        break
+            except Exception as e:
+                status, error = "error", str(e)
+                if vm.output_buffer:
+                    self.send({ "output": "".join(vm.output_buffer) })
+            elapsed = time.perf_counter() - start
+        self.server.counters.record_run(vm.step_count, elapsed, status == "error")
+        self.send({
+            "status": status,
+            "error": error,
+            "steps": vm.step_count,
+            "registers": { reg: vm.registers.read(reg) for reg in REGISTERS },
+            "time": elapsed,
+        })
+
+def request(socket_path, message: dict):
+    # sends one request to a running server, yielding each line of its answer
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        sock.sendall((json.dumps(message) + "\n").encode("utf-8"))
+        sock.shutdown(socket.SHUT_WR)
+        with sock.makefile("r", encoding="utf-8") as answer:
+            for line in answer:
+                yield json.loads(line)
+
+
+if __name__ == "__main__":
+    import sys
+
+    args = sys.argv[1:]
+    def pop_option_values(flag):
+        # removes every "<flag> <value>" pair from the arguments, returning the values
+        values = []
+        while flag in args:
+            idx = args.index(flag)
+            if idx + 1 >= len(args):
+                print(f"{flag} must be followed by a value")
+                sys.exit(1)
+            values.append(args[idx + 1])
+            del args[idx:idx + 2]
+        return values
+
+    worker_counts = pop_option_values("--workers")
+    library_dirs = pop_option_values("--library")
+    link_names = pop_option_values("--link")  # relative to the server's library directory
+    input_filenames = pop_option_values("--input")
+
+    if len(args) < 2 or args[0] not in ("serve", "run", "stats") or (args[0] == "run" and len(args) < 3):
+        print("Please enter a command and the server's socket")
+        print(f"Usage: python3 {sys.argv[0]} serve <socket> [--workers N] [--library <dir>]")
+        print(f"       python3 {sys.argv[0]} run <socket> <asm_file> [function] [--link <library file>] [--input <file>]")
+        print(f"       python3 {sys.argv[0]} stats <socket>")
+        sys.exit(1)
+
+    command, socket_path = args[0], args[1]
+    if command == "serve":
+        import signal
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))  # so the socket is still cleaned up
+        workers = int(worker_counts[-1]) if worker_counts else DEFAULT_WORKERS
+        library_dir = library_dirs[-1] if library_dirs else None
+        with VMServer(socket_path, workers, library_dir) as server:
+            print(f"Serving on {socket_path} with {workers} workers")
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+    elif command == "stats":
+        for answer in request(socket_path, { "op": "stats" }):
+            for name, value in answer.items():
+                print(f"{name}: {value}")
+    else:
+        with open(args[2], "r") as f:
+            source = f.read()
+        input_text = ""
+        for input_filename in input_filenames:
+            with open(input_filename, "r") as f:
+                input_text += f.read()
+        message = { "op": "run", "source": source, "link": link_names, "input": input_text }
+        if len(args) > 3:
+            message["entry"] = args[3]
+        for answer in request(socket_path, message):
+            if "output" in answer:
+                print(answer["output"], end="", flush=True)
+            elif answer.get("error"):
+                print(f"\nError: {answer['error']}")
+                sys.exit(1)
@@ -0,0 +1,285 @@
+# Load-time fusion of common instruction sequences into superinstructions
+
+"""
+Every instruction normally costs one trip through the VM's dispatch loop.
+Fusion replaces the closure in slot i with a superinstruction, which runs the whole sequence
+starting at i (two or three instructions) in a single dispatch.
+The other slots of the sequence keep their own closures (or start sequences of their own),
+so jumping into the middle of a fused sequence still runs exactly the same instructions.
+Only the last instruction of a sequence may change control flow.
+A load or store after the first instruction of a sequence first sets the program counter to its own slot,
+so if it faults, the VM is left in the same state as unfused execution would leave it.
+
+Which sequences are fused is driven by a list of patterns. Each element of a pattern is either
+an instruction kind (see instruction_kind) or a mnemonic, so a profile of the mnemonic pairs
+a program actually runs can be turned into extra patterns.
+"""
+
+import json
+from collections import Counter
+from interpreter import OPCODES, MASK_8, MASK_32, code_label_locator, parse_address
+
+# the hot sequences of the asm generated by the mathlang compiler and its library, longest first
+STATIC_PATTERNS = [
+    ("alu", "alu", "branch"),  # e.g. addi a0, a0, 1; slti a1, a0, 10; bne a1, zero, 0b
+    ("store", "alu", "jal"),  # e.g. sb 0(a1), a2; addi a1, a1, 1; jal zero, 0b
+    ("alu", "branch"),  # compare and branch
+    ("alu", "jal"),  # loop step, e.g. addi a1, a1, -1; jal zero, 0b
+    ("alu", "alu"),  # e.g. addi a3, zero, 10; rem a2, a0, a3
+    ("load", "printc"),  # e.g. lb a3, 12(sp); printc a3
+    ("load", "branch"),  # e.g. lbu a1, 0(a0); beq a1, zero, 1f
+    ("alu", "printc"),
+    ("load", "load"),
+    ("store", "store"),
+]
+
+FUSABLE_FORMATS = ("none", "printc", "load", "store", "la", "branch", "jal", "jalr")
+
+def instruction_kind(instr, args):
+    # the kind names which patterns use, or None for instructions which are never fused
+    spec = OPCODES.get(instr)
+    if spec is None or (instr == "xor" and args == ["zero", "zero", "zero"]):
+        return None  # unknown instructions are left for the decoder to report, and the debug insn stays alone
+    if spec.fmt in ("r", "i"):
+        return "alu"
+    if spec.fmt not in FUSABLE_FORMATS:
+        return None  # such as readc, which the superinstructions do not implement
+    return spec.fmt
+
+def do_nothing(vm):
+    pass
+
+def make_body(instr, args, vm):
+    # the effect of a straight-line instruction, without touching the program counter.
+    # registers are accessed directly, since every value in the register file is already masked
+    spec = OPCODES[instr]
+    op = spec.semantics
+    if spec.fmt == "r":
+        dest_reg, src_reg1, src_reg2 = args[0], args[1], args[2]
+        if dest_reg == "zero":
+            return do_nothing
+        def body(vm):
+            regs = vm.registers.regs
+            regs[dest_reg] = op(regs[src_reg1], regs[src_reg2]) & MASK_32
+    elif spec.fmt == "i":
+        dest_reg, src_reg, immediate = args[0], args[1], int(args[2], 0)
+        if dest_reg == "zero":
+            return do_nothing
+        def body(vm):
+            regs = vm.registers.regs
+            regs[dest_reg] = op(regs[src_reg], immediate) & MASK_32
+    elif spec.fmt == "load":
+        dest_reg = args[0]
+        offset, base_reg = parse_address(args[1], "lw")
+        def body(vm):
+            regs = vm.registers.regs
+            value = op(vm, (regs[base_reg] + offset) & MASK_32) & MASK_32  # may still fault when discarded
+            if dest_reg != "zero":
+                regs[dest_reg] = value
+    elif spec.fmt == "store":
+        offset, base_reg = parse_address(args[0], "sw")
+        src_reg = args[1]
+        def body(vm):
+            regs = vm.registers.regs
+            op(vm, (regs[base_reg] + offset) & MASK_32, regs[src_reg])
+    elif spec.fmt == "printc":
+        src_reg = args[0]
+        def body(vm):
+            vm.print_char(vm.registers.regs[src_reg] & MASK_8)
+    elif spec.fmt == "la":
+        dest_reg = args[0]
+        if args[1] not in vm.data_labels:
+            raise ValueError(f"Label '{args[1]}' not found")
+        address = vm.data_labels[args[1]]
+        if dest_reg == "zero":
+            return do_nothing
+        def body(vm):
+            vm.registers.regs[dest_reg] = address & MASK_32
+    elif spec.fmt == "none":
+        return do_nothing
+    else:
+        raise ValueError(f"Cannot fuse control flow instruction: {instr}")
+    return body
+
+def make_faulting_body(body, pc, completed):
+    # a memory access after the start of a sequence, which may fault: it reports its own program counter,
+    # and counts the instructions the sequence already ran, so a fault leaves the VM as unfused execution would
+    def faulting_body(vm):
+        vm.program_counter = pc
+        try:
+            body(vm)
+        except Exception:
+            vm.step_count += completed
+            raise
+    return faulting_body
+
+def make_tail(instr, args, vm, idx, next_pc):
+    # the control flow instruction ending a sequence, at index idx
+    spec = OPCODES[instr]
+    if spec.fmt == "branch":
+        src_reg1, src_reg2 = args[0], args[1]
+        target = code_label_locator(vm, idx)(args[2])
+        condition = spec.semantics
+        def tail(vm):
+            regs = vm.registers.regs
+            if condition(regs[src_reg1], regs[src_reg2]):
+                vm.program_counter = target
+            else:
+                vm.program_counter = next_pc
+    elif spec.fmt == "jal":
+        dest_reg = args[0]
+        target = code_label_locator(vm, idx)(args[1])
+        def tail(vm):
+            if dest_reg != "zero":
+                vm.registers.regs[dest_reg] = next_pc
+            vm.program_counter = target
+    elif spec.fmt == "jalr":
+        dest_reg, base_reg = args[0], args[1]
+        target_offset = int(args[2] if len(args) > 2 else "0", 0)
+        def tail(vm):
+            regs = vm.registers.regs
+            target_address = (regs[base_reg] + target_offset) & MASK_32
+            if dest_reg != "zero":
+                regs[dest_reg] = next_pc
+            vm.program_counter = target_address
+    else:
+        raise ValueError(f"Not a control flow instruction: {instr}")
+    return tail
+
+def make_superinstruction(vm, idx, length):
+    instructions = vm.program.code[idx:idx + length]
+    next_pc = idx + length
+    last_instr, last_args = instructions[-1]
+    if OPCODES[last_instr].is_branch:
+        bodies = [make_body(instr, args, vm) for instr, args in instructions[:-1]]
+        tail = make_tail(last_instr, last_args, vm, next_pc - 1, next_pc)
+    else:
+        bodies = [make_body(instr, args, vm) for instr, args in instructions]
+        tail = None
+    for offset, (instr, _) in enumerate(instructions[1:len(bodies)], start=1):
+        if OPCODES[instr].fmt in ("load", "store"):
+            bodies[offset] = make_faulting_body(bodies[offset], idx + offset, offset)
+
+    # unrolled for the common lengths, since every saved call counts here.
+    # the run loop counts one instruction per dispatch, so each superinstruction adds the rest itself
+    extra_steps = length - 1
+    if tail is None and len(bodies) == 2:
+        first, second = bodies
+        def superinstruction(vm):
+            first(vm)
+            second(vm)
+            vm.program_counter = next_pc
+            vm.step_count += extra_steps
+    elif tail is None:
+        def superinstruction(vm):
+            for body in bodies:
+                body(vm)
+            vm.program_counter = next_pc
+            vm.step_count += extra_steps
+    elif len(bodies) == 1:
+        first = bodies[0]
+        def superinstruction(vm):
+            first(vm)
+            tail(vm)
+            vm.step_count += extra_steps
+    elif len(bodies) == 2:
+        first, second = bodies
+        def superinstruction(vm):
+            first(vm)
+            second(vm)
+            tail(vm)
+            vm.step_count += extra_steps
+    else:
+        def superinstruction(vm):
+            for body in bodies:
+                body(vm)
+            tail(vm)
+            vm.step_count += extra_steps
+    superinstruction.length = length  # how many instructions one dispatch runs
+    superinstruction.single = vm.decode_instruction(idx, *instructions[0])  # the first instruction on its own
+    return superinstruction
+
+def matches(program_code, idx, pattern) -> bool:
+    if idx + len(pattern) > len(program_code):
+        return False
+    for offset, element in enumerate(pattern):
+        instr, args = program_code[idx + offset]
+        kind = instruction_kind(instr, args)
+        if kind is None or element not in (kind, instr):
+            return False
+        if offset < len(pattern) - 1 and OPCODES[instr].is_branch:
+            return False  # only the last instruction may leave the sequence
+    return True
+
+def fuse_program(vm, patterns=STATIC_PATTERNS) -> int:
+    """
+    Replaces every slot of the loaded program which starts a pattern with a superinstruction,
+    trying the patterns in order. Returns the number of slots fused.
+    """
+    program_code = vm.program.code
+    fused = 0
+    for idx in range(len(program_code)):
+        for pattern in patterns:
+            if matches(program_code, idx, pattern):
+                vm.code[idx] = make_superinstruction(vm, idx, len(pattern))
+                fused += 1
+                break
+    return fused
+
+def profile_pairs(vm) -> Counter:
+    # runs the loaded program to completion, counting each pair of mnemonics executed back to back
+    program_code = vm.program.code
+    counts = Counter()
+    previous_pc = None
+    while vm.program_counter != 0xFFFFFFFF:
+        pc = vm.program_counter
+        if previous_pc is not None and pc == previous_pc + 1:
+            counts[(program_code[previous_pc][0], program_code[pc][0])] += 1
+        vm.interpret_step()
+        previous_pc = pc
+    return counts
+
+def patterns_from_profile(counts: Counter, min_share=0.01) -> list:
+    # every fusable pair which makes up at least min_share of the profiled pairs
+    total = sum(counts.values())
+    patterns = []
+    for (first, second), count in counts.most_common():
+        if count < total * min_share:
+            break
+        if first in OPCODES and second in OPCODES and not OPCODES[first].is_branch:
+            patterns.append((first, second))
+    return patterns
+
+def save_profile(counts: Counter, filename: str):
+    with open(filename, "w") as f:
+        json.dump([[first, second, count] for (first, second), count in counts.most_common()], f)
+
+def load_profile(filename: str) -> Counter:
+    with open(filename, "r") as f:
+        return Counter({ (first, second): count for first, second, count in json.load(f) })
+
+
+if __name__ == "__main__":
+    import sys
+    import io
+    import contextlib
+    import parser
+    from interpreter import VM, MemoryLayout
+
+    if len(sys.argv) != 3:
+        print("Please enter the name of the asm file to profile, and the profile file to write")
+        print(f"Usage: python3 {sys.argv[0]} <asm_file> <profile_file>")
+        sys.exit(1)
+
+    asm_parser = parser.parse_file(sys.argv[1])
+    vm = VM(layout=MemoryLayout.for_program(asm_parser))
+    vm.load_program(asm_parser)
+    vm.call_function("main")
+    with contextlib.redirect_stdout(io.StringIO()):  # only the profile is of interest
+        counts = profile_pairs(vm)
+    save_profile(counts, sys.argv[2])
+
+    total = sum(counts.values())
+    print(f"Profiled {total} instruction pairs, the most common being:")
+    for (first, second), count in counts.most_common(10):
+        print(f"  {first} -> {second}: {count} ({100 * count / total:.1f}%)")
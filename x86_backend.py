@@ -0,0 +1,467 @@
+# Lowers a loaded VM program into native x86-64 machine code
+
+"""
+Every VM instruction is translated into a short x86-64 sequence, and branches and jumps
+go straight to the native code of their target, so loops run without any dispatch at all.
+The guest registers and the program counter live in a NativeState structure,
+and guest memory is the VM's own memory array, which the native code reads and writes in place.
+
+Anything the native code cannot (or should not) do itself traps back to Python,
+with the program counter on the instruction, which the VM then runs as usual:
+printc and the debug insn, instructions the backend does not know (such as newly registered opcodes),
+and any memory access which is misaligned or out of bounds, so it raises exactly the same error.
+The native code also returns to Python every so often (its fuel, counted in control flow instructions),
+so a runaway guest loop can still be interrupted.
+
+All arithmetic matches the interpreter bit for bit: 32-bit wraparound, truncating signed division,
+0xFFFFFFFF for division or remainder by zero, INT_MIN / -1, and shift amounts of 32 or more.
+"""
+
+import ctypes
+import mmap
+import platform
+from interpreter import OPCODES, MASK_32, code_label_locator, parse_address
+
+HALT_PC = 0xFFFFFFFF
+NATIVE_REGISTERS = [ "zero", "sp", "a0", "a1", "a2", "a3", "ra" ]  # guest registers the native code can access
+FUEL_PER_ENTRY = 1 << 20  # control flow instructions between returns to Python
+
+# why the native code returned to Python
+EXIT_JUMP = 0  # the program counter left the code: either halted, or out of bounds
+EXIT_TRAP = 1  # the instruction at the program counter has to be run by the VM
+EXIT_FUEL = 2  # out of fuel, the program counter is the next instruction to run
+
+# x86-64 registers
+RAX, RCX, RDX, RBX, RSP, RBP, RSI, RDI = range(8)
+R8, R9, R10, R11, R12, R13, R14, R15 = range(8, 16)
+# rbx holds the NativeState, r12 the guest memory, r13 the remaining fuel and r14 the memory size
+
+# condition codes
+CC_B, CC_AE, CC_E, CC_NE, CC_BE, CC_A, CC_S = 0x2, 0x3, 0x4, 0x5, 0x6, 0x7, 0x8
+CC_L, CC_GE = 0xC, 0xD
+
+class NativeState(ctypes.Structure):
+    _fields_ = [
+        ("regs", ctypes.c_uint32 * len(NATIVE_REGISTERS)),
+        ("pc", ctypes.c_uint32),
+        ("mem_size", ctypes.c_uint32),
+        ("fuel", ctypes.c_int64),
+        ("mem", ctypes.c_void_p),
+    ]
+
+class Mem:
+    # a memory operand: [base + disp], or [base + index * scale]
+    def __init__(self, base, disp=0, index=None, scale=1):
+        self.base = base
+        self.disp = disp
+        self.index = index
+        self.scale = scale
+
+    def encode(self, reg_field):
+        # returns the ModRM byte and everything after it, and the REX.X and REX.B bits
+        if self.index is None:
+            modrm = bytes([0x80 | reg_field << 3 | (self.base & 7)])  # mod=10: disp32
+            sib = b"\x24" if self.base & 7 == RSP else b""  # rsp and r12 always need a SIB byte
+            return modrm + sib + (self.disp & MASK_32).to_bytes(4, "little"), 0, self.base >> 3
+        if self.base & 7 == RBP or self.disp != 0:
+            raise ValueError("Indexed operands only support a base other than rbp/r13, without displacement")
+        scale_bits = { 1: 0, 2: 1, 4: 2, 8: 3 }[self.scale]
+        modrm = bytes([reg_field << 3 | 0x4])  # mod=00, with a SIB byte
+        sib = bytes([scale_bits << 6 | (self.index & 7) << 3 | (self.base & 7)])
+        return modrm + sib, self.index >> 3, self.base >> 3
+
+def imm32(value):
+    return (value & MASK_32).to_bytes(4, "little")
+
+class X86Assembler:
+    def __init__(self):
+        self.code = bytearray()
+        self.labels = {}  # label -> offset
+        self.fixups = []  # (offset of a rel32 field, label)
+
+    def label(self, name):
+        self.labels[name] = len(self.code)
+
+    def mark(self):
+        return len(self.code), len(self.fixups)
+
+    def rollback(self, mark):
+        # forget everything emitted since mark
+        code_length, fixup_count = mark
+        del self.code[code_length:]
+        del self.fixups[fixup_count:]
+
+    def rel32(self, label):
+        self.fixups.append((len(self.code), label))
+        self.code += b"\0\0\0\0"
+
+    def instr(self, opcode: bytes, reg, rm, wide=False, prefix=b"", imm=b""):
+        # an instruction with a ModRM operand; rm is a register number or a Mem
+        rex = 0x48 if wide else 0x40
+        rex |= (reg >> 3) << 2
+        if isinstance(rm, Mem):
+            modrm, rex_x, rex_b = rm.encode(reg & 7)
+            rex |= rex_x << 1 | rex_b
+        else:
+            modrm = bytes([0xC0 | (reg & 7) << 3 | (rm & 7)])
+            rex |= rm >> 3
+        self.code += prefix
+        if rex != 0x40:
+            self.code.append(rex)
+        self.code += opcode + modrm + imm
+
+    def mov_imm(self, reg, value):
+        # mov r32, imm32
+        if reg >= 8:
+            self.code.append(0x41)
+        self.code.append(0xB8 | (reg & 7))
+        self.code += imm32(value)
+
+    def push(self, reg):
+        if reg >= 8:
+            self.code.append(0x41)
+        self.code.append(0x50 | (reg & 7))
+
+    def pop(self, reg):
+        if reg >= 8:
+            self.code.append(0x41)
+        self.code.append(0x58 | (reg & 7))
+
+    def jmp(self, label):
+        self.code.append(0xE9)
+        self.rel32(label)
+
+    def jcc(self, cc, label):
+        self.code += bytes([0x0F, 0x80 | cc])
+        self.rel32(label)
+
+    def lea_rip(self, reg, label):
+        # lea r64, [rip + label]
+        self.code += bytes([0x48 | (reg >> 3) << 2, 0x8D, (reg & 7) << 3 | 0x5])
+        self.rel32(label)
+
+    def finish(self) -> bytearray:
+        for offset, label in self.fixups:
+            self.code[offset:offset + 4] = imm32(self.labels[label] - (offset + 4))
+        return self.code
+
+def reg_slot(name):
+    # the guest register's offset in NativeState; other names make the instruction trap
+    return NativeState.regs.offset + 4 * NATIVE_REGISTERS.index(name)
+
+class NativeCompiler:
+    def __init__(self, vm):
+        self.vm = vm
+        self.program_code = vm.program.code
+        self.asm = X86Assembler()
+        self.exit_stubs = {}  # (reason, pc) -> label
+
+    def exit_label(self, reason, pc):
+        # a stub which returns to Python with the given program counter, emitted at the end
+        key = (reason, pc)
+        if key not in self.exit_stubs:
+            self.exit_stubs[key] = f"exit_{reason}_{pc}"
+        return self.exit_stubs[key]
+
+    def code_label(self, idx):
+        # where execution continues for the guest instruction idx
+        if 0 <= idx < len(self.program_code):
+            return f"L{idx}"
+        return self.exit_label(EXIT_JUMP, idx)
+
+    def load_reg(self, host_reg, name):
+        self.asm.instr(b"\x8b", host_reg, Mem(RBX, reg_slot(name)))
+
+    def store_reg(self, name, host_reg):
+        slot = reg_slot(name)
+        if name != "zero":
+            self.asm.instr(b"\x89", host_reg, Mem(RBX, slot))
+
+    def store_reg_imm(self, name, value):
+        slot = reg_slot(name)
+        if name != "zero":
+            self.asm.instr(b"\xc7", 0, Mem(RBX, slot), imm=imm32(value))
+
+    def use_fuel(self, idx):
+        # dec r13; js exit
+        self.asm.instr(b"\xff", 1, R13, wide=True)
+        self.asm.jcc(CC_S, self.exit_label(EXIT_FUEL, idx))
+
+    def compile(self) -> bytearray:
+        asm = self.asm
+        # prologue: uint32_t run(NativeState *state)
+        for reg in (RBX, R12, R13, R14):
+            asm.push(reg)
+        asm.instr(b"\x89", RDI, RBX, wide=True)  # mov rbx, rdi
+        asm.instr(b"\x8b", R12, Mem(RBX, NativeState.mem.offset), wide=True)
+        asm.instr(b"\x8b", R13, Mem(RBX, NativeState.fuel.offset), wide=True)
+        asm.instr(b"\x8b", R14, Mem(RBX, NativeState.mem_size.offset))
+        asm.instr(b"\x8b", RAX, Mem(RBX, NativeState.pc.offset))
+
+        # indirect jumps: eax holds the target program counter
+        asm.label("dispatch")
+        asm.instr(b"\x81", 7, RAX, imm=imm32(len(self.program_code)))  # cmp eax, n
+        asm.jcc(CC_AE, "exit_jump_eax")
+        asm.lea_rip(RCX, "table")
+        asm.instr(b"\xff", 4, Mem(RCX, index=RAX, scale=8))  # jmp [rcx + rax*8]
+
+        asm.label("exit_jump_eax")
+        asm.instr(b"\x89", RAX, Mem(RBX, NativeState.pc.offset))
+        asm.mov_imm(RAX, EXIT_JUMP)
+        asm.label("epilogue")
+        asm.instr(b"\x89", R13, Mem(RBX, NativeState.fuel.offset), wide=True)
+        for reg in (R14, R13, R12, RBX):
+            asm.pop(reg)
+        asm.code.append(0xC3)  # ret
+
+        for idx, (instr, args) in enumerate(self.program_code):
+            asm.label(f"L{idx}")
+            mark = asm.mark()
+            try:
+                self.compile_instruction(idx, instr, args)
+            except (ValueError, KeyError, IndexError):
+                # anything which does not lower (or would not even decode) is left to the VM
+                asm.rollback(mark)
+                asm.jmp(self.exit_label(EXIT_TRAP, idx))
+        asm.jmp(self.code_label(len(self.program_code)))  # running off the end
+
+        for (reason, pc), label in list(self.exit_stubs.items()):
+            asm.label(label)
+            asm.instr(b"\xc7", 0, Mem(RBX, NativeState.pc.offset), imm=imm32(pc))
+            asm.mov_imm(RAX, reason)
+            asm.jmp("epilogue")
+
+        # the jump table itself is filled in once the code's address is known
+        asm.code += b"\xcc" * (-len(asm.code) % 8)
+        asm.label("table")
+        asm.code += bytes(8 * len(self.program_code))
+        return asm.finish()
+
+    def compile_instruction(self, idx, instr, args):
+        asm = self.asm
+        spec = OPCODES.get(instr)
+        if spec is None or instr == "printc" or (instr == "xor" and args == ["zero", "zero", "zero"]):
+            raise ValueError(f"Trapping instruction: {instr}")
+
+        if spec.fmt == "none":
+            return
+        elif spec.fmt == "r":
+            self.load_reg(RAX, args[1])
+            self.load_reg(RCX, args[2])
+            self.compile_alu(instr, args[1], args[2])
+            self.store_reg(args[0], RAX)
+        elif spec.fmt == "i":
+            immediate = int(args[2], 0)
+            self.load_reg(RAX, args[1])
+            if instr in ("slli", "srli", "srai"):
+                self.compile_shift_immediate(instr, immediate)
+            else:
+                asm.mov_imm(RCX, immediate)
+                self.compile_alu(instr[:-1], args[1], None)
+            self.store_reg(args[0], RAX)
+        elif spec.fmt == "la":
+            if args[1] not in self.vm.data_labels:
+                raise ValueError(f"Label '{args[1]}' not found")
+            self.store_reg_imm(args[0], self.vm.data_labels[args[1]])
+        elif spec.fmt == "load":
+            offset, base_reg = parse_address(args[1], "lw")
+            self.compile_address(idx, base_reg, offset, MEMORY_ACCESS_SIZES[instr])
+            asm.instr(LOAD_OPCODES[instr], RAX, Mem(R12, index=RAX))
+            self.store_reg(args[0], RAX)
+        elif spec.fmt == "store":
+            offset, base_reg = parse_address(args[0], "sw")
+            self.compile_address(idx, base_reg, offset, MEMORY_ACCESS_SIZES[instr])
+            self.load_reg(RCX, args[1])
+            if instr == "sw":
+                asm.instr(b"\x89", RCX, Mem(R12, index=RAX))
+            elif instr == "sh":
+                asm.instr(b"\x89", RCX, Mem(R12, index=RAX), prefix=b"\x66")
+            else:
+                asm.instr(b"\x88", RCX, Mem(R12, index=RAX))
+        elif spec.fmt == "branch":
+            target = code_label_locator(self.vm, idx)(args[2])
+            self.use_fuel(idx)
+            self.load_reg(RAX, args[0])
+            asm.instr(b"\x3b", RAX, Mem(RBX, reg_slot(args[1])))  # cmp eax, [rs2]
+            asm.jcc(BRANCH_CONDITIONS[instr], self.code_label(target))
+        elif spec.fmt == "jal":
+            target = code_label_locator(self.vm, idx)(args[1])
+            self.use_fuel(idx)
+            self.store_reg_imm(args[0], idx + 1)
+            asm.jmp(self.code_label(target))
+        elif spec.fmt == "jalr":
+            target_offset = int(args[2] if len(args) > 2 else "0", 0)
+            self.use_fuel(idx)
+            self.load_reg(RAX, args[1])
+            asm.instr(b"\x81", 0, RAX, imm=imm32(target_offset))  # add eax, offset
+            self.store_reg_imm(args[0], idx + 1)
+            asm.jmp("dispatch")
+        else:
+            raise ValueError(f"Unsupported operand format: {spec.fmt}")
+
+    def compile_address(self, idx, base_reg, offset, size):
+        # eax = (base + offset) mod 2^32, trapping on misaligned or out of bounds accesses
+        asm = self.asm
+        self.load_reg(RAX, base_reg)
+        asm.instr(b"\x81", 0, RAX, imm=imm32(offset))  # add eax, offset
+        if size > 1:
+            asm.instr(b"\xf7", 0, RAX, imm=imm32(size - 1))  # test eax, size - 1
+            asm.jcc(CC_NE, self.exit_label(EXIT_TRAP, idx))
+        asm.instr(b"\x8b", RCX, RAX)  # mov ecx, eax (zero extends)
+        asm.instr(b"\x81", 0, RCX, wide=True, imm=imm32(size))  # add rcx, size
+        asm.instr(b"\x39", R14, RCX, wide=True)  # cmp rcx, r14
+        asm.jcc(CC_A, self.exit_label(EXIT_TRAP, idx))
+
+    def compile_alu(self, instr, src_reg1, src_reg2):
+        # eax = eax op ecx, where src_reg2 is None if ecx holds an immediate
+        asm = self.asm
+        if instr in SIMPLE_ALU_OPCODES:
+            asm.instr(SIMPLE_ALU_OPCODES[instr], RCX, RAX)
+        elif instr in ("slt", "sltu"):
+            asm.instr(b"\x39", RCX, RAX)  # cmp eax, ecx
+            asm.instr(bytes([0x0F, 0x90 | (CC_L if instr == "slt" else CC_B)]), 0, RAX)  # setcc al
+            asm.instr(b"\x0f\xb6", RAX, RAX)  # movzx eax, al
+        elif instr in ("sll", "srl"):
+            # x86 only uses the low 5 bits of the count, but shifting by 32 or more gives 0
+            asm.instr(b"\xd3", 4 if instr == "sll" else 5, RAX)
+            asm.instr(b"\x31", RDX, RDX)  # xor edx, edx
+            asm.instr(b"\x81", 7, RCX, imm=imm32(32))  # cmp ecx, 32
+            asm.instr(bytes([0x0F, 0x40 | CC_AE]), RAX, RDX)  # cmovae eax, edx
+        elif instr == "sra":
+            # shifting by 32 or more fills with the sign, same as shifting by 31
+            asm.mov_imm(RDX, 31)
+            asm.instr(b"\x81", 7, RCX, imm=imm32(31))  # cmp ecx, 31
+            asm.instr(bytes([0x0F, 0x40 | CC_A]), RCX, RDX)  # cmova ecx, edx
+            asm.instr(b"\xd3", 7, RAX)  # sar eax, cl
+        elif instr == "mul":
+            asm.instr(b"\x0f\xaf", RAX, RCX)  # imul eax, ecx
+        elif instr == "mulh":
+            asm.instr(b"\x63", RAX, RAX, wide=True)  # movsxd rax, eax
+            asm.instr(b"\x63", RCX, RCX, wide=True)  # movsxd rcx, ecx
+            asm.instr(b"\x0f\xaf", RAX, RCX, wide=True)  # imul rax, rcx
+            asm.instr(b"\xc1", 7, RAX, wide=True, imm=b"\x20")  # sar rax, 32
+        elif instr == "mulhu":
+            asm.instr(b"\x0f\xaf", RAX, RCX, wide=True)  # imul rax, rcx (both zero extended)
+            asm.instr(b"\xc1", 5, RAX, wide=True, imm=b"\x20")  # shr rax, 32
+        elif instr in ("div", "rem", "divu", "remu"):
+            self.compile_division(instr)
+        else:
+            raise ValueError(f"Unsupported ALU instruction: {instr}")
+
+    def compile_division(self, instr):
+        asm = self.asm
+        done = f"div_done_{len(asm.code)}"
+        divide = f"div_{len(asm.code)}"
+        # division by zero gives 0xFFFFFFFF, for the quotient and the remainder alike
+        asm.instr(b"\x85", RCX, RCX)  # test ecx, ecx
+        asm.mov_imm(RDX, MASK_32)
+        asm.instr(bytes([0x0F, 0x40 | CC_E]), RAX, RDX)  # cmove eax, edx
+        asm.jcc(CC_E, done)
+        if instr in ("div", "rem"):
+            # INT_MIN / -1 overflows (and faults on x86): the quotient wraps to INT_MIN, the remainder is 0
+            asm.instr(b"\x81", 7, RCX, imm=imm32(-1))  # cmp ecx, -1
+            asm.jcc(CC_NE, divide)
+            asm.instr(b"\x81", 7, RAX, imm=imm32(0x80000000))  # cmp eax, INT_MIN
+            asm.jcc(CC_NE, divide)
+            if instr == "rem":
+                asm.instr(b"\x31", RAX, RAX)  # xor eax, eax
+            asm.jmp(done)
+            asm.label(divide)
+            asm.code.append(0x99)  # cdq
+            asm.instr(b"\xf7", 7, RCX)  # idiv ecx
+        else:
+            asm.instr(b"\x31", RDX, RDX)  # xor edx, edx
+            asm.instr(b"\xf7", 6, RCX)  # div ecx
+        if instr in ("rem", "remu"):
+            asm.instr(b"\x89", RDX, RAX)  # mov eax, edx
+        asm.label(done)
+
+    def compile_shift_immediate(self, instr, immediate):
+        asm = self.asm
+        if immediate < 0:
+            raise ValueError("Negative shift count")  # raises in the VM too
+        if instr == "srai":
+            asm.instr(b"\xc1", 7, RAX, imm=bytes([min(immediate, 31)]))
+        elif immediate >= 32:
+            asm.instr(b"\x31", RAX, RAX)  # everything is shifted out
+        else:
+            asm.instr(b"\xc1", 4 if instr == "slli" else 5, RAX, imm=bytes([immediate]))
+
+# op r/m32, r32
+SIMPLE_ALU_OPCODES = { "add": b"\x01", "sub": b"\x29", "and": b"\x21", "or": b"\x09", "xor": b"\x31" }
+BRANCH_CONDITIONS = { "beq": CC_E, "bne": CC_NE, "blt": CC_L, "bge": CC_GE, "bltu": CC_B, "bgeu": CC_AE }
+MEMORY_ACCESS_SIZES = { "lw": 4, "sw": 4, "lh": 2, "lhu": 2, "sh": 2, "lb": 1, "lbu": 1, "sb": 1 }
+LOAD_OPCODES = {
+    "lw": b"\x8b",  # mov
+    "lh": b"\x0f\xbf",  # movsx from 16 bits
+    "lhu": b"\x0f\xb7",  # movzx from 16 bits
+    "lb": b"\x0f\xbe",  # movsx from 8 bits
+    "lbu": b"\x0f\xb6",  # movzx from 8 bits
+}
+
+class NativeCode:
+    """
+    The native translation of the program loaded into a VM, together with the executable mapping holding it
+    """
+    def __init__(self, vm):
+        if platform.machine().lower() not in ("x86_64", "amd64") or not hasattr(mmap, "PROT_EXEC"):
+            raise ValueError("The native backend needs an x86-64 host with executable mmap")
+        compiler = NativeCompiler(vm)
+        code = compiler.compile()
+        self.length = len(vm.program.code)
+
+        self.mapping = mmap.mmap(-1, max(len(code), 1), prot=mmap.PROT_READ | mmap.PROT_WRITE | mmap.PROT_EXEC)
+        self.address = ctypes.addressof(ctypes.c_char.from_buffer(self.mapping))
+        table = compiler.asm.labels["table"]
+        for idx in range(self.length):
+            code[table + 8 * idx:table + 8 * idx + 8] = (self.address + compiler.asm.labels[f"L{idx}"]).to_bytes(8, "little")
+        self.mapping.write(bytes(code))
+        self.function = ctypes.CFUNCTYPE(ctypes.c_uint32, ctypes.POINTER(NativeState))(self.address)
+        self.state = NativeState()
+
+    def enter(self, vm, fuel) -> int:
+        # runs native code from the VM's program counter until it exits, returning the reason
+        state = self.state
+        regs = vm.registers.regs
+        for slot, name in enumerate(NATIVE_REGISTERS):
+            state.regs[slot] = regs.get(name, 0)
+        state.pc = vm.program_counter
+        state.mem_size = len(vm.memory)
+        state.mem = vm.memory.buffer_info()[0]
+        state.fuel = fuel
+        reason = self.function(ctypes.byref(state))
+        for slot, name in enumerate(NATIVE_REGISTERS):
+            if name in regs or state.regs[slot] != 0:
+                regs[name] = state.regs[slot]
+        vm.program_counter = state.pc
+        return reason
+
+    def run(self, vm):
+        # runs the VM until it halts, natively wherever possible
+        while vm.program_counter != HALT_PC:
+            reason = self.enter(vm, FUEL_PER_ENTRY)
+            if reason != EXIT_FUEL:
+                # the VM runs the trapping instruction, or halts or reports the bad program counter
+                vm.interpret_step()
+
+
+if __name__ == "__main__":
+    import sys
+    import parser
+    from interpreter import VM, MemoryLayout
+
+    if len(sys.argv) != 3:
+        print("Please enter the name of the asm file to translate, and the file to write the machine code to")
+        print(f"Usage: python3 {sys.argv[0]} <asm_file> <output_file>")
+        print("(To run a program natively, use: python3 interpreter.py <asm_file> --native)")
+        sys.exit(1)
+
+    asm_parser = parser.parse_file(sys.argv[1])
+    vm = VM(layout=MemoryLayout.for_program(asm_parser))
+    vm.load_program(asm_parser)
+    compiler = NativeCompiler(vm)
+    code = compiler.compile()
+    with open(sys.argv[2], "wb") as f:
+        f.write(code)
+    print(f"Translated {len(vm.program.code)} instructions into {len(code)} bytes of x86-64")
+    print(f"Disassemble with: objdump -D -b binary -m i386:x86-64 {sys.argv[2]}")